@@ -0,0 +1,73 @@
+import argparse
+import json
+import pathlib
+import sys
+
+from relinet.benchmark import (
+    BenchmarkSettings,
+    compare_benchmark_results,
+    run_benchmarks,
+    select_benchmark_cases
+)
+
+EXPERIMENT_CONFIGURATIONS = {
+    'ship': 'ship.json',
+    'industrial-robot': 'industrial-robot.json'
+}
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark training and prediction of all model classes on synthetic data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('output')
+    run_parser.add_argument('--device', default='cpu')
+    run_parser.add_argument('--threads', type=int, default=None)
+    run_parser.add_argument('--models', nargs='*', default=None)
+    run_parser.add_argument('--epochs', type=int, default=1)
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        main_path = pathlib.Path(__file__).parent.parent.absolute()
+        cases = []
+        for experiment, configuration_name in EXPERIMENT_CONFIGURATIONS.items():
+            cases.extend(select_benchmark_cases(
+                experiment,
+                main_path.joinpath('configuration').joinpath(configuration_name),
+                model_names=args.models
+            ))
+
+        benchmark = run_benchmarks(cases, BenchmarkSettings(
+            train_epochs=args.epochs,
+            device_name=args.device,
+            torch_threads=args.threads
+        ))
+        with pathlib.Path(args.output).open(mode='w') as f:
+            json.dump(benchmark, f, indent=2)
+        return
+
+    with pathlib.Path(args.baseline).open(mode='r') as f:
+        baseline = json.load(f)
+    with pathlib.Path(args.current).open(mode='r') as f:
+        current = json.load(f)
+
+    regressions = compare_benchmark_results(baseline, current, tolerance=args.tolerance)
+    for regression in regressions:
+        print(
+            f'Regression in {regression.metric} of {regression.model_name} ({regression.experiment}): '
+            f'{regression.baseline:.4g} -> {regression.current:.4g} ({regression.relative_change:+.1%}).'
+        )
+    if len(regressions) > 0:
+        sys.exit(1)
+    print('No regressions found.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+import pathlib
+import traceback
+
+from deepsysid.pipeline.configuration import ExperimentConfiguration, ExperimentGridSearchTemplate
+
+from relinet.metrics import build_horizon_metric_file_name, compute_horizon_metrics, write_horizon_metrics
+from relinet.testing import build_run_directories, build_test_prediction_path
+from relinet.utils import load_environment, get_configuration_path
+
+from relinet.utils import retrieve_tested_models
+
+EXPERIMENTS = {
+    'ship-ind': 'progress-ship.json',
+    'ship-ood': 'progress-ship.json',
+    'industrial-robot': 'progress-industrial-robot.json'
+}
+
+
+def main():
+    parser = argparse.ArgumentParser('Compute RMSE and NRMSE at every horizon step for all runs of the best models.')
+    parser.add_argument('experiment', choices=list(EXPERIMENTS.keys()))
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    main_path = pathlib.Path(__file__).parent.parent.absolute()
+    report_path = main_path.joinpath('configuration').joinpath(EXPERIMENTS[args.experiment])
+    environment_path = main_path.joinpath('environment').joinpath(f'{args.experiment}.env')
+    environment = load_environment(environment_path)
+
+    configuration_path = get_configuration_path(environment_file_path=environment_path)
+    with configuration_path.open(mode='r') as f:
+        configuration = ExperimentConfiguration.from_grid_search_template(
+            ExperimentGridSearchTemplate.parse_obj(json.load(f))
+        )
+    n_runs = 1 if configuration.session is None else configuration.session.total_runs_for_best_models
+
+    models = sorted(retrieve_tested_models(report_path))
+    for model_name in models:
+        for run_idx in range(n_runs):
+            result_directory, _ = build_run_directories(
+                run_idx, environment['RESULT_DIRECTORY'], environment['MODELS_DIRECTORY']
+            )
+            try:
+                scores = compute_horizon_metrics(
+                    build_test_prediction_path(
+                        pathlib.Path(result_directory),
+                        model_name,
+                        'test',
+                        configuration.window_size,
+                        configuration.horizon_size
+                    ),
+                    configuration.horizon_size,
+                    len(configuration.state_names),
+                    args.batch_size
+                )
+                write_horizon_metrics(
+                    scores,
+                    pathlib.Path(result_directory).joinpath(model_name).joinpath(
+                        build_horizon_metric_file_name('test')
+                    )
+                )
+            except Exception:
+                print(f'Failure in evaluating {model_name} (run {run_idx + 1}/{n_runs}):\n{traceback.format_exc()}')
+                continue
+
+            print(f'Evaluated {model_name} (run {run_idx + 1}/{n_runs}) on {scores.n_windows} windows.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import pathlib
+import traceback
+
+from deepsysid.pipeline.configuration import ExperimentConfiguration, ExperimentGridSearchTemplate, initialize_model
+from deepsysid.pipeline.model_io import load_model
+
+from relinet.export import (
+    EXPORT_FORMATS,
+    ExportTestResult,
+    export_model,
+    get_export_directory,
+    test_exported_model,
+    write_export_test_results
+)
+from relinet.utils import load_environment, get_configuration_path, get_results_directory
+
+from relinet.utils import retrieve_tested_models
+
+EXPORTED_MODEL_BASE_NAMES = [
+    'LSTM+Init',
+    'ReLiNet',
+    'StableReLiNet'
+]
+EXPERIMENTS = {
+    'ship-ind': 'progress-ship.json',
+    'ship-ood': 'progress-ship.json',
+    'industrial-robot': 'progress-industrial-robot.json'
+}
+
+
+def main():
+    parser = argparse.ArgumentParser('Export best-performing models and test them from the exported artifacts.')
+    parser.add_argument('experiment', choices=list(EXPERIMENTS.keys()))
+    parser.add_argument('--formats', default=','.join(EXPORT_FORMATS))
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    formats = args.formats.split(',')
+
+    main_path = pathlib.Path(__file__).parent.parent.absolute()
+    report_path = main_path.joinpath('configuration').joinpath(EXPERIMENTS[args.experiment])
+    environment_path = main_path.joinpath('environment').joinpath(f'{args.experiment}.env')
+    environment = load_environment(environment_path)
+
+    configuration_path = get_configuration_path(environment_file_path=environment_path)
+    with configuration_path.open(mode='r') as f:
+        configuration = ExperimentConfiguration.from_grid_search_template(
+            ExperimentGridSearchTemplate.parse_obj(json.load(f))
+        )
+
+    models = sorted(
+        model for model in retrieve_tested_models(report_path)
+        if model.split('-')[0] in EXPORTED_MODEL_BASE_NAMES
+    )
+    models_directory = pathlib.Path(environment['MODELS_DIRECTORY'])
+
+    results = []
+    for model_name in models:
+        try:
+            model = initialize_model(configuration, model_name, 'cpu')
+            load_model(model, str(models_directory.joinpath(model_name)), model_name)
+            export_model(
+                model,
+                model_name,
+                get_export_directory(models_directory, model_name),
+                configuration.window_size,
+                configuration.horizon_size,
+                formats
+            )
+        except Exception:
+            print(f'Failure in exporting {model_name}:\n{traceback.format_exc()}')
+            continue
+
+        for backend in formats:
+            try:
+                result = test_exported_model(
+                    configuration=configuration,
+                    model_name=model_name,
+                    backend=backend,
+                    dataset_directory=pathlib.Path(environment['DATASET_DIRECTORY']),
+                    result_directory=pathlib.Path(environment['RESULT_DIRECTORY']),
+                    models_directory=models_directory,
+                    tolerance=args.tolerance,
+                    batch_size=args.batch_size
+                )
+            except Exception:
+                result = ExportTestResult(model_name, backend, success=False, error=traceback.format_exc())
+                print(f'Failure in testing {model_name} with {backend}:\n{result.error}')
+            else:
+                print(
+                    f'{model_name} ({backend}): max. abs. difference {result.max_absolute_difference:.2e}, '
+                    f'median batch latency {result.exported_batch_median_ms:.2f} ms '
+                    f'(eager {result.eager_batch_median_ms:.2f} ms).'
+                )
+            results.append(result)
+
+    write_export_test_results(
+        results,
+        get_results_directory(environment_path).joinpath('export-runs.json')
+    )
+
+
+if __name__ == '__main__':
+    main()
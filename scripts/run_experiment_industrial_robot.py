@@ -1,12 +1,26 @@
 import argparse
 import pathlib
 
+from relinet.checkpoints import CheckpointSettings
+from relinet.halving import run_successive_halving_session
+from relinet.scheduling import parse_worker_slots, run_scheduled_gridsearch_session
+from relinet.telemetry import TelemetryRecorder, get_telemetry_path
+from relinet.training import TrainingSettings
 from relinet.utils import load_environment, run_full_gridsearch_session
 
 
 def main():
     parser = argparse.ArgumentParser('Run experiments for the industrial robot dataset.')
     parser.add_argument('device')
+    parser.add_argument('--slots', default=None)
+    parser.add_argument('--halving', action='store_true')
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--rungs', type=int, default=3)
+    parser.add_argument('--checkpoint-every', type=int, default=None)
+    parser.add_argument('--checkpoint-keep', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--initializer-cache', action='store_true')
+    parser.add_argument('--warm-start', action='store_true')
     args = parser.parse_args()
 
     device_idx = int(args.device)
@@ -16,12 +30,42 @@ def main():
     environment_path = main_path.joinpath('environment').joinpath('industrial-robot.env')
 
     environment = load_environment(environment_path)
-
-    run_full_gridsearch_session(
-        report_path=report_path,
-        device_idx=device_idx,
-        environment=environment
+    checkpoint_settings = (
+        CheckpointSettings(args.checkpoint_every, args.checkpoint_keep)
+        if args.checkpoint_every is not None else None
     )
+    if checkpoint_settings is not None or args.initializer_cache or args.seed is not None:
+        environment = TrainingSettings(
+            seed=args.seed,
+            checkpoints=checkpoint_settings,
+            initializer_cache=args.initializer_cache,
+            warm_start=args.warm_start
+        ).build_environment(environment)
+    telemetry = TelemetryRecorder(get_telemetry_path(report_path), experiment='industrial-robot')
+
+    if args.halving:
+        run_successive_halving_session(
+            report_path=report_path,
+            slots=parse_worker_slots(args.slots if args.slots is not None else f'cuda:{device_idx}'),
+            environment=environment,
+            eta=args.eta,
+            n_rungs=args.rungs,
+            telemetry=telemetry
+        )
+    elif args.slots is None:
+        run_full_gridsearch_session(
+            report_path=report_path,
+            device_idx=device_idx,
+            environment=environment,
+            telemetry=telemetry
+        )
+    else:
+        run_scheduled_gridsearch_session(
+            report_path=report_path,
+            slots=parse_worker_slots(args.slots),
+            environment=environment,
+            telemetry=telemetry
+        )
 
 
 if __name__ == '__main__':
@@ -1,18 +1,23 @@
 import argparse
 import json
-import os
 import pathlib
+import sys
 
 from deepsysid.pipeline.configuration import ExperimentConfiguration, ExperimentGridSearchTemplate
-from deepsysid.pipeline.evaluation import evaluate_model
-from deepsysid.pipeline.testing.runner import test_model
 
-from relinet.utils import load_environment, retrieve_tested_models, get_configuration_path
+from relinet.predictioncache import PredictionCache, get_prediction_cache_directory
+from relinet.telemetry import TelemetryRecorder, get_telemetry_path
+from relinet.testing import run_parallel_tests
+from relinet.utils import load_environment, retrieve_tested_models, get_configuration_path, get_results_directory
 
 
 def main():
     parser = argparse.ArgumentParser('Run experiments for the 4-DOF ship in-distribution dataset.')
     parser.add_argument('device')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--prediction-cache', action='store_true')
+    parser.add_argument('--prediction-cache-gb', type=float, default=10.0)
     args = parser.parse_args()
 
     device_idx = int(args.device)
@@ -21,6 +26,13 @@ def main():
     report_path = main_path.joinpath('configuration').joinpath('progress-ship.json')
     environment_path = main_path.joinpath('environment').joinpath('ship-ood.env')
     environment = load_environment(environment_path)
+    telemetry = TelemetryRecorder(
+        get_telemetry_path(report_path),
+        experiment='ship-ood',
+        profile_directory=(
+            get_results_directory(environment_path).joinpath('profiles') if args.profile else None
+        )
+    )
 
     configuration_path = get_configuration_path(environment_file_path=environment_path)
     with configuration_path.open(mode='r') as f:
@@ -39,58 +51,32 @@ def main():
     else:
         n_runs = configuration.session.total_runs_for_best_models
 
-    for model_idx, model in enumerate(models):
-        print(
-            f'Testing {model} on out-of-distribution data ({model_idx}/{len(models)}).'
-        )
-        test_model(
-            model_name=model,
-            configuration=configuration,
-            device_name=f'cuda:{device_idx}',
-            mode='test',
-            dataset_directory=environment['DATASET_DIRECTORY'],
-            result_directory=environment['RESULT_DIRECTORY'],
-            models_directory=environment['MODELS_DIRECTORY']
-        )
-        evaluate_model(
-            model_name=model,
-            config=configuration,
-            mode='test',
-            result_directory=environment['RESULT_DIRECTORY'],
-            models_directory=environment['MODELS_DIRECTORY']
+    results = run_parallel_tests(
+        models=models,
+        n_runs=n_runs,
+        configuration=configuration,
+        environment=environment,
+        device_names=[f'cuda:{device_idx}'],
+        n_workers=args.workers,
+        telemetry=telemetry,
+        prediction_cache=(
+            PredictionCache(
+                get_prediction_cache_directory(pathlib.Path(environment['MODELS_DIRECTORY'])),
+                max_bytes=int(args.prediction_cache_gb * 1024 ** 3)
+            )
+            if args.prediction_cache else None
         )
+    )
+
+    failures = [result for result in results if not result.success]
+    for result in failures:
         print(
-            f'Finished test run 1/{n_runs}.'
+            f'Failure in testing {result.model_name} (run {result.run_idx + 1}/{n_runs}):\n'
+            f'{result.error}'
         )
-        for run_idx in range(1, n_runs):
-            result_directory = os.path.join(
-                environment['RESULT_DIRECTORY'],
-                f'repeat-{run_idx}'
-            )
-            models_directory = os.path.join(
-                environment['MODELS_DIRECTORY'],
-                f'repeat-{run_idx}'
-            )
-
-            test_model(
-                model_name=model,
-                configuration=configuration,
-                device_name=f'cuda:{device_idx}',
-                mode='test',
-                dataset_directory=environment['DATASET_DIRECTORY'],
-                result_directory=result_directory,
-                models_directory=models_directory
-            )
-            evaluate_model(
-                model_name=model,
-                config=configuration,
-                mode='test',
-                result_directory=result_directory,
-                models_directory=models_directory
-            )
-            print(
-                f'Finished test run {run_idx + 1}/{n_runs}.'
-            )
+    if len(failures) > 0:
+        print(f'{len(failures)} of {len(results)} test runs failed.')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
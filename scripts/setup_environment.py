@@ -1,8 +1,19 @@
+import argparse
 import dataclasses
-import os
 import pathlib
-import subprocess
-from distutils.dir_util import copy_tree
+from typing import Optional, Sequence
+
+from relinet.datasets import build_dataset_cache
+from relinet.provisioning import (
+    DatasetFetcher,
+    DeepsysidDownloadFetcher,
+    LocalMirrorFetcher,
+    ProvisioningManifest,
+    ProvisioningTask,
+    TaskProgress,
+    link_tree,
+    provision_datasets
+)
 
 
 @dataclasses.dataclass
@@ -69,43 +80,101 @@ def create_environment(dirs: Directories) -> None:
         ]))
 
 
-def download_datasets(dirs: Directories) -> None:
-    subprocess.call([
-        'deepsysid',
-        'download',
-        '4dof-sim-ship',
-        dirs.datasets.joinpath('ship-ind'),
-        dirs.datasets.joinpath('ship-ood')
-    ])
-
+class ShipOodTrainLinkFetcher(DatasetFetcher):
     # ship-ood is for testing only, so it does not have a train dataset.
     # However, for evaluation of explainers a train dataset is needed.
-    # We solve this by copying over the ship-ind train dataset.
-    ship_ind_train_directory = dirs.datasets.joinpath('ship-ind').joinpath('processed').joinpath('train')
-    ship_ood_train_directory = dirs.datasets.joinpath('ship-ood').joinpath('processed').joinpath('train')
-    os.makedirs(ship_ood_train_directory, exist_ok=True)
-    copy_tree(
-        str(ship_ind_train_directory),
-        str(ship_ood_train_directory)
-    )
-
-    subprocess.call([
-        'deepsysid',
-        'download',
-        'industrial-robot',
-        # train-test split is 90-10
-        # we want a 70-20-10 split
-        # this is 18% of the training set for validation
-        '--validation_fraction=0.18',
-        dirs.datasets.joinpath('industrial-robot')
-    ])
+    # We solve this by linking the ship-ind train dataset.
+    def __init__(self, ship_ind_train_directory: pathlib.Path):
+        self.ship_ind_train_directory = ship_ind_train_directory
+
+    def fetch(self, target_directories: Sequence[pathlib.Path], progress: TaskProgress) -> bool:
+        if not self.ship_ind_train_directory.is_dir():
+            return False
+        for target_directory in target_directories:
+            link_tree(self.ship_ind_train_directory, target_directory, progress)
+        return True
+
+
+def download_datasets(dirs: Directories, mirror_directory: Optional[pathlib.Path] = None) -> None:
+    if mirror_directory is None:
+        ship_fetcher = DeepsysidDownloadFetcher('4dof-sim-ship')
+        robot_fetcher = DeepsysidDownloadFetcher(
+            'industrial-robot',
+            # train-test split is 90-10
+            # we want a 70-20-10 split
+            # this is 18% of the training set for validation
+            arguments=['--validation_fraction=0.18']
+        )
+    else:
+        ship_fetcher = LocalMirrorFetcher(mirror_directory)
+        robot_fetcher = LocalMirrorFetcher(mirror_directory)
+
+    manifest = ProvisioningManifest(dirs.datasets.joinpath('manifest.json'))
+    results = provision_datasets([
+        ProvisioningTask(
+            name='4dof-sim-ship',
+            fetcher=ship_fetcher,
+            target_directories=[
+                dirs.datasets.joinpath('ship-ind'),
+                dirs.datasets.joinpath('ship-ood')
+            ]
+        ),
+        ProvisioningTask(
+            name='industrial-robot',
+            fetcher=robot_fetcher,
+            target_directories=[dirs.datasets.joinpath('industrial-robot')]
+        )
+    ], manifest)
+
+    if results['4dof-sim-ship']:
+        results.update(provision_datasets([
+            ProvisioningTask(
+                name='ship-ood-train',
+                fetcher=ShipOodTrainLinkFetcher(
+                    dirs.datasets.joinpath('ship-ind').joinpath('processed').joinpath('train')
+                ),
+                target_directories=[
+                    dirs.datasets.joinpath('ship-ood').joinpath('processed').joinpath('train')
+                ]
+            )
+        ], manifest))
+
+    failed_tasks = [name for name, success in results.items() if not success]
+    if len(failed_tasks) > 0:
+        raise ValueError(
+            f'Failed provisioning {", ".join(failed_tasks)}. '
+            'Rerun the setup to resume.'
+        )
+
+
+def build_dataset_caches(dirs: Directories) -> None:
+    for dataset_name, configuration_name in [
+        ('ship-ind', 'ship.json'),
+        ('ship-ood', 'ship.json'),
+        ('industrial-robot', 'industrial-robot.json')
+    ]:
+        build_dataset_cache(
+            dataset_directory=dirs.datasets.joinpath(dataset_name),
+            configuration_path=dirs.configuration.joinpath(configuration_name)
+        )
 
 
 def main():
+    parser = argparse.ArgumentParser('Set up directories, environment files and datasets.')
+    parser.add_argument('--build-cache', action='store_true')
+    parser.add_argument('--mirror', default=None)
+    args = parser.parse_args()
+
     main_path = pathlib.Path(__file__).parent.parent.absolute()
     dirs = create_directories(main_path)
     create_environment(dirs)
-    download_datasets(dirs)
+    download_datasets(
+        dirs,
+        mirror_directory=pathlib.Path(args.mirror).expanduser().absolute() if args.mirror else None
+    )
+
+    if args.build_cache:
+        build_dataset_caches(dirs)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,20 @@
 import pathlib
-from typing import Set, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Set, List, Optional, Tuple
 
 import h5py
 import numpy as np
 import pandas as pd
 from deepsysid.pipeline.configuration import ExperimentGridSearchTemplate, ExperimentConfiguration
 from deepsysid.pipeline.data_io import build_score_file_name, build_explanation_result_file_name
-from deepsysid.pipeline.evaluation import ReadableEvaluationScores
 from deepsysid.pipeline.gridsearch import ExperimentSessionReport
 
+from relinet.metrics import summarize_horizon_metrics
+from relinet.quantization import get_quantized_result_directory, summarize_quantization
+from relinet.scoreindex import ScoreIndex
+from relinet.statistics import reduce_dataset
+from relinet.telemetry import get_telemetry_path, read_telemetry, summarize_costs
+
 
 def get_best_models(report_path: pathlib.Path) -> Set[str]:
     report = ExperimentSessionReport.parse_file(report_path)
@@ -24,88 +30,130 @@ def get_best_models(report_path: pathlib.Path) -> Set[str]:
     return best_models
 
 
-def summarize_prediction_scores(
+def build_score_files(
     configuration: ExperimentConfiguration,
     models: Set[str],
     result_directory: pathlib.Path,
+    n_runs: int
+) -> List[Tuple[str, int, pathlib.Path]]:
+    score_file_name = build_score_file_name(
+        mode='test',
+        window_size=configuration.window_size,
+        horizon_size=configuration.horizon_size,
+        extension='json'
+    )
+    score_files = []
+    for run_idx in range(n_runs):
+        run_directory = result_directory if run_idx == 0 else result_directory.joinpath(f'repeat-{run_idx}')
+        for model in sorted(models):
+            score_files.append((model, run_idx, run_directory.joinpath(model).joinpath(score_file_name)))
+    return score_files
+
+
+def summarize_prediction_scores(
+    score_index: ScoreIndex,
+    models: Set[str],
     horizons: List[int]
 ) -> pd.DataFrame:
+    scores = score_index.scores
+    scores = scores[
+        (scores['metric'] == 'nrmse')
+        & scores['model'].isin(models)
+        & scores['horizon'].isin(horizons)
+    ]
+    df = scores\
+        .groupby(['model', 'run', 'horizon'])['value']\
+        .mean()\
+        .unstack('horizon')
+    df.columns = [f'H={horizon}' for horizon in df.columns]
+    df = df.reset_index()
+    return df[['model'] + [f'H={horizon}' for horizon in horizons] + ['run']]
+
+
+EXPLANATION_SCORE_COLUMNS = ['model', 'metric', 'explainer', 'score', 'std', 'q05', 'q50', 'q95', 'count']
+
+
+def summarize_explanation_file(
+    model: str,
+    explanation_file_path: pathlib.Path
+) -> List[List[Any]]:
     rows = []
-    for model in models:
-        score_file_name = build_score_file_name(
-            mode='test',
-            window_size=configuration.window_size,
-            horizon_size=configuration.horizon_size,
-            extension='json'
-        )
-        scores = ReadableEvaluationScores.parse_file(
-            result_directory.joinpath(model).joinpath(score_file_name)
-        )
-        row = [model]
-        for horizon in horizons:
-            nrmse_multi = np.mean(
-                scores.scores_per_horizon[horizon]['nrmse']
-            )
-            row.append(nrmse_multi)
-        rows.append(row)
+    with h5py.File(
+        explanation_file_path,
+        mode='r'
+    ) as f:
+        for metric_name in f.keys():
+            for explainer_name in f[metric_name].keys():
+                dispersion = [np.nan, np.nan, np.nan, np.nan, 1]
+                if metric_name == 'simplicity':
+                    score = float(
+                        f[metric_name][explainer_name]['metadata']['simplicity'][:]
+                    )
+                elif metric_name == 'infidelity':
+                    statistics = reduce_dataset(f[metric_name][explainer_name]['score'])
+                    summary = statistics.summarize()
+                    score = summary['mean']
+                    dispersion = [
+                        summary['std'],
+                        summary['q05'],
+                        summary['q50'],
+                        summary['q95'],
+                        summary['count']
+                    ]
+                elif metric_name == 'lipschitz':
+                    score = float(
+                        f[metric_name][explainer_name]['metadata']['largest_lipschitz_estimate'][:]
+                    )
+                else:
+                    raise NotImplementedError(
+                        f'Unknown metric name {metric_name} encountered.'
+                    )
 
-    df = pd.DataFrame(
-        data=rows,
-        columns=['model'] + [f'H={horizon}' for horizon in horizons]
-    )
-    return df
+                rows.append([
+                    model,
+                    metric_name,
+                    explainer_name,
+                    score
+                ] + dispersion)
+
+    return rows
 
 
 def summarize_explanation_scores(
     configuration: ExperimentConfiguration,
     models: Set[str],
-    result_directory: pathlib.Path
+    result_directory: pathlib.Path,
+    n_workers: Optional[int] = None
 ) -> pd.DataFrame:
-    rows = []
-    for model in models:
-        explanation_file_name = build_explanation_result_file_name(
-            mode='test',
-            window_size=configuration.window_size,
-            horizon_size=configuration.horizon_size,
-            extension='hdf5'
-        )
+    explanation_file_name = build_explanation_result_file_name(
+        mode='test',
+        window_size=configuration.window_size,
+        horizon_size=configuration.horizon_size,
+        extension='hdf5'
+    )
+    explanation_files = [
+        (model, result_directory.joinpath(model).joinpath(explanation_file_name))
+        for model in sorted(models)
+    ]
+    explanation_files = [
+        (model, explanation_file_path)
+        for model, explanation_file_path in explanation_files
+        if explanation_file_path.exists()
+    ]
 
-        explanation_file_path = result_directory.joinpath(model).joinpath(explanation_file_name)
-        if not explanation_file_path.exists():
-            continue
-
-        with h5py.File(
-            explanation_file_path
-        ) as f:
-            for metric_name in f.keys():
-                for explainer_name in f[metric_name].keys():
-                    if metric_name == 'simplicity':
-                        score = float(
-                            f[metric_name][explainer_name]['metadata']['simplicity'][:]
-                        )
-                    elif metric_name == 'infidelity':
-                        score = float(
-                            np.mean(f[metric_name][explainer_name]['score'][:])
-                        )
-                    elif metric_name == 'lipschitz':
-                        score = float(
-                            f[metric_name][explainer_name]['metadata']['largest_lipschitz_estimate'][:]
-                        )
-                    else:
-                        raise NotImplemented(
-                            f'Unknown metric name {metric_name} encountered.'
-                        )
-
-                    rows.append([
-                        model,
-                        metric_name,
-                        explainer_name,
-                        score
-                    ])
+    rows = []
+    if len(explanation_files) > 0:
+        # h5py serializes all calls within a process, so files are reduced in separate processes.
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for model_rows in executor.map(
+                summarize_explanation_file,
+                *zip(*explanation_files)
+            ):
+                rows.extend(model_rows)
 
     df = pd.DataFrame(
         data=rows,
-        columns=['model', 'metric', 'explainer', 'score']
+        columns=EXPLANATION_SCORE_COLUMNS
     )
     return df
 
@@ -123,22 +171,16 @@ def summarize_experiment(
     n_runs = configuration.session.total_runs_for_best_models
 
     horizons = [1, 15, 30, 45, configuration.horizon_size]
+    score_index = ScoreIndex(result_directory.joinpath('score-index'))
+    score_files = build_score_files(configuration, best_models, result_directory, n_runs)
+    n_parsed = score_index.update(score_files)
+    score_index.save()
+    print(f'Updated score index of {result_directory} with {n_parsed}/{len(score_files)} score files.')
     prediction_scores = summarize_prediction_scores(
-        configuration,
+        score_index,
         best_models,
-        result_directory,
         horizons
     )
-    prediction_scores['run'] = 0
-    for run_idx in range(1, n_runs):
-        additional_prediction_scores = summarize_prediction_scores(
-            configuration,
-            best_models,
-            result_directory=result_directory.joinpath(f'repeat-{run_idx}'),
-            horizons=horizons
-        )
-        additional_prediction_scores['run'] = run_idx
-        prediction_scores = pd.concat((prediction_scores, additional_prediction_scores))
 
     # https://stackoverflow.com/a/53522680
     stats = prediction_scores\
@@ -158,6 +200,11 @@ def summarize_experiment(
         result_directory
     )
 
+    costs = summarize_costs(
+        read_telemetry(get_telemetry_path(report_path)),
+        experiment=result_directory.name
+    )
+
     prediction_scores.to_csv(
         result_directory.joinpath('summary-prediction.csv'),
     )
@@ -167,6 +214,20 @@ def summarize_experiment(
     explanation_scores.to_csv(
         result_directory.joinpath('summary-explanation.csv')
     )
+    costs.to_csv(
+        result_directory.joinpath('summary-cost.csv')
+    )
+    horizon_metrics = summarize_horizon_metrics(result_directory, best_models, n_runs)
+    if len(horizon_metrics) > 0:
+        horizon_metrics.to_csv(
+            result_directory.joinpath('summary-horizon.csv')
+        )
+    if get_quantized_result_directory(result_directory).exists():
+        summarize_quantization(
+            result_directory, configuration.window_size, configuration.horizon_size, horizons
+        ).to_csv(
+            result_directory.joinpath('summary-quantization.csv')
+        )
 
 
 def main():
@@ -0,0 +1,80 @@
+import argparse
+import json
+import pathlib
+import traceback
+
+from deepsysid.pipeline.configuration import ExperimentConfiguration, ExperimentGridSearchTemplate
+
+from relinet.quantization import (
+    QuantizationTestResult,
+    get_quantized_result_directory,
+    test_quantized_model,
+    write_quantization_test_results
+)
+from relinet.utils import load_environment, get_configuration_path, get_results_directory
+
+from relinet.utils import retrieve_tested_models
+
+QUANTIZED_MODEL_BASE_NAMES = [
+    'LSTM+Init',
+    'ReLiNet',
+    'StableReLiNet'
+]
+EXPERIMENTS = {
+    'ship-ind': 'progress-ship.json',
+    'ship-ood': 'progress-ship.json',
+    'industrial-robot': 'progress-industrial-robot.json'
+}
+
+
+def main():
+    parser = argparse.ArgumentParser('Test best-performing models with dynamically quantized int8 layers on CPU.')
+    parser.add_argument('experiment', choices=list(EXPERIMENTS.keys()))
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    main_path = pathlib.Path(__file__).parent.parent.absolute()
+    report_path = main_path.joinpath('configuration').joinpath(EXPERIMENTS[args.experiment])
+    environment_path = main_path.joinpath('environment').joinpath(f'{args.experiment}.env')
+    environment = load_environment(environment_path)
+
+    configuration_path = get_configuration_path(environment_file_path=environment_path)
+    with configuration_path.open(mode='r') as f:
+        configuration = ExperimentConfiguration.from_grid_search_template(
+            ExperimentGridSearchTemplate.parse_obj(json.load(f))
+        )
+
+    models = sorted(
+        model for model in retrieve_tested_models(report_path)
+        if model.split('-')[0] in QUANTIZED_MODEL_BASE_NAMES
+    )
+
+    results = []
+    for idx, model_name in enumerate(models):
+        try:
+            result = test_quantized_model(
+                configuration=configuration,
+                model_name=model_name,
+                dataset_directory=pathlib.Path(environment['DATASET_DIRECTORY']),
+                result_directory=pathlib.Path(environment['RESULT_DIRECTORY']),
+                models_directory=pathlib.Path(environment['MODELS_DIRECTORY']),
+                tolerance=args.tolerance,
+                batch_size=args.batch_size
+            )
+        except Exception:
+            result = QuantizationTestResult(model_name, success=False, error=traceback.format_exc())
+            print(f'Failure in testing quantized {model_name}:\n{result.error}')
+        results.append(result)
+
+        print(
+            f'Tested {idx + 1}/{len(models)}.'
+        )
+
+    quantized_directory = get_quantized_result_directory(get_results_directory(environment_path))
+    quantized_directory.mkdir(parents=True, exist_ok=True)
+    write_quantization_test_results(results, quantized_directory.joinpath('quantization-runs.json'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import contextlib
+import dataclasses
+import datetime
+import json
+import math
+import multiprocessing
+import pathlib
+import platform
+import resource
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from deepsysid.pipeline.configuration import (
+    ExperimentConfiguration,
+    ExperimentGridSearchTemplate,
+    initialize_model
+)
+
+from relinet.models import is_switching_model, predict_batch, simulate_model
+from relinet.scheduling import GridModel, expand_model_grid
+from relinet.streaming import StreamingPredictor
+
+# Direction in which a metric improves: 1 if higher is better, -1 if lower is better.
+METRIC_DIRECTIONS = {
+    'train_seconds': -1,
+    'train_steps_per_second': 1,
+    'prediction_windows_per_second': 1,
+    'latency_median_ms': -1,
+    'latency_p95_ms': -1,
+    'streaming_tick_median_ms': -1,
+    'peak_rss_mb': -1,
+    'peak_cuda_mb': -1
+}
+
+
+@dataclasses.dataclass
+class BenchmarkSettings:
+    n_trajectories: int = 16
+    trajectory_length: int = 4000
+    train_epochs: int = 1
+    n_prediction_windows: int = 256
+    prediction_batch_size: int = 64
+    n_latency_repeats: int = 50
+    device_name: str = 'cpu'
+    torch_threads: Optional[int] = None
+    seed: int = 0
+
+
+@dataclasses.dataclass
+class BenchmarkCase:
+    experiment: str
+    configuration_path: pathlib.Path
+    model: GridModel
+
+
+@dataclasses.dataclass
+class Regression:
+    experiment: str
+    model_name: str
+    metric: str
+    baseline: float
+    current: float
+    relative_change: float
+
+
+def select_benchmark_cases(
+    experiment: str,
+    configuration_path: pathlib.Path,
+    model_names: Optional[Sequence[str]] = None
+) -> List[BenchmarkCase]:
+    # Without explicit model names, benchmark the most expensive configuration
+    # of every model class in the grid. Grids list their values in ascending
+    # order, so ties go to the last entry.
+    with configuration_path.open(mode='r') as f:
+        template = json.load(f)
+
+    models = expand_model_grid(template)
+    if model_names is not None:
+        selected = [model for model in models if model.model_name in model_names]
+    else:
+        largest: Dict[str, GridModel] = {}
+        for model in models:
+            current = largest.get(model.model_base_name)
+            if current is None or model.cost >= current.cost:
+                largest[model.model_base_name] = model
+        selected = list(largest.values())
+
+    return [BenchmarkCase(experiment, configuration_path, model) for model in selected]
+
+
+def generate_synthetic_data(
+    n_controls: int,
+    n_states: int,
+    settings: BenchmarkSettings
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    rng = np.random.default_rng(settings.seed)
+    control_seqs, state_seqs = [], []
+    for _ in range(settings.n_trajectories):
+        control = np.cumsum(rng.normal(size=(settings.trajectory_length, n_controls)), axis=0)
+        state = np.cumsum(rng.normal(size=(settings.trajectory_length, n_states)), axis=0)
+        control_seqs.append(control)
+        state_seqs.append(state)
+    return control_seqs, state_seqs
+
+
+@contextlib.contextmanager
+def count_optimizer_steps() -> Iterator[List[int]]:
+    # Counts the steps of every torch optimizer created while the context is
+    # active, e.g. within model.train, in the single entry of the yielded
+    # list. Models without torch optimizers take no steps. Step hooks only
+    # exist from torch 2.0, so the step method of every new optimizer is
+    # wrapped instead.
+    counter = [0]
+    original_init = torch.optim.Optimizer.__init__
+
+    def counting_init(optimizer, *args, **kwargs):
+        original_init(optimizer, *args, **kwargs)
+        step = optimizer.step
+
+        def counting_step(self, *step_args, **step_kwargs):
+            counter[0] += 1
+            return step(*step_args, **step_kwargs)
+
+        # Bound, since learning rate schedulers wrap step through __func__.
+        optimizer.step = types.MethodType(counting_step, optimizer)
+
+    torch.optim.Optimizer.__init__ = counting_init
+    try:
+        yield counter
+    finally:
+        torch.optim.Optimizer.__init__ = original_init
+
+
+def _run_benchmark_case(case: BenchmarkCase, settings: BenchmarkSettings) -> Dict[str, Any]:
+    if settings.torch_threads is not None:
+        torch.set_num_threads(settings.torch_threads)
+    torch.manual_seed(settings.seed)
+
+    with case.configuration_path.open(mode='r') as f:
+        template = json.load(f)
+    for model_template in template['models']:
+        for name in model_template.get('static_parameters', {}):
+            if name.startswith('epochs'):
+                model_template['static_parameters'][name] = settings.train_epochs
+    configuration = ExperimentConfiguration.from_grid_search_template(
+        ExperimentGridSearchTemplate.parse_obj(template)
+    )
+
+    window_size = configuration.window_size
+    horizon_size = configuration.horizon_size
+    control_seqs, state_seqs = generate_synthetic_data(
+        len(configuration.control_names),
+        len(configuration.state_names),
+        settings
+    )
+
+    model = initialize_model(configuration, case.model.model_name, settings.device_name)
+    with count_optimizer_steps() as train_steps:
+        start_time = time.perf_counter()
+        model.train(control_seqs=control_seqs, state_seqs=state_seqs)
+        train_seconds = time.perf_counter() - start_time
+
+    rng = np.random.default_rng(settings.seed)
+    windows = []
+    for _ in range(settings.n_prediction_windows):
+        trajectory_idx = rng.integers(settings.n_trajectories)
+        start = rng.integers(settings.trajectory_length - window_size - horizon_size)
+        control, state = control_seqs[trajectory_idx], state_seqs[trajectory_idx]
+        windows.append((
+            control[start:start + window_size],
+            state[start:start + window_size],
+            control[start + window_size:start + window_size + horizon_size]
+        ))
+
+    # Throughput in batches as in testing, latency of a single window.
+    batched_windows = [np.stack(arrays) for arrays in zip(*windows)]
+    start_time = time.perf_counter()
+    for batch_start in range(0, settings.n_prediction_windows, settings.prediction_batch_size):
+        predict_batch(model, *(
+            array[batch_start:batch_start + settings.prediction_batch_size] for array in batched_windows
+        ))
+    prediction_seconds = time.perf_counter() - start_time
+
+    latencies = []
+    for _ in range(settings.n_latency_repeats):
+        start_time = time.perf_counter()
+        simulate_model(model, *windows[0])
+        latencies.append(time.perf_counter() - start_time)
+
+    # One sample and one forecast per tick, after the initial window was streamed.
+    tick_latencies = []
+    if is_switching_model(model):
+        initial_control, initial_state, control = windows[0]
+        predictor = StreamingPredictor(model)
+        for time_idx in range(window_size):
+            predictor.update(initial_control[time_idx:time_idx + 1], initial_state[time_idx:time_idx + 1])
+        for _ in range(settings.n_latency_repeats):
+            start_time = time.perf_counter()
+            predictor.update(initial_control[-1:], initial_state[-1:])
+            predictor.forecast(control[np.newaxis])
+            tick_latencies.append(time.perf_counter() - start_time)
+
+    result = {
+        'experiment': case.experiment,
+        'model_name': case.model.model_name,
+        'model_class': case.model.model_class,
+        'train_seconds': train_seconds,
+        'train_steps': train_steps[0],
+        'train_steps_per_second': (
+            train_steps[0] / train_seconds if train_steps[0] > 0 else math.nan
+        ),
+        'prediction_windows_per_second': settings.n_prediction_windows / prediction_seconds,
+        'latency_median_ms': float(np.median(latencies) * 1000.0),
+        'latency_p95_ms': float(np.percentile(latencies, 95) * 1000.0),
+        'streaming_tick_median_ms': (
+            float(np.median(tick_latencies) * 1000.0) if tick_latencies else math.nan
+        ),
+        # ru_maxrss is reported in kilobytes on Linux.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+    if settings.device_name.startswith('cuda'):
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated(settings.device_name) / 1024.0 ** 2
+    return result
+
+
+def run_benchmarks(
+    cases: Sequence[BenchmarkCase],
+    settings: BenchmarkSettings
+) -> Dict[str, Any]:
+    # Every case runs in a fresh process, so peak memory is measured per model
+    # and no case benefits from caches warmed up by another.
+    results = []
+    for case_idx, case in enumerate(cases):
+        print(f'Benchmarking {case.model.model_name} ({case.experiment}, {case_idx + 1}/{len(cases)}).')
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            results.append(executor.submit(_run_benchmark_case, case, settings).result())
+
+    return {
+        'metadata': {
+            'created': datetime.datetime.now().isoformat(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'settings': dataclasses.asdict(settings)
+        },
+        'results': results
+    }
+
+
+def compare_benchmark_results(
+    baseline: Dict[str, Any],
+    current: Dict[str, Any],
+    tolerance: float = 0.1
+) -> List[Regression]:
+    baseline_results = {
+        (result['experiment'], result['model_name']): result
+        for result in baseline['results']
+    }
+
+    regressions = []
+    for result in current['results']:
+        key = (result['experiment'], result['model_name'])
+        if key not in baseline_results:
+            continue
+        for metric, direction in METRIC_DIRECTIONS.items():
+            baseline_value = baseline_results[key].get(metric)
+            current_value = result.get(metric)
+            if baseline_value is None or current_value is None:
+                continue
+            if math.isnan(baseline_value) or math.isnan(current_value) or baseline_value == 0.0:
+                continue
+
+            relative_change = (current_value - baseline_value) / abs(baseline_value)
+            if direction * relative_change < -tolerance:
+                regressions.append(Regression(
+                    experiment=key[0],
+                    model_name=key[1],
+                    metric=metric,
+                    baseline=baseline_value,
+                    current=current_value,
+                    relative_change=relative_change
+                ))
+
+    return regressions
@@ -0,0 +1,39 @@
+import sys
+from typing import Callable, List
+
+from relinet.datasets import install_split_cache_loader
+
+# Runs the deepsysid command line interface with the split cache and the
+# TrainingSettings of the environment installed:
+#   python -m relinet.cachedcli {deepsysid arguments}
+CACHED_DEEPSYSID_COMMAND = [sys.executable, '-m', 'relinet.cachedcli']
+
+
+def load_deepsysid_entry_point() -> Callable[[], None]:
+    from importlib.metadata import entry_points
+
+    scripts = entry_points()
+    if hasattr(scripts, 'select'):
+        scripts = scripts.select(group='console_scripts', name='deepsysid')
+    else:
+        # Python < 3.10
+        scripts = [script for script in scripts.get('console_scripts', []) if script.name == 'deepsysid']
+    scripts = list(scripts)
+    if len(scripts) == 0:
+        raise ImportError('The deepsysid command is not installed.')
+    return scripts[0].load()
+
+
+def main(arguments: List[str]) -> None:
+    # relinet.training imports relinet.utils, which imports this module.
+    from relinet.training import install_relinet_training
+
+    entry_point = load_deepsysid_entry_point()
+    install_split_cache_loader()
+    install_relinet_training()
+    sys.argv = ['deepsysid'] + arguments
+    entry_point()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,91 @@
+import dataclasses
+import os
+import pathlib
+import shutil
+from typing import Any, Dict, List, Optional
+
+import torch
+
+# Training phases in the order they run. Checkpoint file names sort by
+# phase and epoch, so the last file is the latest checkpoint.
+TRAINING_PHASES = ['initializer', 'predictor']
+
+
+@dataclasses.dataclass
+class CheckpointSettings:
+    # Save every every_epochs epochs and at the end of every phase.
+    every_epochs: int = 10
+    # Number of checkpoints kept per training job.
+    keep_last: int = 2
+
+    def __post_init__(self):
+        if self.every_epochs < 1 or self.keep_last < 1:
+            raise ValueError('Checkpoint interval and retention have to be positive.')
+
+
+def get_checkpoint_directory(models_directory: pathlib.Path, job_name: str) -> pathlib.Path:
+    return models_directory.joinpath('checkpoints').joinpath(job_name)
+
+
+class CheckpointManager:
+    """Checkpoints of a single training job.
+
+    A checkpoint is only valid for the job that wrote it, identified by a
+    fingerprint such as model name and seeds. Checkpoints are written
+    atomically and at most keep_last are kept. The directory is removed with
+    clear once the trained model has been saved, so only unfinished jobs
+    occupy disk space.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        fingerprint: Dict[str, Any],
+        settings: CheckpointSettings
+    ):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.settings = settings
+
+    def should_save(self, epoch: int, epochs: int) -> bool:
+        return (epoch + 1) % self.settings.every_epochs == 0 or epoch + 1 == epochs
+
+    def save(self, phase: str, epoch: int, state: Dict[str, Any]) -> pathlib.Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        file_path = self.directory.joinpath(
+            f'checkpoint-{TRAINING_PHASES.index(phase)}-{epoch:06d}.pt'
+        )
+        temporary_path = file_path.with_name(f'.{file_path.name}.tmp')
+        torch.save(
+            dict(fingerprint=self.fingerprint, phase=phase, epoch=epoch, state=state),
+            temporary_path
+        )
+        os.replace(temporary_path, file_path)
+
+        for stale_path in self._list_checkpoints()[:-self.settings.keep_last]:
+            stale_path.unlink()
+        return file_path
+
+    def load_latest(self) -> Optional[Dict[str, Any]]:
+        # Latest checkpoint that can be read and belongs to this job.
+        # Unreadable files, e.g. from a crash on a non-atomic filesystem, are skipped.
+        for file_path in reversed(self._list_checkpoints()):
+            try:
+                checkpoint = torch.load(file_path, map_location='cpu', weights_only=False)
+            except Exception as e:
+                print(f'Skipping unreadable checkpoint {file_path}: {e}')
+                continue
+            if checkpoint.get('fingerprint') != self.fingerprint:
+                print(f'Skipping checkpoint {file_path} of a different training job.')
+                continue
+            return checkpoint
+        return None
+
+    def clear(self) -> None:
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+
+    def _list_checkpoints(self) -> List[pathlib.Path]:
+        if not self.directory.exists():
+            return []
+        return sorted(self.directory.glob('checkpoint-*.pt'))
@@ -0,0 +1,206 @@
+import pathlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from deepsysid.pipeline.configuration import ExperimentConfiguration, initialize_model
+from deepsysid.pipeline.data_io import build_explanation_result_file_name
+from deepsysid.pipeline.model_io import load_model
+
+from relinet.datasets import count_windows, iterate_windows, load_split_sequences
+from relinet.explanations import ExplanationLayout, ExplanationReader, build_explanation_shapes, write_explanation_file
+from relinet.lipschitz import LipschitzSettings, estimate_lipschitz, write_lipschitz_scores
+from relinet.models import Normalization, build_initial_window, is_switching_model
+
+# Closed-form explanations are not scored by a metric, they are stored
+# under this group in place of the metric name.
+CLOSED_FORM_GROUP = 'closed-form'
+CLOSED_FORM_EXPLAINER_NAME = 'ReLiNet-Explainer'
+
+
+def build_closed_form_file_name(mode: str, window_size: int, horizon_size: int) -> str:
+    return f'closed-form-{build_explanation_result_file_name(mode, window_size, horizon_size, "hdf5")}'
+
+
+def explain_lpv_rollout(
+    normalization: Normalization,
+    y0: torch.Tensor,
+    system_matrices: torch.Tensor,
+    control_matrices: torch.Tensor
+) -> Tuple[np.ndarray, np.ndarray]:
+    # The switching predictor is an LPV system x_{k+1} = A_k x_k + B_k u_k in
+    # normalized coordinates. Unrolled over the horizon, the last predicted state
+    # is x_H = P_0 x_0 + sum_k M_k u_k with M_k = P_{k+1} B_k and P_k = P_{k+1} A_k,
+    # starting from P_H = I. Returns the weights (batch, state, horizon, control)
+    # and intercepts (batch, state) in the original units.
+    batch_size, horizon_size, state_dim, _ = system_matrices.shape
+    product = torch.eye(state_dim, device=system_matrices.device).expand(batch_size, state_dim, state_dim)
+    weights = torch.empty_like(control_matrices)
+    for time in reversed(range(horizon_size)):
+        weights[:, time] = product @ control_matrices[:, time]
+        product = product @ system_matrices[:, time]
+    offset = (product @ y0.unsqueeze(-1)).squeeze(-1)
+
+    # Undo the normalization of states and controls.
+    state_std = normalization.state_std
+    weights = weights.cpu().numpy().astype(np.float64)
+    weights = weights * state_std[np.newaxis, np.newaxis, :, np.newaxis] / normalization.control_std
+    weights_control = weights.transpose(0, 2, 1, 3)
+    intercepts = (
+        normalization.state_mean
+        + state_std * offset.cpu().numpy().astype(np.float64)
+        - np.einsum('bshc,c->bs', weights_control, normalization.control_mean)
+    )
+    return weights_control, intercepts
+
+
+def compute_closed_form_explanations(
+    model,
+    initial_control: np.ndarray,
+    initial_state: np.ndarray,
+    control: np.ndarray
+) -> Dict[str, np.ndarray]:
+    # The initial window enters the LPV rollout through x_0 and the hidden
+    # state, so its contribution is part of the intercept.
+    normalization = Normalization.from_model(model)
+    x0, y0 = build_initial_window(
+        normalization.normalize_control(initial_control),
+        normalization.normalize_state(initial_state)
+    )
+    x = normalization.normalize_control(control)
+
+    model.initializer.eval()
+    model.predictor.eval()
+    with torch.no_grad():
+        x0 = torch.from_numpy(x0).float().to(model.device)
+        y0 = torch.from_numpy(y0).float().to(model.device)
+        x = torch.from_numpy(x).float().to(model.device)
+        _, hx = model.initializer(x0, return_state=True)
+        output = model.predictor(x, previous_output=y0, hx=hx)
+        weights_control, intercepts = explain_lpv_rollout(
+            normalization, y0, output.system_matrices, output.control_matrices
+        )
+
+    batch_size, state_dim = intercepts.shape
+    return {
+        'weights_initial_control': np.zeros(
+            (batch_size, state_dim) + initial_control.shape[1:], dtype=np.float64
+        ),
+        'weights_initial_state': np.zeros(
+            (batch_size, state_dim) + initial_state.shape[1:], dtype=np.float64
+        ),
+        'weights_control': weights_control,
+        'intercepts': intercepts,
+        'initial_controls': initial_control,
+        'initial_states': initial_state,
+        'controls': control
+    }
+
+
+def write_closed_form_explanations(
+    model,
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    file_path: pathlib.Path,
+    window_size: int,
+    horizon_size: int,
+    stride: int,
+    batch_size: int = 1024,
+    lipschitz: Optional[LipschitzSettings] = None,
+    layout: Optional[ExplanationLayout] = None
+) -> int:
+    if not is_switching_model(model):
+        raise ValueError(f'Closed-form explanations require a switching model, got {type(model).__name__}.')
+    if lipschitz is not None:
+        lipschitz = lipschitz.fit_to(control_seqs[0].shape[1], state_seqs[0].shape[1])
+
+    def explain_batch(initial_control, initial_state, control, window_indices):
+        return compute_closed_form_explanations(model, initial_control, initial_state, control)
+
+    scores: List[np.ndarray] = []
+
+    def iterate_explanations():
+        position = 0
+        for initial_control, initial_state, control in iterate_windows(
+            control_seqs, state_seqs, window_size, horizon_size, stride, batch_size
+        ):
+            window_indices = np.arange(position, position + initial_control.shape[0])
+            position += initial_control.shape[0]
+            explanations = explain_batch(initial_control, initial_state, control, window_indices)
+            if lipschitz is not None:
+                scores.append(estimate_lipschitz(
+                    explain_batch, initial_control, initial_state, control,
+                    explanations, window_indices, lipschitz
+                ))
+            yield explanations
+
+    n_windows = count_windows(control_seqs, window_size, horizon_size, stride)
+    write_explanation_file(
+        file_path,
+        CLOSED_FORM_GROUP,
+        CLOSED_FORM_EXPLAINER_NAME,
+        n_windows,
+        build_explanation_shapes(state_seqs[0].shape[1], control_seqs[0].shape[1], window_size, horizon_size),
+        iterate_explanations(),
+        layout=layout
+    )
+    if lipschitz is not None:
+        write_lipschitz_scores(file_path, CLOSED_FORM_EXPLAINER_NAME, np.concatenate(scores))
+    return n_windows
+
+
+def explain_closed_form(
+    configuration: ExperimentConfiguration,
+    model_name: str,
+    device_name: str,
+    mode: str,
+    dataset_directory: pathlib.Path,
+    result_directory: pathlib.Path,
+    models_directory: pathlib.Path,
+    stride: int,
+    batch_size: int = 1024,
+    lipschitz: Optional[LipschitzSettings] = None,
+    layout: Optional[ExplanationLayout] = None
+) -> pathlib.Path:
+    model = initialize_model(configuration, model_name, device_name)
+    load_model(model, str(models_directory.joinpath(model_name)), model_name)
+
+    control_seqs, state_seqs = load_split_sequences(
+        dataset_directory, mode, configuration.control_names, configuration.state_names
+    )
+
+    result_directory.joinpath(model_name).mkdir(parents=True, exist_ok=True)
+    file_path = result_directory.joinpath(model_name).joinpath(
+        build_closed_form_file_name(mode, configuration.window_size, configuration.horizon_size)
+    )
+    write_closed_form_explanations(
+        model,
+        control_seqs,
+        state_seqs,
+        file_path,
+        configuration.window_size,
+        configuration.horizon_size,
+        stride,
+        batch_size,
+        lipschitz,
+        layout
+    )
+    return file_path
+
+
+def open_closed_form_explanations(
+    result_directory: pathlib.Path,
+    model_name: str,
+    window_size: int,
+    horizon_size: int,
+    mode: str = 'test',
+    **kwargs
+) -> ExplanationReader:
+    return ExplanationReader(
+        result_directory.joinpath(model_name).joinpath(
+            build_closed_form_file_name(mode, window_size, horizon_size)
+        ),
+        CLOSED_FORM_EXPLAINER_NAME,
+        metric_name=CLOSED_FORM_GROUP,
+        **kwargs
+    )
@@ -0,0 +1,394 @@
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import sys
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+CACHE_FORMAT_VERSION = 1
+
+
+@dataclasses.dataclass
+class CachedWindows:
+    initial_control: np.ndarray
+    initial_state: np.ndarray
+    control: np.ndarray
+    state: np.ndarray
+
+
+def build_window_index(
+    offsets: np.ndarray,
+    window_length: int,
+    stride: int = 1
+) -> np.ndarray:
+    # Start positions (in the concatenated arrays) of all windows that
+    # lie completely within a single trajectory.
+    starts = []
+    for begin, end in zip(offsets[:-1], offsets[1:]):
+        if end - begin >= window_length:
+            starts.append(np.arange(begin, end - window_length + 1, stride, dtype=np.int64))
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(starts)
+
+
+def list_split_file_names(dataset_directory: pathlib.Path, split: str) -> List[str]:
+    # Names of the trajectory files in the order of load_split_sequences.
+    split_directory = dataset_directory.joinpath('processed').joinpath(split)
+    return [file_path.name for file_path in sorted(split_directory.glob('*.csv'))]
+
+
+def read_split_directory(
+    split_directory: pathlib.Path,
+    control_names: List[str],
+    state_names: List[str]
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    file_paths = sorted(split_directory.glob('*.csv'))
+    if len(file_paths) == 0:
+        raise ValueError(f'No CSV files found in {split_directory}.')
+
+    controls, states = [], []
+    for file_path in file_paths:
+        df = pd.read_csv(file_path)
+        controls.append(df[control_names].to_numpy(dtype=np.float64))
+        states.append(df[state_names].to_numpy(dtype=np.float64))
+    return controls, states
+
+
+def iterate_windows(
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    window_size: int,
+    horizon_size: int,
+    stride: int,
+    batch_size: int,
+    with_targets: bool = False
+) -> Iterator[Tuple[np.ndarray, ...]]:
+    # Batches of (initial_control, initial_state, control) from all windows
+    # that lie within a single trajectory, in trajectory order. With
+    # with_targets, the true states over the horizon are appended.
+    control = np.concatenate(control_seqs)
+    state = np.concatenate(state_seqs)
+    offsets = np.cumsum([0] + [sequence.shape[0] for sequence in control_seqs])
+    starts = build_window_index(offsets, window_size + horizon_size, stride)
+
+    window_length = window_size + horizon_size
+    control_windows = np.lib.stride_tricks.sliding_window_view(control, window_length, axis=0).transpose(0, 2, 1)
+    state_windows = np.lib.stride_tricks.sliding_window_view(state, window_length, axis=0).transpose(0, 2, 1)
+    for batch_start in range(0, starts.shape[0], batch_size):
+        batch_starts = starts[batch_start:batch_start + batch_size]
+        batch_control = control_windows[batch_starts]
+        batch_state = state_windows[batch_starts]
+        batch = (
+            batch_control[:, :window_size],
+            batch_state[:, :window_size],
+            batch_control[:, window_size:]
+        )
+        if with_targets:
+            batch = batch + (batch_state[:, window_size:],)
+        yield batch
+
+
+def count_windows(
+    control_seqs: Sequence[np.ndarray],
+    window_size: int,
+    horizon_size: int,
+    stride: int
+) -> int:
+    offsets = np.cumsum([0] + [sequence.shape[0] for sequence in control_seqs])
+    return build_window_index(offsets, window_size + horizon_size, stride).shape[0]
+
+
+def build_split_cache(
+    split_directory: pathlib.Path,
+    cache_directory: pathlib.Path,
+    control_names: List[str],
+    state_names: List[str],
+    window_size: int,
+    horizon_size: int
+) -> None:
+    file_paths = sorted(split_directory.glob('*.csv'))
+    controls, states = read_split_directory(split_directory, control_names, state_names)
+
+    offsets = np.cumsum([0] + [control.shape[0] for control in controls]).astype(np.int64)
+
+    cache_directory.mkdir(parents=True, exist_ok=True)
+    metadata_path = cache_directory.joinpath('metadata.json')
+    if metadata_path.exists():
+        metadata_path.unlink()
+
+    np.save(cache_directory.joinpath('control.npy'), np.concatenate(controls))
+    np.save(cache_directory.joinpath('state.npy'), np.concatenate(states))
+    np.save(cache_directory.joinpath('offsets.npy'), offsets)
+    np.save(
+        cache_directory.joinpath('windows.npy'),
+        build_window_index(offsets, window_size + horizon_size)
+    )
+
+    # The metadata file is written last and marks the cache as complete.
+    metadata = {
+        'version': CACHE_FORMAT_VERSION,
+        'control_names': control_names,
+        'state_names': state_names,
+        'window_size': window_size,
+        'horizon_size': horizon_size,
+        'file_names': [file_path.name for file_path in file_paths],
+        'file_mtimes_ns': [os.stat(file_path).st_mtime_ns for file_path in file_paths]
+    }
+    with metadata_path.open(mode='w') as f:
+        json.dump(metadata, f)
+
+
+def is_split_cache_current(split_directory: pathlib.Path, cache_directory: pathlib.Path) -> bool:
+    metadata_path = cache_directory.joinpath('metadata.json')
+    if not metadata_path.exists():
+        return False
+
+    with metadata_path.open(mode='r') as f:
+        metadata = json.load(f)
+
+    file_paths = sorted(split_directory.glob('*.csv'))
+    return (
+        metadata.get('version') == CACHE_FORMAT_VERSION
+        and metadata['file_names'] == [file_path.name for file_path in file_paths]
+        and metadata['file_mtimes_ns'] == [os.stat(file_path).st_mtime_ns for file_path in file_paths]
+    )
+
+
+class SplitCache:
+    def __init__(self, cache_directory: pathlib.Path):
+        with cache_directory.joinpath('metadata.json').open(mode='r') as f:
+            metadata = json.load(f)
+
+        self.control_names: List[str] = metadata['control_names']
+        self.state_names: List[str] = metadata['state_names']
+        self.file_names: List[str] = metadata['file_names']
+        self.window_size: int = metadata['window_size']
+        self.horizon_size: int = metadata['horizon_size']
+
+        # Memory-mapped arrays are backed by the page cache, so concurrent
+        # processes reading the same split share one copy in memory.
+        self.control = np.load(cache_directory.joinpath('control.npy'), mmap_mode='r')
+        self.state = np.load(cache_directory.joinpath('state.npy'), mmap_mode='r')
+        self.offsets = np.load(cache_directory.joinpath('offsets.npy'))
+        self.window_starts = np.load(cache_directory.joinpath('windows.npy'), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return self.window_starts.shape[0]
+
+    def trajectories(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        for begin, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.control[begin:end], self.state[begin:end]
+
+    def trajectory(self, file_name: str) -> Tuple[np.ndarray, np.ndarray]:
+        idx = self.file_names.index(file_name)
+        begin, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.control[begin:end], self.state[begin:end]
+
+    def window_index(self, window_length: Optional[int] = None, stride: int = 1) -> np.ndarray:
+        if window_length is None and stride == 1:
+            return np.asarray(self.window_starts)
+        if window_length is None:
+            window_length = self.window_size + self.horizon_size
+        return build_window_index(self.offsets, window_length, stride)
+
+    def window_views(self, window_length: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Zero-copy strided views with shape (position, time, channel). Index
+        # them with window_index() to skip windows crossing trajectory boundaries.
+        if window_length is None:
+            window_length = self.window_size + self.horizon_size
+        control = np.lib.stride_tricks.sliding_window_view(self.control, window_length, axis=0)
+        state = np.lib.stride_tricks.sliding_window_view(self.state, window_length, axis=0)
+        return control.transpose(0, 2, 1), state.transpose(0, 2, 1)
+
+    def get_window(self, idx: int) -> CachedWindows:
+        start = int(self.window_starts[idx])
+        middle = start + self.window_size
+        end = middle + self.horizon_size
+        return CachedWindows(
+            initial_control=self.control[start:middle],
+            initial_state=self.state[start:middle],
+            control=self.control[middle:end],
+            state=self.state[middle:end]
+        )
+
+    def iterate_batches(
+        self,
+        batch_size: int,
+        window_starts: Optional[np.ndarray] = None
+    ) -> Iterator[CachedWindows]:
+        # Batches are zero-copy strided views into the memory-mapped arrays.
+        # A view needs evenly spaced starts, so a batch ends early where the
+        # spacing of window_starts changes, e.g. at trajectory boundaries.
+        if window_starts is None:
+            window_starts = np.asarray(self.window_starts)
+        window_length = self.window_size + self.horizon_size
+        for first_start, step, count in iterate_evenly_spaced_runs(window_starts, batch_size):
+            control = _build_strided_windows(self.control, first_start, step, count, window_length)
+            state = _build_strided_windows(self.state, first_start, step, count, window_length)
+            yield CachedWindows(
+                initial_control=control[:, :self.window_size],
+                initial_state=state[:, :self.window_size],
+                control=control[:, self.window_size:],
+                state=state[:, self.window_size:]
+            )
+
+
+def iterate_evenly_spaced_runs(starts: np.ndarray, max_count: int) -> Iterator[Tuple[int, int, int]]:
+    # Splits starts into runs of at most max_count evenly spaced values,
+    # given as (first start, spacing, count).
+    position = 0
+    while position < starts.shape[0]:
+        count = 1
+        step = int(starts[position + 1] - starts[position]) if position + 1 < starts.shape[0] else 1
+        while (
+            count < max_count
+            and position + count < starts.shape[0]
+            and starts[position + count] - starts[position + count - 1] == step
+        ):
+            count += 1
+        yield int(starts[position]), step if count > 1 else 1, count
+        position += count
+
+
+def _build_strided_windows(
+    array: np.ndarray,
+    first_start: int,
+    step: int,
+    count: int,
+    window_length: int
+) -> np.ndarray:
+    # Read-only view (count, window_length, channel) of the windows starting
+    # at first_start + i * step.
+    if first_start + (count - 1) * step + window_length > array.shape[0]:
+        raise IndexError('Window exceeds the cached split.')
+    return np.lib.stride_tricks.as_strided(
+        array[first_start:],
+        shape=(count, window_length, array.shape[1]),
+        strides=(step * array.strides[0], array.strides[0], array.strides[1]),
+        writeable=False
+    )
+
+
+def get_split_cache_directory(dataset_directory: pathlib.Path, split: str) -> pathlib.Path:
+    return dataset_directory.joinpath('cache').joinpath(split)
+
+
+def open_split_cache(dataset_directory: pathlib.Path, split: str) -> SplitCache:
+    return SplitCache(get_split_cache_directory(dataset_directory, split))
+
+
+_split_caches: Dict[pathlib.Path, Optional[SplitCache]] = {}
+
+
+def load_cached_trajectory(
+    file_path: pathlib.Path,
+    control_names: List[str],
+    state_names: List[str]
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    # Control and state of a trajectory file {dataset}/processed/{split}/{name}.csv
+    # from the split cache, or None if there is no current cache with these
+    # channels. Whether the cache is current is checked once per process.
+    split_directory = file_path.parent.absolute()
+    if split_directory not in _split_caches:
+        cache_directory = get_split_cache_directory(split_directory.parent.parent, split_directory.name)
+        _split_caches[split_directory] = (
+            SplitCache(cache_directory) if is_split_cache_current(split_directory, cache_directory) else None
+        )
+    cache = _split_caches[split_directory]
+    if (
+        cache is None
+        or list(cache.control_names) != list(control_names)
+        or list(cache.state_names) != list(state_names)
+        or file_path.name not in cache.file_names
+    ):
+        return None
+    control, state = cache.trajectory(file_path.name)
+    return np.array(control), np.array(state)
+
+
+def install_split_cache_loader() -> None:
+    # Makes deepsysid's training, testing and explanation jobs read the
+    # trajectories from the split cache instead of parsing the CSV files.
+    # deepsysid's modules import the loader by name, so every reference in an
+    # imported deepsysid module is replaced. Files without a current cache
+    # are still parsed by deepsysid.
+    from deepsysid.pipeline import data_io
+
+    original = data_io.load_control_and_state
+    if getattr(original, 'uses_split_cache', False):
+        return
+
+    def load_control_and_state(
+        file_path: str,
+        control_names: List[str],
+        state_names: List[str]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        arrays = load_cached_trajectory(pathlib.Path(file_path), control_names, state_names)
+        if arrays is None:
+            return original(file_path, control_names, state_names)
+        return arrays
+
+    load_control_and_state.uses_split_cache = True
+    for name, module in list(sys.modules.items()):
+        if name.split('.')[0] == 'deepsysid' and getattr(module, 'load_control_and_state', None) is original:
+            setattr(module, 'load_control_and_state', load_control_and_state)
+
+
+def hash_sequences(sequences: Sequence[np.ndarray]) -> str:
+    digest = hashlib.sha256()
+    for sequence in sequences:
+        sequence = np.ascontiguousarray(sequence, dtype=np.float64)
+        digest.update(str(sequence.shape).encode('utf-8'))
+        digest.update(sequence.tobytes())
+    return digest.hexdigest()
+
+
+def load_split_sequences(
+    dataset_directory: pathlib.Path,
+    split: str,
+    control_names: List[str],
+    state_names: List[str]
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    # Reads from the cache if it is current, otherwise from the CSV files.
+    split_directory = dataset_directory.joinpath('processed').joinpath(split)
+    cache_directory = get_split_cache_directory(dataset_directory, split)
+    if is_split_cache_current(split_directory, cache_directory):
+        cache = SplitCache(cache_directory)
+        if cache.control_names == control_names and cache.state_names == state_names:
+            controls, states = [], []
+            for control, state in cache.trajectories():
+                controls.append(np.array(control))
+                states.append(np.array(state))
+            return controls, states
+
+    return read_split_directory(split_directory, control_names, state_names)
+
+
+def build_dataset_cache(
+    dataset_directory: pathlib.Path,
+    configuration_path: pathlib.Path
+) -> None:
+    with configuration_path.open(mode='r') as f:
+        settings = json.load(f)['settings']
+
+    for split_directory in sorted(dataset_directory.joinpath('processed').iterdir()):
+        if not split_directory.is_dir():
+            continue
+
+        cache_directory = get_split_cache_directory(dataset_directory, split_directory.name)
+        if is_split_cache_current(split_directory, cache_directory):
+            continue
+
+        build_split_cache(
+            split_directory=split_directory,
+            cache_directory=cache_directory,
+            control_names=settings['control_names'],
+            state_names=settings['state_names'],
+            window_size=settings['window_size'],
+            horizon_size=settings['horizon_size']
+        )
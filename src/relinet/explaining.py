@@ -0,0 +1,402 @@
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import pathlib
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from deepsysid.pipeline.configuration import ExperimentConfiguration, ExperimentGridSearchTemplate
+from deepsysid.pipeline.data_io import build_explanation_result_file_name
+from deepsysid.pipeline.explaining import explain_model
+
+from relinet.closedform import explain_closed_form
+from relinet.datasets import install_split_cache_loader
+from relinet.explanations import ExplanationLayout, repack_explanation_file
+from relinet.lime import LimeSettings, explain_lime
+from relinet.lipschitz import LipschitzSettings, use_batched_lipschitz_metric
+from relinet.telemetry import TelemetryRecorder, get_telemetry_path, optional_stage
+from relinet.testing import build_run_directories
+from relinet.utils import (
+    get_configuration_path,
+    get_results_directory,
+    load_environment,
+    retrieve_tested_models,
+    stage_dataset_in_memory
+)
+
+EXPLAINED_MODEL_BASE_NAMES = [
+    'LSTM+Init',
+    'ReLiNet',
+    'StableReLiNet'
+]
+CLOSED_FORM_MODEL_BASE_NAMES = [
+    'ReLiNet',
+    'StableReLiNet'
+]
+LIME_MODEL_BASE_NAMES = [
+    'LSTM+Init'
+]
+
+_worker_configuration: Optional[ExperimentConfiguration] = None
+_worker_telemetry: Optional[TelemetryRecorder] = None
+_worker_layout: Optional[ExplanationLayout] = None
+
+
+@dataclasses.dataclass
+class ExplanationRunResult:
+    model_name: str
+    success: bool
+    duration: float
+    error: Optional[str] = None
+    run_idx: int = 0
+
+
+def _initialize_worker(
+    configuration: ExperimentConfiguration,
+    telemetry: Optional[TelemetryRecorder],
+    layout: Optional[ExplanationLayout] = None
+) -> None:
+    global _worker_configuration, _worker_telemetry, _worker_layout
+    install_split_cache_loader()
+    _worker_configuration = configuration
+    _worker_telemetry = telemetry
+    _worker_layout = layout
+
+
+def _explain(
+    model_name: str,
+    device_name: str,
+    mode: str,
+    dataset_directory: str,
+    result_directory: str,
+    models_directory: str
+) -> ExplanationRunResult:
+    start_time = time.perf_counter()
+    try:
+        with optional_stage(_worker_telemetry, model_name, 'explain'):
+            explain_model(
+                model_name=model_name,
+                device_name=device_name,
+                mode=mode,
+                configuration=_worker_configuration,
+                dataset_directory=dataset_directory,
+                result_directory=result_directory,
+                models_directory=models_directory
+            )
+        if _worker_layout is not None:
+            # deepsysid writes unchunked float64 datasets.
+            repack_explanation_file(
+                pathlib.Path(result_directory).joinpath(model_name).joinpath(build_explanation_result_file_name(
+                    mode, _worker_configuration.window_size, _worker_configuration.horizon_size, 'hdf5'
+                )),
+                _worker_layout
+            )
+    except Exception:
+        return ExplanationRunResult(
+            model_name,
+            success=False,
+            duration=time.perf_counter() - start_time,
+            error=traceback.format_exc()
+        )
+
+    return ExplanationRunResult(
+        model_name,
+        success=True,
+        duration=time.perf_counter() - start_time
+    )
+
+
+def explain_models(
+    models: Sequence[str],
+    configuration: ExperimentConfiguration,
+    environment: Dict[str, str],
+    device_names: Sequence[str],
+    n_workers: int = 0,
+    mode: str = 'test',
+    telemetry: Optional[TelemetryRecorder] = None,
+    layout: Optional[ExplanationLayout] = None,
+    lipschitz: Optional[LipschitzSettings] = None
+) -> Iterator[ExplanationRunResult]:
+    # deepsysid's Lipschitz estimate explains one disturbed window at a time.
+    # With lipschitz, it is replaced by the batched estimate.
+    if lipschitz is not None:
+        configuration = use_batched_lipschitz_metric(configuration, lipschitz)
+    # Explanation metrics need the train split in addition to the explained split.
+    splits = sorted({'train', mode})
+    with stage_dataset_in_memory(
+        pathlib.Path(environment['DATASET_DIRECTORY']), splits=splits
+    ) as dataset_directory:
+        arguments = [
+            (
+                model,
+                device_names[model_idx % len(device_names)],
+                mode,
+                str(dataset_directory),
+                environment['RESULT_DIRECTORY'],
+                environment['MODELS_DIRECTORY']
+            )
+            for model_idx, model in enumerate(models)
+        ]
+
+        if n_workers == 0:
+            _initialize_worker(configuration, telemetry, layout)
+            for model_arguments in arguments:
+                yield _explain(*model_arguments)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize_worker,
+            initargs=(configuration, telemetry, layout)
+        ) as executor:
+            futures = [
+                executor.submit(_explain, *model_arguments)
+                for model_arguments in arguments
+            ]
+            for future in futures:
+                yield future.result()
+
+
+def explain_models_closed_form(
+    models: Sequence[str],
+    n_runs: int,
+    configuration: ExperimentConfiguration,
+    environment: Dict[str, str],
+    device_name: str,
+    mode: str = 'test',
+    stride: Optional[int] = None,
+    batch_size: int = 1024,
+    lipschitz: Optional[LipschitzSettings] = None,
+    telemetry: Optional[TelemetryRecorder] = None,
+    layout: Optional[ExplanationLayout] = None
+) -> Iterator[ExplanationRunResult]:
+    # Closed-form explanations of switching models for every run, computed
+    # in batches in this process. Windows do not overlap by default.
+    if stride is None:
+        stride = configuration.window_size + configuration.horizon_size
+
+    for model_name in models:
+        for run_idx in range(n_runs):
+            result_directory, models_directory = build_run_directories(
+                run_idx, environment['RESULT_DIRECTORY'], environment['MODELS_DIRECTORY']
+            )
+            start_time = time.perf_counter()
+            try:
+                with optional_stage(telemetry, model_name, 'explain-closed-form', run_idx):
+                    explain_closed_form(
+                        configuration=configuration,
+                        model_name=model_name,
+                        device_name=device_name,
+                        mode=mode,
+                        dataset_directory=pathlib.Path(environment['DATASET_DIRECTORY']),
+                        result_directory=pathlib.Path(result_directory),
+                        models_directory=pathlib.Path(models_directory),
+                        stride=stride,
+                        batch_size=batch_size,
+                        lipschitz=lipschitz,
+                        layout=layout
+                    )
+            except Exception:
+                yield ExplanationRunResult(
+                    model_name,
+                    success=False,
+                    duration=time.perf_counter() - start_time,
+                    error=traceback.format_exc(),
+                    run_idx=run_idx
+                )
+                continue
+
+            yield ExplanationRunResult(
+                model_name,
+                success=True,
+                duration=time.perf_counter() - start_time,
+                run_idx=run_idx
+            )
+
+
+def explain_models_lime(
+    models: Sequence[str],
+    configuration: ExperimentConfiguration,
+    environment: Dict[str, str],
+    device_name: str,
+    settings: LimeSettings,
+    mode: str = 'test',
+    telemetry: Optional[TelemetryRecorder] = None,
+    layout: Optional[ExplanationLayout] = None,
+    lipschitz: Optional[LipschitzSettings] = None
+) -> Iterator[ExplanationRunResult]:
+    # deepsysid's explanations and explanation metrics, with the LIME
+    # explanations computed on settings.n_workers processes.
+    for model_name in models:
+        start_time = time.perf_counter()
+        try:
+            with optional_stage(telemetry, model_name, 'explain-lime'):
+                explain_lime(
+                    configuration=configuration,
+                    model_name=model_name,
+                    device_name=device_name,
+                    mode=mode,
+                    dataset_directory=pathlib.Path(environment['DATASET_DIRECTORY']),
+                    result_directory=pathlib.Path(environment['RESULT_DIRECTORY']),
+                    models_directory=pathlib.Path(environment['MODELS_DIRECTORY']),
+                    settings=settings,
+                    layout=layout,
+                    lipschitz=lipschitz
+                )
+        except Exception:
+            yield ExplanationRunResult(
+                model_name,
+                success=False,
+                duration=time.perf_counter() - start_time,
+                error=traceback.format_exc()
+            )
+            continue
+
+        yield ExplanationRunResult(
+            model_name,
+            success=True,
+            duration=time.perf_counter() - start_time
+        )
+
+
+def write_explanation_run_results(
+    results: List[ExplanationRunResult],
+    result_path: pathlib.Path
+) -> None:
+    with result_path.open(mode='w') as f:
+        json.dump([dataclasses.asdict(result) for result in results], f, indent=2)
+
+
+def explain_best_models(
+    description: str,
+    experiment: str,
+    report_path: pathlib.Path,
+    environment_path: pathlib.Path
+) -> None:
+    # Command line of the explain_best_models scripts. Runs deepsysid's
+    # explanations of the best models, or the closed-form or LIME
+    # explanations with --closed-form or --lime.
+    parser = argparse.ArgumentParser(description)
+    parser.add_argument('device')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--closed-form', action='store_true')
+    parser.add_argument('--stride', type=int, default=None)
+    parser.add_argument('--lime', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lipschitz', action='store_true')
+    parser.add_argument('--disturbance-chunk', type=int, default=None)
+    parser.add_argument('--chunk-samples', type=int, default=64)
+    parser.add_argument('--compression', choices=['gzip', 'lzf', 'none'], default='gzip')
+    parser.add_argument('--compression-level', type=int, default=4)
+    parser.add_argument('--float16', action='store_true')
+    parser.add_argument('--repack', action='store_true')
+    args = parser.parse_args()
+
+    device_name = f'cuda:{int(args.device)}'
+
+    tested_models = sorted(
+        model for model in retrieve_tested_models(report_path)
+        if model.split('-')[0] in EXPLAINED_MODEL_BASE_NAMES
+    )
+    environment = load_environment(environment_path)
+    results_directory = get_results_directory(environment_path)
+    telemetry = TelemetryRecorder(
+        get_telemetry_path(report_path),
+        experiment=experiment,
+        profile_directory=results_directory.joinpath('profiles') if args.profile else None
+    )
+
+    configuration_path = get_configuration_path(environment_file_path=environment_path)
+    with configuration_path.open(mode='r') as f:
+        template = json.load(f)
+    configuration = ExperimentConfiguration.from_grid_search_template(
+        ExperimentGridSearchTemplate.parse_obj(template)
+    )
+    if args.lipschitz:
+        lipschitz = LipschitzSettings.from_parameters(
+            template['settings']['explanation_metrics']['lipschitz']['parameters'],
+            seed=args.seed,
+            chunk_size=args.disturbance_chunk
+        )
+    else:
+        lipschitz = None
+    layout = ExplanationLayout(
+        chunk_size=args.chunk_samples,
+        compression=None if args.compression == 'none' else args.compression,
+        compression_level=args.compression_level,
+        float16=args.float16
+    )
+
+    results = []
+    if args.lime:
+        lime_models = [
+            model for model in tested_models
+            if model.split('-')[0] in LIME_MODEL_BASE_NAMES
+        ]
+        for idx, result in enumerate(explain_models_lime(
+            models=lime_models,
+            configuration=configuration,
+            environment=environment,
+            device_name=device_name,
+            settings=LimeSettings(seed=args.seed, n_workers=args.workers),
+            telemetry=telemetry,
+            layout=layout if args.repack else None,
+            lipschitz=lipschitz
+        )):
+            results.append(result)
+            if not result.success:
+                print(f'Failure in running LIME explanation on {result.model_name}:\n{result.error}')
+            print(f'Explained {idx + 1}/{len(lime_models)}.')
+        result_file_name = 'explanation-runs-lime.json'
+    elif args.closed_form:
+        closed_form_models = [
+            model for model in tested_models
+            if model.split('-')[0] in CLOSED_FORM_MODEL_BASE_NAMES
+        ]
+        if configuration.session is None:
+            n_runs = 1
+        else:
+            n_runs = configuration.session.total_runs_for_best_models
+
+        for idx, result in enumerate(explain_models_closed_form(
+            models=closed_form_models,
+            n_runs=n_runs,
+            configuration=configuration,
+            environment=environment,
+            device_name=device_name,
+            stride=args.stride,
+            lipschitz=lipschitz,
+            telemetry=telemetry,
+            layout=layout
+        )):
+            results.append(result)
+            if not result.success:
+                print(
+                    f'Failure in running closed-form explanation on {result.model_name} '
+                    f'(run {result.run_idx + 1}/{n_runs}):\n{result.error}'
+                )
+            print(f'Explained {idx + 1}/{len(closed_form_models) * n_runs}.')
+        result_file_name = 'explanation-runs-closed-form.json'
+    else:
+        for idx, result in enumerate(explain_models(
+            models=tested_models,
+            configuration=configuration,
+            environment=environment,
+            device_names=[device_name],
+            n_workers=args.workers,
+            telemetry=telemetry,
+            layout=layout if args.repack else None,
+            lipschitz=lipschitz
+        )):
+            results.append(result)
+            if not result.success:
+                print(f'Failure in running explain on {result.model_name}:\n{result.error}')
+            print(f'Explained {idx + 1}/{len(tested_models)}.')
+        result_file_name = 'explanation-runs.json'
+
+    write_explanation_run_results(results, results_directory.joinpath(result_file_name))
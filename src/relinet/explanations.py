@@ -0,0 +1,345 @@
+import collections
+import dataclasses
+import os
+import pathlib
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Union
+
+import h5py
+import numpy as np
+from deepsysid.explainability.base import Explanation, ModelInput
+from deepsysid.pipeline.data_io import build_explanation_result_file_name
+
+EXPLANATION_DATASETS = [
+    'weights_initial_control',
+    'weights_initial_state',
+    'weights_control',
+    'intercepts',
+    'initial_controls',
+    'initial_states',
+    'controls'
+]
+
+# Storage types of the compact layout. Only the weights are stored in half
+# precision. Intercepts and inputs are in the units of the states and
+# controls and can exceed the float16 range (65504), so they stay float32.
+REDUCED_PRECISION_DTYPES = {
+    'weights_initial_control': np.float16,
+    'weights_initial_state': np.float16,
+    'weights_control': np.float16,
+    'intercepts': np.float32,
+    'initial_controls': np.float32,
+    'initial_states': np.float32,
+    'controls': np.float32
+}
+
+SampleIndex = Union[int, slice, Sequence[int], np.ndarray]
+
+# Files without the version attribute are in the layout written by deepsysid:
+# float64 and no tuned chunking or compression. Readers choose the layout
+# from the attribute and reject other versions.
+EXPLANATION_FORMAT_VERSION = 2
+FORMAT_VERSION_ATTRIBUTE = 'relinet_format_version'
+COMPRESSIONS = ('gzip', 'lzf')
+
+
+@dataclasses.dataclass
+class ExplanationLayout:
+    # Samples per HDF5 chunk, the unit of compression and of every read.
+    chunk_size: int = 64
+    # One of COMPRESSIONS or None.
+    compression: Optional[str] = 'gzip'
+    # Only used by gzip (0-9).
+    compression_level: int = 4
+    # Byte shuffle before compression, which helps on floating point data.
+    shuffle: bool = True
+    # Store weights as float16 and intercepts and inputs as float32. Readers
+    # return float64.
+    float16: bool = False
+
+    def __post_init__(self):
+        if self.chunk_size < 1:
+            raise ValueError('Chunk size has to be positive.')
+        if self.compression is not None and self.compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {self.compression}, expected one of {COMPRESSIONS} or None.')
+
+    def get_storage_dtype(self, name: str, dtype: np.dtype) -> np.dtype:
+        # Datasets other than the explanations, e.g. scores, keep their type.
+        if not self.float16 or name not in REDUCED_PRECISION_DTYPES or not np.issubdtype(dtype, np.floating):
+            return np.dtype(dtype)
+        return np.dtype(REDUCED_PRECISION_DTYPES[name])
+
+    def build_dataset_options(
+        self,
+        name: str,
+        shape: Tuple[int, ...],
+        dtype: np.dtype
+    ) -> Dict[str, Any]:
+        # Options of h5py's create_dataset for a dataset with a leading sample axis.
+        options: Dict[str, Any] = dict(
+            shape=shape,
+            dtype=self.get_storage_dtype(name, dtype),
+            chunks=(max(min(self.chunk_size, shape[0]), 1),) + tuple(shape[1:]),
+            shuffle=self.shuffle and self.compression is not None,
+            compression=self.compression
+        )
+        if self.compression == 'gzip':
+            options['compression_opts'] = self.compression_level
+        return options
+
+
+def check_storage_range(name: str, values: np.ndarray, dtype: np.dtype) -> None:
+    # Finite values outside the range of a reduced storage type would be
+    # stored as inf.
+    if dtype == values.dtype or not np.issubdtype(dtype, np.floating):
+        return
+    finite = np.isfinite(values)
+    if np.any(np.abs(values[finite]) > np.finfo(dtype).max):
+        raise ValueError(
+            f'Values of {name} exceed the range of {np.dtype(dtype).name}, store them without --float16.'
+        )
+
+
+def read_format_version(f: h5py.File) -> Optional[int]:
+    # None for files in deepsysid's layout, which have no version attribute.
+    if FORMAT_VERSION_ATTRIBUTE not in f.attrs:
+        return None
+    version = int(f.attrs[FORMAT_VERSION_ATTRIBUTE])
+    if version != EXPLANATION_FORMAT_VERSION:
+        raise ValueError(
+            f'Explanation file {f.filename} has layout version {version}, '
+            f'only version {EXPLANATION_FORMAT_VERSION} and deepsysid\'s layout can be read.'
+        )
+    return version
+
+
+class ExplanationReader:
+    def __init__(
+        self,
+        file_path: pathlib.Path,
+        explainer_name: str,
+        metric_name: str = 'infidelity',
+        chunk_size: Optional[int] = None,
+        cache_size: int = 32
+    ):
+        self.file_path = file_path
+        self.explainer_name = explainer_name
+        self.metric_name = metric_name
+        self.cache_size = cache_size
+
+        self._file = h5py.File(file_path, mode='r')
+        try:
+            self.format_version = read_format_version(self._file)
+        except ValueError:
+            self._file.close()
+            raise
+        metadata = self._file[metric_name][explainer_name]['metadata']
+        self._datasets: Dict[str, h5py.Dataset] = {
+            name: metadata[name] for name in EXPLANATION_DATASETS
+        }
+        self.n_samples = self._datasets['intercepts'].shape[0]
+
+        # In the compact layout, default to its chunking of the sample axis,
+        # so a cache entry never decompresses more than one HDF5 chunk per
+        # dataset. deepsysid's layout is not chunked along samples.
+        if chunk_size is None:
+            chunk_size = 64
+            if self.format_version is not None:
+                chunk_size = self._datasets['weights_control'].chunks[0]
+        self.chunk_size = chunk_size
+
+        self._cache: 'collections.OrderedDict[int, Dict[str, np.ndarray]]' = (
+            collections.OrderedDict()
+        )
+
+    @classmethod
+    def from_result_directory(
+        cls,
+        result_directory: pathlib.Path,
+        model_name: str,
+        explainer_name: str,
+        window_size: int,
+        horizon_size: int,
+        mode: str = 'test',
+        **kwargs
+    ) -> 'ExplanationReader':
+        return cls(
+            result_directory.joinpath(model_name).joinpath(
+                build_explanation_result_file_name(mode, window_size, horizon_size, 'hdf5')
+            ),
+            explainer_name,
+            **kwargs
+        )
+
+    def __len__(self) -> int:
+        return self.n_samples
+
+    def __enter__(self) -> 'ExplanationReader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._cache.clear()
+        self._file.close()
+
+    def read(self, index: SampleIndex) -> Tuple[Explanation, ModelInput]:
+        # A single integer index returns a single sample, everything else
+        # returns arrays stacked along a leading sample axis.
+        if isinstance(index, (int, np.integer)):
+            arrays = self._read_samples(np.array([index]))
+            arrays = {name: array[0] for name, array in arrays.items()}
+        elif isinstance(index, slice):
+            arrays = self._read_samples(np.arange(self.n_samples)[index])
+        else:
+            arrays = self._read_samples(np.asarray(index, dtype=np.int64))
+
+        explanation = Explanation(
+            weights_initial_control=arrays['weights_initial_control'],
+            weights_initial_state=arrays['weights_initial_state'],
+            weights_control=arrays['weights_control'],
+            intercept=arrays['intercepts']
+        )
+        model_input = ModelInput(
+            initial_control=arrays['initial_controls'],
+            initial_state=arrays['initial_states'],
+            control=arrays['controls']
+        )
+        return explanation, model_input
+
+    def _read_samples(self, indices: np.ndarray) -> Dict[str, np.ndarray]:
+        indices = np.where(indices < 0, indices + self.n_samples, indices)
+        if np.any((indices < 0) | (indices >= self.n_samples)):
+            raise IndexError(
+                f'Sample index out of range for {self.n_samples} samples.'
+            )
+
+        chunk_indices = indices // self.chunk_size
+        # Reduced precision datasets of the compact layout are returned as
+        # float64, deepsysid's layout is returned as stored.
+        result = {
+            name: np.empty(
+                (len(indices),) + dataset.shape[1:],
+                dtype=(
+                    np.float64
+                    if self.format_version is not None and np.issubdtype(dataset.dtype, np.floating)
+                    else dataset.dtype
+                )
+            )
+            for name, dataset in self._datasets.items()
+        }
+        for chunk_idx in np.unique(chunk_indices):
+            chunk = self._load_chunk(int(chunk_idx))
+            mask = chunk_indices == chunk_idx
+            offsets = indices[mask] - chunk_idx * self.chunk_size
+            for name, array in chunk.items():
+                result[name][mask] = array[offsets]
+
+        return result
+
+    def _load_chunk(self, chunk_idx: int) -> Dict[str, np.ndarray]:
+        if chunk_idx in self._cache:
+            self._cache.move_to_end(chunk_idx)
+            return self._cache[chunk_idx]
+
+        start = chunk_idx * self.chunk_size
+        end = min(start + self.chunk_size, self.n_samples)
+        chunk = {
+            name: dataset[start:end]
+            for name, dataset in self._datasets.items()
+        }
+
+        self._cache[chunk_idx] = chunk
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return chunk
+
+
+def build_explanation_shapes(
+    state_dim: int,
+    control_dim: int,
+    window_size: int,
+    horizon_size: int
+) -> Dict[str, Tuple[int, ...]]:
+    # Per-sample shapes of the explanation datasets. Weights explain the
+    # last predicted state and are indexed by (state, time, input channel).
+    return {
+        'weights_initial_control': (state_dim, window_size, control_dim),
+        'weights_initial_state': (state_dim, window_size, state_dim),
+        'weights_control': (state_dim, horizon_size, control_dim),
+        'intercepts': (state_dim,),
+        'initial_controls': (window_size, control_dim),
+        'initial_states': (window_size, state_dim),
+        'controls': (horizon_size, control_dim)
+    }
+
+
+def write_explanation_file(
+    file_path: pathlib.Path,
+    group_name: str,
+    explainer_name: str,
+    n_samples: int,
+    shapes: Dict[str, Tuple[int, ...]],
+    batches: Iterable[Dict[str, np.ndarray]],
+    layout: Optional[ExplanationLayout] = None
+) -> None:
+    # Writes batches of explanations in the group structure of deepsysid's
+    # explanation files as they arrive, so memory use does not grow with the
+    # number of samples.
+    if layout is None:
+        layout = ExplanationLayout()
+
+    temporary_path = file_path.with_name(f'.{file_path.name}.tmp')
+    with h5py.File(temporary_path, mode='w') as f:
+        f.attrs[FORMAT_VERSION_ATTRIBUTE] = EXPLANATION_FORMAT_VERSION
+        metadata = f.create_group(group_name).create_group(explainer_name).create_group('metadata')
+        datasets = {
+            name: metadata.create_dataset(
+                name, **layout.build_dataset_options(name, (n_samples,) + shapes[name], np.float64)
+            )
+            for name in EXPLANATION_DATASETS
+        }
+        position = 0
+        for batch in batches:
+            n_batch = batch['intercepts'].shape[0]
+            for name, dataset in datasets.items():
+                check_storage_range(name, batch[name], dataset.dtype)
+                dataset[position:position + n_batch] = batch[name]
+            position += n_batch
+        if position != n_samples:
+            raise ValueError(f'Expected {n_samples} explanations, received {position}.')
+    os.replace(temporary_path, file_path)
+
+
+def repack_explanation_file(
+    file_path: pathlib.Path,
+    layout: ExplanationLayout,
+    block_size: int = 4096
+) -> None:
+    # Rewrites an explanation file, e.g. one written by deepsysid, in the given
+    # layout. Datasets are copied in blocks of samples. Only the explanations
+    # and inputs are reduced in precision, scores keep theirs.
+    temporary_path = file_path.with_name(f'.{file_path.name}.tmp')
+    with h5py.File(file_path, mode='r') as source, h5py.File(temporary_path, mode='w') as target:
+        def copy_group(source_group: h5py.Group, target_group: h5py.Group) -> None:
+            target_group.attrs.update(source_group.attrs)
+            for name, item in source_group.items():
+                if isinstance(item, h5py.Group):
+                    copy_group(item, target_group.create_group(name))
+                elif item.ndim == 0 or item.shape[0] == 0:
+                    target_group.create_dataset(name, data=item[()])
+                    target_group[name].attrs.update(item.attrs)
+                else:
+                    dataset = target_group.create_dataset(
+                        name, **layout.build_dataset_options(name, item.shape, item.dtype)
+                    )
+                    dataset.attrs.update(item.attrs)
+                    for start in range(0, item.shape[0], block_size):
+                        block = item[start:start + block_size]
+                        check_storage_range(name, block, dataset.dtype)
+                        dataset[start:start + block_size] = block
+
+        copy_group(source, target)
+        target.attrs[FORMAT_VERSION_ATTRIBUTE] = EXPLANATION_FORMAT_VERSION
+    os.replace(temporary_path, file_path)
@@ -0,0 +1,320 @@
+import dataclasses
+import json
+import math
+import pathlib
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+from deepsysid.pipeline.configuration import ExperimentConfiguration, initialize_model
+from deepsysid.pipeline.evaluation import evaluate_model
+from deepsysid.pipeline.model_io import load_model
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:
+    # ONNX artifacts are only run if onnxruntime is installed.
+    onnxruntime = None
+
+from relinet.datasets import list_split_file_names, load_split_sequences
+from relinet.models import Normalization, build_initial_window, is_recurrent_model, is_switching_model, predict_batch
+from relinet.testing import TestPredictionWriter, build_test_prediction_path, iterate_test_windows
+
+EXPORT_FORMATS = ('torchscript', 'onnx')
+EXPORTED_DIRECTORY_NAME = 'exported'
+ONNX_OPSET_VERSION = 13
+
+
+class PredictionGraph(nn.Module):
+    # Initializer and predictor as a single module on normalized tensors,
+    # returning only the predicted states so it can be traced.
+    def __init__(self, initializer: nn.Module, predictor: nn.Module, switching: bool):
+        super().__init__()
+        self.initializer = initializer
+        self.predictor = predictor
+        self.switching = switching
+
+    def forward(self, x0: torch.Tensor, x: torch.Tensor, y0: torch.Tensor) -> torch.Tensor:
+        _, hx = self.initializer(x0, return_state=True)
+        if self.switching:
+            return self.predictor(x, previous_output=y0, hx=hx).outputs
+        # Keep y0 in the graph, so all artifacts share the same inputs.
+        return self.predictor(x, hx=hx) + 0.0 * y0.unsqueeze(1)
+
+
+@dataclasses.dataclass
+class ExportMetadata:
+    model_name: str
+    model_class: str
+    window_size: int
+    horizon_size: int
+    formats: List[str]
+    normalization: Normalization
+
+    def to_json(self) -> Dict:
+        return dict(
+            model_name=self.model_name,
+            model_class=self.model_class,
+            window_size=self.window_size,
+            horizon_size=self.horizon_size,
+            formats=self.formats,
+            normalization={
+                name: np.asarray(value).tolist()
+                for name, value in dataclasses.asdict(self.normalization).items()
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'ExportMetadata':
+        return cls(
+            model_name=data['model_name'],
+            model_class=data['model_class'],
+            window_size=data['window_size'],
+            horizon_size=data['horizon_size'],
+            formats=data['formats'],
+            normalization=Normalization(**{
+                name: np.array(value, dtype=np.float64)
+                for name, value in data['normalization'].items()
+            })
+        )
+
+
+@dataclasses.dataclass
+class ExportTestResult:
+    model_name: str
+    backend: str
+    success: bool
+    error: Optional[str] = None
+    n_windows: int = 0
+    max_absolute_difference: float = math.nan
+    eager_max_deviation: float = math.nan
+    eager_batch_median_ms: float = math.nan
+    exported_batch_median_ms: float = math.nan
+    eager_windows_per_second: float = math.nan
+    exported_windows_per_second: float = math.nan
+
+
+def get_export_directory(models_directory: pathlib.Path, model_name: str) -> pathlib.Path:
+    return models_directory.joinpath(model_name).joinpath('export')
+
+
+def build_artifact_file_name(model_name: str, export_format: str) -> str:
+    extension = 'pt' if export_format == 'torchscript' else 'onnx'
+    return f'{model_name}.{extension}'
+
+
+def export_model(
+    model,
+    model_name: str,
+    export_directory: pathlib.Path,
+    window_size: int,
+    horizon_size: int,
+    formats: Sequence[str] = EXPORT_FORMATS
+) -> ExportMetadata:
+    if not is_recurrent_model(model):
+        raise ValueError(f'Only recurrent models can be exported, got {type(model).__name__}.')
+    for export_format in formats:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f'Unknown export format {export_format}, expected one of {EXPORT_FORMATS}.')
+
+    normalization = Normalization.from_model(model)
+    control_dim = normalization.control_mean.shape[0]
+    state_dim = normalization.state_mean.shape[0]
+
+    graph = PredictionGraph(model.initializer, model.predictor, is_switching_model(model)).cpu().eval()
+    example_inputs = (
+        torch.zeros((2, window_size - 1, control_dim + state_dim)),
+        torch.zeros((2, horizon_size, control_dim)),
+        torch.zeros((2, state_dim))
+    )
+
+    export_directory.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        if 'torchscript' in formats:
+            traced = torch.jit.trace(graph, example_inputs, check_trace=False)
+            traced.save(str(export_directory.joinpath(build_artifact_file_name(model_name, 'torchscript'))))
+        if 'onnx' in formats:
+            torch.onnx.export(
+                graph,
+                example_inputs,
+                str(export_directory.joinpath(build_artifact_file_name(model_name, 'onnx'))),
+                input_names=['x0', 'x', 'y0'],
+                output_names=['y'],
+                dynamic_axes={'x0': {0: 'batch'}, 'x': {0: 'batch'}, 'y0': {0: 'batch'}, 'y': {0: 'batch'}},
+                opset_version=ONNX_OPSET_VERSION
+            )
+    # The graph shares its modules with the model, move them back.
+    model.initializer.to(model.device)
+    model.predictor.to(model.device)
+
+    metadata = ExportMetadata(
+        model_name=model_name,
+        model_class=f'{type(model).__module__}.{type(model).__name__}',
+        window_size=window_size,
+        horizon_size=horizon_size,
+        formats=list(formats),
+        normalization=normalization
+    )
+    with export_directory.joinpath(f'{model_name}.json').open(mode='w') as f:
+        json.dump(metadata.to_json(), f, indent=2)
+    return metadata
+
+
+class ExportedModel:
+    """Runs an exported model on CPU without deepsysid.
+
+    The torchscript backend only needs torch, the onnx backend needs onnxruntime.
+    """
+
+    def __init__(self, export_directory: pathlib.Path, model_name: str, backend: str = 'torchscript'):
+        with export_directory.joinpath(f'{model_name}.json').open(mode='r') as f:
+            self.metadata = ExportMetadata.from_json(json.load(f))
+        if backend not in self.metadata.formats:
+            raise ValueError(f'{model_name} was not exported to {backend}.')
+
+        self.backend = backend
+        artifact_path = export_directory.joinpath(build_artifact_file_name(model_name, backend))
+        if backend == 'torchscript':
+            self._module = torch.jit.load(str(artifact_path), map_location='cpu').eval()
+        else:
+            if onnxruntime is None:
+                raise ImportError('The onnx backend requires onnxruntime to be installed.')
+            self._session = onnxruntime.InferenceSession(
+                str(artifact_path), providers=['CPUExecutionProvider']
+            )
+
+    def predict_batch(
+        self,
+        initial_control: np.ndarray,
+        initial_state: np.ndarray,
+        control: np.ndarray
+    ) -> np.ndarray:
+        # Same inputs and outputs as relinet.models.predict_batch. Tracing
+        # unrolls the loop over the horizon, so the artifact only predicts
+        # the horizon it was exported with.
+        if control.ndim != 3 or control.shape[1] != self.metadata.horizon_size:
+            raise ValueError(
+                f'{self.metadata.model_name} was exported for a horizon of {self.metadata.horizon_size} steps, '
+                f'got control of shape {control.shape} (expected (batch, {self.metadata.horizon_size}, control)).'
+            )
+        normalization = self.metadata.normalization
+        x0, y0 = build_initial_window(
+            normalization.normalize_control(initial_control),
+            normalization.normalize_state(initial_state)
+        )
+        x = normalization.normalize_control(control)
+        x0, x, y0 = (array.astype(np.float32) for array in (x0, x, y0))
+
+        if self.backend == 'torchscript':
+            with torch.no_grad():
+                prediction = self._module(torch.from_numpy(x0), torch.from_numpy(x), torch.from_numpy(y0)).numpy()
+        else:
+            prediction = self._session.run(['y'], {'x0': x0, 'x': x, 'y0': y0})[0]
+        return normalization.denormalize_state(prediction.astype(np.float64))
+
+
+def get_exported_result_directory(result_directory: pathlib.Path, backend: str) -> pathlib.Path:
+    # Result directory of a backend in the layout of deepsysid, holding the
+    # test predictions and scores of every exported model.
+    return result_directory.joinpath(EXPORTED_DIRECTORY_NAME).joinpath(backend)
+
+
+def test_exported_model(
+    configuration: ExperimentConfiguration,
+    model_name: str,
+    backend: str,
+    dataset_directory: pathlib.Path,
+    result_directory: pathlib.Path,
+    models_directory: pathlib.Path,
+    mode: str = 'test',
+    batch_size: int = 256,
+    tolerance: float = 1e-3
+) -> ExportTestResult:
+    # Test pass from the exported artifact over the windows of the deepsysid
+    # test run of the model, timed against the eager model on the same
+    # batches. The predictions are written in deepsysid's test layout to
+    # result_directory/exported/{backend} and scored with evaluate_model. The
+    # eager predictions have to reproduce those of the test run up to
+    # tolerance (in units of the state standard deviation).
+    exported = ExportedModel(get_export_directory(models_directory, model_name), model_name, backend)
+    model = initialize_model(configuration, model_name, 'cpu')
+    load_model(model, str(models_directory.joinpath(model_name)), model_name)
+    state_std = Normalization.from_model(model).state_std
+
+    control_seqs, state_seqs = load_split_sequences(
+        dataset_directory, mode, configuration.control_names, configuration.state_names
+    )
+    reference_path = build_test_prediction_path(
+        result_directory, model_name, mode, configuration.window_size, configuration.horizon_size
+    )
+    backend_result_directory = get_exported_result_directory(result_directory, backend)
+
+    eager_latencies, exported_latencies = [], []
+    n_windows = 0
+    max_absolute_difference = 0.0
+    eager_max_deviation = 0.0
+    with TestPredictionWriter(reference_path, build_test_prediction_path(
+        backend_result_directory, model_name, mode, configuration.window_size, configuration.horizon_size
+    )) as writer:
+        for initial_control, initial_state, control, _, reference_prediction in iterate_test_windows(
+            reference_path,
+            control_seqs,
+            state_seqs,
+            list_split_file_names(dataset_directory, mode),
+            configuration.window_size,
+            configuration.horizon_size,
+            batch_size
+        ):
+            start_time = time.perf_counter()
+            eager_prediction = predict_batch(model, initial_control, initial_state, control)
+            eager_latencies.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            exported_prediction = exported.predict_batch(initial_control, initial_state, control)
+            exported_latencies.append(time.perf_counter() - start_time)
+
+            writer.write(exported_prediction)
+            n_windows += initial_control.shape[0]
+            max_absolute_difference = max(
+                max_absolute_difference, float(np.max(np.abs(exported_prediction - eager_prediction)))
+            )
+            eager_max_deviation = max(
+                eager_max_deviation, float(np.max(np.abs(eager_prediction - reference_prediction) / state_std))
+            )
+
+    if eager_max_deviation > tolerance:
+        raise ValueError(
+            f'Eager predictions of {model_name} deviate from its test run by {eager_max_deviation:.2e} '
+            f'state standard deviations, more than the tolerance of {tolerance:.2e}.'
+        )
+
+    evaluate_model(
+        model_name=model_name,
+        config=configuration,
+        mode=mode,
+        result_directory=str(backend_result_directory),
+        models_directory=str(models_directory)
+    )
+
+    return ExportTestResult(
+        model_name=model_name,
+        backend=backend,
+        success=True,
+        n_windows=n_windows,
+        max_absolute_difference=max_absolute_difference,
+        eager_max_deviation=eager_max_deviation,
+        eager_batch_median_ms=float(np.median(eager_latencies) * 1000.0),
+        exported_batch_median_ms=float(np.median(exported_latencies) * 1000.0),
+        eager_windows_per_second=n_windows / sum(eager_latencies),
+        exported_windows_per_second=n_windows / sum(exported_latencies)
+    )
+
+
+def write_export_test_results(
+    results: List[ExportTestResult],
+    result_path: pathlib.Path
+) -> None:
+    with result_path.open(mode='w') as f:
+        json.dump([dataclasses.asdict(result) for result in results], f, indent=2)
@@ -0,0 +1,204 @@
+import copy
+import json
+import math
+import os
+import pathlib
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from relinet.scheduling import (
+    GridModel,
+    GridsearchJob,
+    WorkerSlot,
+    expand_model_grid,
+    open_session_report,
+    run_jobs_on_slots,
+    run_test_best
+)
+from relinet.scoreindex import read_validation_score
+from relinet.telemetry import TelemetryRecorder
+
+
+def get_halving_state_path(report_path: pathlib.Path) -> pathlib.Path:
+    return report_path.with_name(f'{report_path.stem}.halving.json')
+
+
+def build_rung_budgets(eta: int, n_rungs: int) -> List[float]:
+    # Fraction of the configured epochs trained at each rung, e.g. eta=3 and
+    # n_rungs=3 gives [1/9, 1/3, 1]. The last rung always trains the full budget.
+    if eta < 2 or n_rungs < 1:
+        raise ValueError('Successive halving requires eta >= 2 and at least one rung.')
+    return [float(eta) ** -(n_rungs - 1 - rung_idx) for rung_idx in range(n_rungs)]
+
+
+def is_budgeted(model: GridModel) -> bool:
+    return any(name.startswith('epochs') for name in model.parameters)
+
+
+def scale_epochs(template: Dict[str, Any], budget: float) -> Dict[str, Any]:
+    # Model names only depend on the flexible parameters, so all models keep
+    # their names in the scaled configuration.
+    template = copy.deepcopy(template)
+    for model in template['models']:
+        static_parameters = model.get('static_parameters', {})
+        for name, value in static_parameters.items():
+            if name.startswith('epochs'):
+                static_parameters[name] = max(int(round(value * budget)), 1)
+        for name in model.get('flexible_parameters', {}):
+            if name.startswith('epochs'):
+                raise ValueError(
+                    f'Epochs of {model["model_base_name"]} are a flexible parameter, '
+                    'which cannot be scaled without renaming the models.'
+                )
+    return template
+
+
+def select_promoted_models(
+    models: Sequence[GridModel],
+    scores: Dict[str, Optional[float]],
+    eta: int
+) -> List[GridModel]:
+    # Promotion is done separately for each base name, since the report
+    # keeps the best model per base name. Failed models are never promoted.
+    promoted = []
+    base_names = sorted(set(model.model_base_name for model in models))
+    for base_name in base_names:
+        candidates = [
+            model for model in models
+            if model.model_base_name == base_name
+            and scores.get(model.model_name) is not None
+            and math.isfinite(scores[model.model_name])
+        ]
+        candidates = sorted(candidates, key=lambda model: (scores[model.model_name], model.model_name))
+        n_group = sum(1 for model in models if model.model_base_name == base_name)
+        promoted.extend(candidates[:max(math.ceil(n_group / eta), 1)])
+    return promoted
+
+
+class HalvingState:
+    def __init__(self, state_path: pathlib.Path):
+        # Validation scores per rung, None marks a failed job.
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self.scores: Dict[str, Dict[str, Optional[float]]] = {}
+        if state_path.exists():
+            with state_path.open(mode='r') as f:
+                self.scores = json.load(f)
+
+    def get_rung_scores(self, rung_idx: int) -> Dict[str, Optional[float]]:
+        with self._lock:
+            return dict(self.scores.get(str(rung_idx), {}))
+
+    def record(self, rung_idx: int, model_name: str, score: Optional[float]) -> None:
+        with self._lock:
+            self.scores.setdefault(str(rung_idx), {})[model_name] = score
+            self.write()
+
+    def write(self) -> None:
+        temporary_path = self.state_path.with_name(f'.{self.state_path.name}.tmp')
+        with temporary_path.open(mode='w') as f:
+            json.dump(self.scores, f, indent=2)
+        os.replace(temporary_path, self.state_path)
+
+
+def build_rung_environment(
+    environment: Dict[str, str],
+    rung_idx: int,
+    template: Dict[str, Any],
+    budget: float
+) -> Dict[str, str]:
+    # Lower rungs train into their own model and result directories with a
+    # configuration whose epochs are scaled down to the rung budget.
+    models_directory = pathlib.Path(environment['MODELS_DIRECTORY']).joinpath('rungs').joinpath(f'rung-{rung_idx}')
+    result_directory = pathlib.Path(environment['RESULT_DIRECTORY']).joinpath('rungs').joinpath(f'rung-{rung_idx}')
+    models_directory.mkdir(parents=True, exist_ok=True)
+    result_directory.mkdir(parents=True, exist_ok=True)
+
+    configuration_path = result_directory.joinpath('configuration.json')
+    with configuration_path.open(mode='w') as f:
+        json.dump(scale_epochs(template, budget), f, indent=2)
+
+    env = environment.copy()
+    env['MODELS_DIRECTORY'] = str(models_directory)
+    env['RESULT_DIRECTORY'] = str(result_directory)
+    env['CONFIGURATION'] = str(configuration_path)
+    return env
+
+
+def run_successive_halving_session(
+    report_path: pathlib.Path,
+    slots: Sequence[WorkerSlot],
+    environment: Dict[str, str],
+    eta: int = 3,
+    n_rungs: int = 3,
+    telemetry: Optional[TelemetryRecorder] = None
+):
+    with pathlib.Path(environment['CONFIGURATION']).open(mode='r') as f:
+        template = json.load(f)
+    settings = template['settings']
+
+    models = expand_model_grid(template)
+    writer = open_session_report(report_path, [model.model_name for model in models])
+    state = HalvingState(get_halving_state_path(report_path))
+    budgets = build_rung_budgets(eta, n_rungs)
+
+    # Models without epochs are fitted in one pass and skip the lower rungs.
+    candidates = [model for model in models if is_budgeted(model)]
+    for rung_idx, budget in enumerate(budgets[:-1]):
+        rung_environment = build_rung_environment(environment, rung_idx, template, budget)
+        rung_scores = state.get_rung_scores(rung_idx)
+        jobs = [
+            GridsearchJob(
+                model_name=model.model_name,
+                model_base_name=model.model_base_name,
+                cost=model.cost * budget
+            )
+            for model in candidates
+            if rung_scores.get(model.model_name) is None
+        ]
+        print(f'Rung {rung_idx}: training {len(jobs)} of {len(candidates)} models with {budget:.3f} of the epochs.')
+
+        def on_finished(job: GridsearchJob, success: bool) -> None:
+            score = None
+            if success:
+                score = read_validation_score(
+                    pathlib.Path(rung_environment['RESULT_DIRECTORY']),
+                    job.model_name,
+                    settings['window_size'],
+                    settings['horizon_size'],
+                    settings['target_metric']
+                )
+            else:
+                print(f'Failure in training or validating {job.model_name} at rung {rung_idx}.')
+            state.record(rung_idx, job.model_name, score)
+
+        run_jobs_on_slots(jobs, slots, rung_environment, telemetry, on_finished)
+        candidates = select_promoted_models(candidates, state.get_rung_scores(rung_idx), eta)
+
+    finalists: Set[str] = set(model.model_name for model in candidates)
+    finalists.update(model.model_name for model in models if not is_budgeted(model))
+    writer.mark_pruned(set(model.model_name for model in models) - finalists)
+
+    unfinished_models = set(writer.report.unfinished_models)
+    jobs = [
+        GridsearchJob(
+            model_name=model.model_name,
+            model_base_name=model.model_base_name,
+            cost=model.cost
+        )
+        for model in models
+        if model.model_name in finalists and model.model_name in unfinished_models
+    ]
+    print(f'Final rung: training {len(jobs)} of {len(finalists)} models with the full budget.')
+
+    def on_finished_final(job: GridsearchJob, success: bool) -> None:
+        if success:
+            writer.mark_validated(job.model_name)
+        else:
+            print(f'Failure in training or validating {job.model_name}.')
+
+    results = run_jobs_on_slots(jobs, slots, environment, telemetry, on_finished_final)
+    if not all(results):
+        raise ValueError('Failed running successive halving session.')
+
+    run_test_best(report_path, slots[0], environment, telemetry)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from torch import nn
+
+
+def get_initializer_cache_directory(models_directory: pathlib.Path) -> pathlib.Path:
+    return models_directory.joinpath('initializer-cache')
+
+
+def hash_tensors(tensors: Sequence[torch.Tensor]) -> str:
+    digest = hashlib.sha256()
+    for tensor in tensors:
+        array = tensor.detach().cpu().contiguous().numpy()
+        digest.update(str(array.shape).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def describe_lstm_sizes(initializer: nn.Module) -> List[List[int]]:
+    return [
+        [module.hidden_size, module.num_layers]
+        for module in initializer.modules() if isinstance(module, nn.LSTM)
+    ]
+
+
+def describe_initializer_family(initializer: nn.Module) -> List[List[Any]]:
+    # The architecture without the hidden sizes and numbers of layers of the
+    # LSTMs, which is shared by the initializers one can be grown from.
+    description = []
+    for name, module in initializer.named_modules():
+        if isinstance(module, nn.LSTM):
+            description.append([name, 'LSTM', module.input_size, module.dropout, module.bias, module.batch_first])
+        elif isinstance(module, nn.Linear):
+            description.append([name, 'Linear', module.out_features, module.bias is not None])
+        else:
+            description.append([name, type(module).__name__])
+    return description
+
+
+def grow_initializer(initializer: nn.Module, parameters: Dict[str, torch.Tensor]) -> None:
+    # Copies the parameters of a smaller initializer of the same family into
+    # the leading blocks of the parameters of initializer. LSTM weights and
+    # biases are copied per gate. Hidden units and layers that the smaller
+    # initializer does not have keep their initial weights.
+    gate_parameters = {
+        f'{name}.{parameter_name}' if name else parameter_name
+        for name, module in initializer.named_modules() if isinstance(module, nn.LSTM)
+        for parameter_name, _ in module.named_parameters()
+    }
+    with torch.no_grad():
+        for name, parameter in initializer.named_parameters():
+            if name not in parameters:
+                continue
+            source = parameters[name].to(parameter.device)
+            if name in gate_parameters:
+                blocks = zip(parameter.chunk(4, dim=0), source.chunk(4, dim=0))
+            else:
+                blocks = [(parameter, source)]
+            for target_block, source_block in blocks:
+                target_block[tuple(slice(0, size) for size in source_block.shape)].copy_(source_block)
+
+
+class InitializerCache:
+    """Content-addressed store of trained initializers.
+
+    An entry is the outcome of the initializer phase of a training job. It is
+    keyed by the initializer architecture and initial weights, its training
+    hyperparameters, the training windows and the seed of the phase, so any
+    model class whose initializer starts from the same state reuses it, and
+    reusing an entry gives the same initializer as training it. The number of
+    epochs is not part of the key: an entry trained for fewer epochs is
+    continued from its optimizer and random state, which also gives the same
+    initializer. Entries are grouped by family, the key without initial
+    weights and LSTM sizes. With warm_start, an initializer without an entry
+    starts from the largest smaller initializer of its family instead, which
+    changes the trained model.
+    """
+
+    def __init__(self, directory: pathlib.Path, warm_start: bool = False):
+        self.directory = directory
+        self.warm_start = warm_start
+
+    @staticmethod
+    def build_family(
+        initializer: nn.Module,
+        hyperparameters: Dict[str, Any],
+        data_hash: str,
+        seed: int
+    ) -> str:
+        description = dict(
+            architecture=describe_initializer_family(initializer),
+            hyperparameters=hyperparameters,
+            data=data_hash,
+            seed=seed
+        )
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def build_key(family: str, initializer: nn.Module) -> str:
+        # The module representation covers layer types, dimensions and dropout.
+        description = dict(
+            family=family,
+            architecture=repr(initializer),
+            parameters=hash_tensors(list(initializer.state_dict().values()))
+        )
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self, family: str, key: str, epochs: int) -> Tuple[Optional[Dict[str, Any]], int]:
+        # Entry with the most epochs up to epochs. Returns the entry and its epochs.
+        entries = self._list_entries(family, key)
+        for cached_epochs in sorted((e for e in entries if e <= epochs), reverse=True):
+            entry = self._read_entry(entries[cached_epochs])
+            if entry is not None:
+                return entry, cached_epochs
+        return None, 0
+
+    def find_smaller(self, family: str, initializer: nn.Module) -> Optional[Dict[str, Any]]:
+        # Entry of the family whose LSTMs are at most as large as those of
+        # initializer, the largest one trained for the most epochs.
+        sizes = describe_lstm_sizes(initializer)
+        candidates = []
+        for file_path in self._list_family(family):
+            entry = self._read_entry(file_path)
+            if entry is None or entry['lstm_sizes'] == sizes or len(entry['lstm_sizes']) != len(sizes):
+                continue
+            if all(
+                hidden_size <= target_hidden_size and num_layers <= target_num_layers
+                for (hidden_size, num_layers), (target_hidden_size, target_num_layers)
+                in zip(entry['lstm_sizes'], sizes)
+            ):
+                candidates.append(entry)
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda entry: (
+            sum(num_layers for _, num_layers in entry['lstm_sizes']),
+            sum(hidden_size for hidden_size, _ in entry['lstm_sizes']),
+            len(entry['losses'])
+        ))
+
+    def store(self, family: str, key: str, epochs: int, entry: Dict[str, Any]) -> pathlib.Path:
+        family_directory = self._get_family_directory(family)
+        family_directory.mkdir(parents=True, exist_ok=True)
+        file_path = family_directory.joinpath(f'{key}-{epochs:06d}.pt')
+        temporary_path = file_path.with_name(f'.{file_path.name}.{os.getpid()}.tmp')
+        torch.save(entry, temporary_path)
+        os.replace(temporary_path, file_path)
+        return file_path
+
+    def _get_family_directory(self, family: str) -> pathlib.Path:
+        return self.directory.joinpath(family[:2]).joinpath(family)
+
+    def _list_family(self, family: str) -> List[pathlib.Path]:
+        family_directory = self._get_family_directory(family)
+        if not family_directory.exists():
+            return []
+        return sorted(family_directory.glob('*.pt'))
+
+    def _list_entries(self, family: str, key: str) -> Dict[int, pathlib.Path]:
+        pattern = re.compile(rf'^{key}-(\d+)\.pt$')
+        entries = {}
+        for file_path in self._list_family(family):
+            match = pattern.match(file_path.name)
+            if match is not None:
+                entries[int(match.group(1))] = file_path
+        return entries
+
+    @staticmethod
+    def _read_entry(file_path: pathlib.Path) -> Optional[Dict[str, Any]]:
+        try:
+            return torch.load(file_path, map_location='cpu', weights_only=False)
+        except Exception as e:
+            print(f'Skipping unreadable initializer cache entry {file_path}: {e}')
+            return None
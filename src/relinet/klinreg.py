@@ -0,0 +1,481 @@
+import dataclasses
+import hashlib
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from deepsysid.models.base import DynamicIdentificationModel, DynamicIdentificationModelConfig
+from deepsysid.models.switching.klinreg import KLinearRegressionARXModel, KLinearRegressionARXModelConfig
+
+_worker_arrays: Dict[str, np.ndarray] = {}
+_worker_memory: List[shared_memory.SharedMemory] = []
+
+
+@dataclasses.dataclass
+class RestartResult:
+    restart_idx: int
+    error: float
+    parameters: Optional[np.ndarray]
+    n_iterations: int
+    # Hashes of all mode assignments the restart went through.
+    visited: List[bytes]
+    pruned: bool
+    # Whether the assignment stopped changing before max_iterations.
+    converged: bool
+
+
+def _hash_assignment(assignment: np.ndarray) -> bytes:
+    return hashlib.blake2b(assignment.astype(np.int8).tobytes(), digest_size=16).digest()
+
+
+def run_restart(
+    regressors: np.ndarray,
+    targets: np.ndarray,
+    n_modes: int,
+    restart_idx: int,
+    seed: int,
+    initialization_bound: float,
+    max_iterations: int,
+    known_assignments: Set[bytes]
+) -> RestartResult:
+    # One run of k-LinReg (Lauer, 2013) from random parameters. Every mode
+    # assignment determines the rest of the run, so a restart that reaches an
+    # assignment of a converged restart ends in the same assignment or, with
+    # fewer iterations left, in one with at least its error, and is pruned.
+    # known_assignments must therefore only contain assignments of restarts
+    # that converged or were pruned themselves, never of restarts that
+    # max_iterations cut short.
+    rng = np.random.default_rng(np.random.SeedSequence([seed, restart_idx]))
+    parameters = rng.uniform(
+        -initialization_bound, initialization_bound,
+        size=(n_modes, regressors.shape[1], targets.shape[1])
+    )
+
+    visited = []
+    assignment = None
+    converged = False
+    for iteration in range(max_iterations):
+        residuals = np.stack([
+            np.sum((targets - regressors @ parameters[mode]) ** 2, axis=1)
+            for mode in range(n_modes)
+        ])
+        new_assignment = np.argmin(residuals, axis=0)
+        if assignment is not None and np.array_equal(assignment, new_assignment):
+            converged = True
+            break
+        assignment = new_assignment
+
+        assignment_hash = _hash_assignment(assignment)
+        if assignment_hash in known_assignments:
+            return RestartResult(restart_idx, np.inf, None, iteration + 1, visited, pruned=True, converged=False)
+        visited.append(assignment_hash)
+
+        # Empty modes are reset to zero instead of keeping their random
+        # parameters, so the parameters only depend on the assignment.
+        for mode in range(n_modes):
+            mask = assignment == mode
+            if np.any(mask):
+                parameters[mode] = np.linalg.lstsq(regressors[mask], targets[mask], rcond=None)[0]
+            else:
+                parameters[mode] = 0.0
+
+    residuals = np.stack([
+        np.sum((targets - regressors @ parameters[mode]) ** 2, axis=1)
+        for mode in range(n_modes)
+    ])
+    error = float(np.mean(np.min(residuals, axis=0)))
+    return RestartResult(restart_idx, error, parameters, len(visited), visited, pruned=False, converged=converged)
+
+
+def _initialize_worker(specifications: Dict[str, Tuple[str, Tuple[int, ...]]]) -> None:
+    # Attach to the regressor matrices in shared memory without copying them.
+    for name, (memory_name, shape) in specifications.items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        _worker_memory.append(memory)
+        array = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+        array.flags.writeable = False
+        _worker_arrays[name] = array
+
+
+def _run_shared_restart(*args) -> RestartResult:
+    return run_restart(_worker_arrays['regressors'], _worker_arrays['targets'], *args)
+
+
+def fit_k_linear_regression(
+    regressors: np.ndarray,
+    targets: np.ndarray,
+    n_modes: int,
+    n_restarts: int,
+    seed: int = 0,
+    initialization_bound: float = 100.0,
+    max_iterations: int = 100,
+    restarts_per_round: int = 8,
+    n_workers: int = 0,
+    stop_without_improvement: bool = False
+) -> Tuple[RestartResult, int]:
+    # Runs the restarts in rounds of restarts_per_round on n_workers processes
+    # (in this process if 0). With stop_without_improvement, no further round
+    # is started once a round did not lower the best error. Restarts only
+    # prune against converged or pruned restarts of rounds that have
+    # finished, and a pruned restart cannot beat the restart it matched. The
+    # best restart (lowest error, then lowest index) therefore does not depend
+    # on the number of workers. Returns the best restart and the number of
+    # pruned restarts.
+    regressors = np.ascontiguousarray(regressors, dtype=np.float64)
+    targets = np.ascontiguousarray(targets, dtype=np.float64)
+    rounds = [
+        list(range(start, min(start + restarts_per_round, n_restarts)))
+        for start in range(0, n_restarts, restarts_per_round)
+    ]
+
+    def run_rounds(submit) -> Tuple[RestartResult, int]:
+        best: Optional[RestartResult] = None
+        known_assignments: Set[bytes] = set()
+        n_pruned = 0
+        for restart_indices in rounds:
+            results = submit(restart_indices, frozenset(known_assignments))
+            improved = False
+            for result in sorted(results, key=lambda result: result.restart_idx):
+                # A restart cut short by max_iterations could still have
+                # improved, so a later restart reaching one of its
+                # assignments with more iterations left is not pruned.
+                if result.converged or result.pruned:
+                    known_assignments.update(result.visited)
+                n_pruned += int(result.pruned)
+                if not result.pruned and (best is None or result.error < best.error):
+                    best = result
+                    improved = True
+            if stop_without_improvement and not improved:
+                break
+        return best, n_pruned
+
+    arguments = (seed, initialization_bound, max_iterations)
+    if n_workers == 0:
+        return run_rounds(lambda restart_indices, known: [
+            run_restart(regressors, targets, n_modes, restart_idx, *arguments, known)
+            for restart_idx in restart_indices
+        ])
+
+    memories = []
+    try:
+        specifications = {}
+        for name, array in (('regressors', regressors), ('targets', targets)):
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            memories.append(memory)
+            np.ndarray(array.shape, dtype=np.float64, buffer=memory.buf)[:] = array
+            specifications[name] = (memory.name, array.shape)
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize_worker,
+            initargs=(specifications,)
+        ) as executor:
+            return run_rounds(lambda restart_indices, known: list(executor.map(
+                _run_shared_restart,
+                *zip(*[(n_modes, restart_idx) + arguments + (known,) for restart_idx in restart_indices])
+            )))
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+
+def build_arx_regressors(
+    control: np.ndarray,
+    state: np.ndarray,
+    lag: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Regressor of step t: the lag previous states, the controls of the lag
+    # steps up to and including t, and a constant.
+    n_steps = state.shape[0] - lag
+    previous_states = np.stack([state[offset:offset + n_steps] for offset in range(lag)], axis=1)
+    controls = np.stack([control[offset + 1:offset + 1 + n_steps] for offset in range(lag)], axis=1)
+    regressors = np.concatenate((
+        previous_states.reshape(n_steps, -1),
+        controls.reshape(n_steps, -1),
+        np.ones((n_steps, 1))
+    ), axis=1)
+    return regressors, state[lag:]
+
+
+class NearestCentroidKLinearRegressionARXModelConfig(DynamicIdentificationModelConfig):
+    lag: int
+    n_modes: int
+    # Only the fixed number of restarts of deepsysid's use_max_restarts is
+    # supported.
+    use_max_restarts: bool = True
+    zero_probability_restarts: int = 100
+    stop_without_improvement: bool = False
+    initialization_bound: float = 100.0
+    max_iterations: int = 100
+    restarts_per_round: int = 8
+    n_workers: int = 0
+    seed: int = 0
+
+
+class NearestCentroidKLinearRegressionARXModel(DynamicIdentificationModel):
+    """Switched ARX model fitted by k-LinReg with restarts on a process pool.
+
+    This is not a drop-in replacement for deepsysid's
+    KLinearRegressionARXModel. The fit runs the same zero_probability_restarts
+    restarts as deepsysid with use_max_restarts, but for simulation the mode
+    of a step is the one whose mean training regressor is closest to the
+    current regressor. Its scores are therefore those of a different model.
+    With stop_without_improvement, no further round of restarts is started
+    once a round did not lower the best error.
+    """
+
+    CONFIG = NearestCentroidKLinearRegressionARXModelConfig
+
+    def __init__(self, config: NearestCentroidKLinearRegressionARXModelConfig):
+        super().__init__(config)
+        if not config.use_max_restarts:
+            raise ValueError(
+                'Only use_max_restarts is supported, set zero_probability_restarts to the number of restarts.'
+            )
+        self.config = config
+        self.lag = config.lag
+        self.n_modes = config.n_modes
+
+        self.control_mean: Optional[np.ndarray] = None
+        self.control_std: Optional[np.ndarray] = None
+        self.state_mean: Optional[np.ndarray] = None
+        self.state_std: Optional[np.ndarray] = None
+        self.parameters: Optional[np.ndarray] = None
+        self.mode_centroids: Optional[np.ndarray] = None
+
+    def train(self, control_seqs: List[np.ndarray], state_seqs: List[np.ndarray]) -> Dict[str, np.ndarray]:
+        control = np.vstack(control_seqs)
+        state = np.vstack(state_seqs)
+        self.control_mean, self.control_std = np.mean(control, axis=0), np.std(control, axis=0)
+        self.state_mean, self.state_std = np.mean(state, axis=0), np.std(state, axis=0)
+
+        regressors, targets = [], []
+        for control, state in zip(control_seqs, state_seqs):
+            sequence_regressors, sequence_targets = build_arx_regressors(
+                (control - self.control_mean) / self.control_std,
+                (state - self.state_mean) / self.state_std,
+                self.lag
+            )
+            regressors.append(sequence_regressors)
+            targets.append(sequence_targets)
+        regressors = np.vstack(regressors)
+        targets = np.vstack(targets)
+
+        best, n_pruned = fit_k_linear_regression(
+            regressors,
+            targets,
+            self.n_modes,
+            self.config.zero_probability_restarts,
+            seed=self.config.seed,
+            initialization_bound=self.config.initialization_bound,
+            max_iterations=self.config.max_iterations,
+            restarts_per_round=self.config.restarts_per_round,
+            n_workers=self.config.n_workers,
+            stop_without_improvement=self.config.stop_without_improvement
+        )
+        self.parameters = best.parameters
+        residuals = np.stack([
+            np.sum((targets - regressors @ self.parameters[mode]) ** 2, axis=1)
+            for mode in range(self.n_modes)
+        ])
+        assignment = np.argmin(residuals, axis=0)
+        self.mode_centroids = np.stack([
+            regressors[assignment == mode].mean(axis=0) if np.any(assignment == mode)
+            else np.full(regressors.shape[1], np.inf)
+            for mode in range(self.n_modes)
+        ])
+
+        return dict(
+            training_error=np.array([best.error]),
+            best_restart=np.array([best.restart_idx]),
+            pruned_restarts=np.array([n_pruned])
+        )
+
+    def simulate(
+        self,
+        initial_control: np.ndarray,
+        initial_state: np.ndarray,
+        control: np.ndarray
+    ) -> np.ndarray:
+        if self.parameters is None:
+            raise ValueError('Model has not been trained.')
+
+        control = (np.vstack((initial_control[-self.lag:], control)) - self.control_mean) / self.control_std
+        states = list((initial_state[-self.lag:] - self.state_mean) / self.state_std)
+        for time in range(control.shape[0] - self.lag):
+            regressor = np.concatenate((
+                np.concatenate(states[-self.lag:]),
+                control[time + 1:time + 1 + self.lag].reshape(-1),
+                np.ones(1)
+            ))
+            mode = int(np.argmin(np.sum((self.mode_centroids - regressor) ** 2, axis=1)))
+            states.append(regressor @ self.parameters[mode])
+
+        prediction = np.array(states[self.lag:])
+        return prediction * self.state_std + self.state_mean
+
+    def save(self, file_path: Tuple[str, ...]) -> None:
+        np.savez(
+            file_path[0],
+            control_mean=self.control_mean,
+            control_std=self.control_std,
+            state_mean=self.state_mean,
+            state_std=self.state_std,
+            parameters=self.parameters,
+            mode_centroids=self.mode_centroids
+        )
+
+    def load(self, file_path: Tuple[str, ...]) -> None:
+        with np.load(file_path[0]) as data:
+            self.control_mean = data['control_mean']
+            self.control_std = data['control_std']
+            self.state_mean = data['state_mean']
+            self.state_std = data['state_std']
+            self.parameters = data['parameters']
+            self.mode_centroids = data['mode_centroids']
+
+    def get_file_extension(self) -> Tuple[str, ...]:
+        return ('npz',)
+
+    def get_parameter_count(self) -> int:
+        return self.n_modes * (self.lag * (len(self.config.state_names) + len(self.config.control_names)) + 1) \
+            * len(self.config.state_names)
+
+
+def compute_simulation_error(
+    model: DynamicIdentificationModel,
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    lag: int
+) -> float:
+    # Mean squared error of simulating every training sequence from its first
+    # lag steps, with the states scaled to unit variance.
+    state_std = np.std(np.vstack(state_seqs), axis=0)
+    squared_errors = []
+    for control, state in zip(control_seqs, state_seqs):
+        if state.shape[0] <= lag:
+            continue
+        prediction = model.simulate(control[:lag], state[:lag], control[lag:])
+        squared_errors.append((((prediction - state[lag:]) / state_std) ** 2).reshape(-1))
+    return float(np.mean(np.concatenate(squared_errors)))
+
+
+def _train_deepsysid_restart(
+    config: KLinearRegressionARXModelConfig,
+    lengths: Sequence[int],
+    restart_idx: int,
+    seed: int
+) -> Tuple[int, float, KLinearRegressionARXModel]:
+    # One restart of deepsysid's k-LinReg on the sequences in shared memory.
+    # The global random state is seeded per restart, so the restart does not
+    # depend on the worker it runs on.
+    splits = np.cumsum(lengths)[:-1]
+    control_seqs = [np.array(control) for control in np.split(_worker_arrays['control'], splits)]
+    state_seqs = [np.array(state) for state in np.split(_worker_arrays['state'], splits)]
+    restart_seed = int(np.random.SeedSequence([seed, restart_idx]).generate_state(1)[0])
+    np.random.seed(restart_seed)
+    random.seed(restart_seed)
+
+    model = KLinearRegressionARXModel(config.copy(update=dict(use_max_restarts=True, zero_probability_restarts=1)))
+    model.train(control_seqs=control_seqs, state_seqs=state_seqs)
+    return restart_idx, compute_simulation_error(model, control_seqs, state_seqs, config.lag), model
+
+
+class ParallelKLinearRegressionARXModelConfig(KLinearRegressionARXModelConfig):
+    # Worker processes for the restarts, all cores if None and in this
+    # process if 0.
+    n_workers: Optional[int] = None
+    seed: int = 0
+
+
+class ParallelKLinearRegressionARXModel(KLinearRegressionARXModel):
+    """deepsysid's KLinearRegressionARXModel with its restarts on a process pool.
+
+    Each of the zero_probability_restarts restarts of use_max_restarts is a
+    run of deepsysid's k-LinReg with a single restart, seeded from seed and
+    the restart index. Workers attach to the training sequences in shared
+    memory. The restart whose model simulates the training sequences with the
+    lowest error is kept, the lowest index on ties, so the trained model only
+    depends on seed and not on n_workers. Simulation, saving and loading are
+    those of deepsysid's model.
+    """
+
+    CONFIG = ParallelKLinearRegressionARXModelConfig
+
+    def __init__(self, config: ParallelKLinearRegressionARXModelConfig):
+        super().__init__(config)
+        if not config.use_max_restarts:
+            raise ValueError(
+                'Only use_max_restarts is supported, set zero_probability_restarts to the number of restarts.'
+            )
+        self.parallel_config = config
+
+    def train(self, control_seqs: List[np.ndarray], state_seqs: List[np.ndarray]) -> Dict[str, np.ndarray]:
+        config = self.parallel_config
+        lengths = [control.shape[0] for control in control_seqs]
+        restart_config = KLinearRegressionARXModelConfig.parse_obj(
+            config.dict(exclude={'n_workers', 'seed'})
+        )
+        arrays = dict(
+            control=np.ascontiguousarray(np.vstack(control_seqs), dtype=np.float64),
+            state=np.ascontiguousarray(np.vstack(state_seqs), dtype=np.float64)
+        )
+        restart_indices = list(range(config.zero_probability_restarts))
+        n_workers = config.n_workers if config.n_workers is not None else os.cpu_count()
+
+        if n_workers == 0:
+            _worker_arrays.update(arrays)
+            try:
+                results = [
+                    _train_deepsysid_restart(restart_config, lengths, restart_idx, config.seed)
+                    for restart_idx in restart_indices
+                ]
+            finally:
+                for name in arrays:
+                    del _worker_arrays[name]
+        else:
+            memories = []
+            try:
+                specifications = {}
+                for name, array in arrays.items():
+                    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                    memories.append(memory)
+                    np.ndarray(array.shape, dtype=np.float64, buffer=memory.buf)[:] = array
+                    specifications[name] = (memory.name, array.shape)
+
+                with ProcessPoolExecutor(
+                    max_workers=min(n_workers, len(restart_indices)),
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_initialize_worker,
+                    initargs=(specifications,)
+                ) as executor:
+                    results = list(executor.map(
+                        _train_deepsysid_restart,
+                        [restart_config] * len(restart_indices),
+                        [lengths] * len(restart_indices),
+                        restart_indices,
+                        [config.seed] * len(restart_indices)
+                    ))
+            finally:
+                for memory in memories:
+                    memory.close()
+                    memory.unlink()
+
+        best_idx, best_error, best_model = min(results, key=lambda result: (result[1], result[0]))
+        # Take over the trained state of the best restart, keeping this
+        # model's configuration.
+        own_config = self.__dict__.get('config')
+        self.__dict__.update(best_model.__dict__)
+        if own_config is not None:
+            self.config = own_config
+        self.parallel_config = config
+        return dict(
+            training_simulation_error=np.array([best_error]),
+            best_restart=np.array([best_idx])
+        )
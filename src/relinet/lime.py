@@ -0,0 +1,360 @@
+import contextlib
+import copy
+import dataclasses
+import hashlib
+import multiprocessing
+import pathlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from deepsysid.explainability.base import Explanation
+from deepsysid.explainability.explainers.lime import LIMEExplainer
+from deepsysid.pipeline.configuration import ExperimentConfiguration, initialize_model
+from deepsysid.pipeline.data_io import build_explanation_result_file_name
+from deepsysid.pipeline.explaining import explain_model
+from deepsysid.pipeline.model_io import load_model
+
+from relinet.datasets import iterate_windows, load_split_sequences
+from relinet.explanations import ExplanationLayout, repack_explanation_file
+from relinet.lipschitz import LipschitzSettings, use_batched_lipschitz_metric
+from relinet.models import predict_batch, simulate_model
+
+LIME_EXPLAINER_CLASS = 'deepsysid.explainability.explainers.lime.LIMEExplainer'
+PARALLEL_LIME_EXPLAINER_CLASS = 'relinet.lime.ParallelLIMEExplainer'
+
+_context: Optional['LimeContext'] = None
+_worker_model = None
+_worker_explainer: Optional[LIMEExplainer] = None
+
+# Inputs (initial_control, initial_state, control) of one simulation.
+SimulationInput = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+@dataclasses.dataclass
+class LimeSettings:
+    # Seed of the global numpy generator, set once before the first explanation.
+    seed: int = 0
+    # Processes that fit the surrogates, in this process if 0.
+    n_workers: int = 0
+    # Windows per forward pass and per task of a worker.
+    batch_size: int = 16
+
+
+@dataclasses.dataclass
+class LimeContext:
+    configuration: ExperimentConfiguration
+    model_name: str
+    device_name: str
+    models_directory: pathlib.Path
+    settings: LimeSettings
+    # Windows (initial_control, initial_state, control) that are explained
+    # in batches before the first explanation is returned.
+    windows: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    # Pools of the explainers, shut down when the context ends.
+    executors: List[Executor] = dataclasses.field(default_factory=list)
+
+
+def hash_model_input(initial_control: np.ndarray, initial_state: np.ndarray, control: np.ndarray) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (initial_control, initial_state, control):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        digest.update(str(array.shape).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.digest()
+
+
+def record_simulations(
+    explainer: LIMEExplainer,
+    model,
+    initial_control: np.ndarray,
+    initial_state: np.ndarray,
+    control: np.ndarray
+) -> List[SimulationInput]:
+    # Runs deepsysid's explanation of one window with a copy of the model
+    # that records the inputs of its simulations and predicts zeros. The
+    # explanation draws the same samples from the global numpy generator as
+    # with the model, and leaves the generator in the same state.
+    inputs = []
+    n_states = initial_state.shape[-1]
+
+    def simulate(simulated_initial_control, simulated_initial_state, simulated_control):
+        inputs.append((
+            np.array(simulated_initial_control),
+            np.array(simulated_initial_state),
+            np.array(simulated_control)
+        ))
+        return np.zeros((simulated_control.shape[0], n_states))
+
+    recorder = copy.copy(model)
+    recorder.simulate = simulate
+    LIMEExplainer.explain(explainer, recorder, initial_control, initial_state, control)
+    return inputs
+
+
+def replay_simulations(
+    explainer: LIMEExplainer,
+    model,
+    initial_control: np.ndarray,
+    initial_state: np.ndarray,
+    control: np.ndarray,
+    random_state: Tuple[Any, ...],
+    inputs: List[SimulationInput],
+    predictions: np.ndarray
+) -> Explanation:
+    # Runs deepsysid's explanation of one window from the generator state of
+    # its recording, with the batched predictions of the recorded inputs. The
+    # surrogate is fitted by deepsysid's explainer. A simulation that does
+    # not match the recording is run on the model.
+    calls = iter(zip(inputs, predictions))
+
+    def simulate(simulated_initial_control, simulated_initial_state, simulated_control):
+        recorded = next(calls, None)
+        if recorded is not None and all(
+            np.array_equal(recorded_array, array) for recorded_array, array
+            in zip(recorded[0], (simulated_initial_control, simulated_initial_state, simulated_control))
+        ):
+            return recorded[1]
+        return simulate_model(model, simulated_initial_control, simulated_initial_state, simulated_control)
+
+    replayer = copy.copy(model)
+    replayer.simulate = simulate
+    np.random.set_state(random_state)
+    return LIMEExplainer.explain(explainer, replayer, initial_control, initial_state, control)
+
+
+def _initialize_worker(
+    configuration: ExperimentConfiguration,
+    model_name: str,
+    device_name: str,
+    models_directory: str,
+    explainer: LIMEExplainer
+) -> None:
+    global _worker_model, _worker_explainer
+    _worker_model = initialize_model(configuration, model_name, device_name)
+    load_model(_worker_model, str(pathlib.Path(models_directory).joinpath(model_name)), model_name)
+    _worker_explainer = explainer
+
+
+def _replay_window(
+    initial_control: np.ndarray,
+    initial_state: np.ndarray,
+    control: np.ndarray,
+    random_state: Tuple[Any, ...],
+    inputs: List[SimulationInput],
+    predictions: np.ndarray
+) -> Explanation:
+    return replay_simulations(
+        _worker_explainer, _worker_model, initial_control, initial_state, control, random_state, inputs, predictions
+    )
+
+
+class ParallelLIMEExplainer(LIMEExplainer):
+    """deepsysid's LIMEExplainer with batched simulations and parallel surrogate fits.
+
+    The windows of a batch are first explained with a model that only
+    records its inputs, drawing the samples from the global numpy generator
+    in the same order as deepsysid. All recorded inputs of a batch are then
+    predicted in one forward pass. Finally, every window is explained again
+    from the generator state of its recording with the batched predictions,
+    on the workers of explain_lime, so deepsysid's surrogate and its CV folds
+    are fitted on the pool. The test windows of explain_lime are explained in
+    one pass before the first explanation is returned, and are returned as
+    long as deepsysid asks for them in order.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.executor: Optional[Executor] = None
+        self.precomputed: List[Tuple[bytes, Explanation]] = []
+        self.next_precomputed = 0
+        self.started = False
+
+    def initialize(self, training_inputs, training_outputs) -> None:
+        super().initialize(training_inputs, training_outputs)
+        self.precomputed = []
+        self.next_precomputed = 0
+        self.started = False
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Workers only need the initialized explainer.
+        state = dict(self.__dict__)
+        state.update(executor=None, precomputed=[], next_precomputed=0)
+        return state
+
+    def explain(
+        self,
+        model,
+        initial_control: np.ndarray,
+        initial_state: np.ndarray,
+        control: np.ndarray
+    ) -> Explanation:
+        if not self.started:
+            self.started = True
+            if _context is not None:
+                self.precomputed = list(zip(
+                    [
+                        hash_model_input(*(array[idx] for array in _context.windows))
+                        for idx in range(_context.windows[0].shape[0])
+                    ],
+                    self.explain_batch(model, *_context.windows)
+                ))
+
+        if self.next_precomputed < len(self.precomputed):
+            key, explanation = self.precomputed[self.next_precomputed]
+            if key == hash_model_input(initial_control, initial_state, control):
+                self.next_precomputed += 1
+                return explanation
+        return self.explain_batch(
+            model, initial_control[np.newaxis], initial_state[np.newaxis], control[np.newaxis]
+        )[0]
+
+    def explain_batch(
+        self,
+        model,
+        initial_control: np.ndarray,
+        initial_state: np.ndarray,
+        control: np.ndarray
+    ) -> List[Explanation]:
+        # Same explanations as explaining the windows one after another.
+        batch_size = 16 if _context is None else _context.settings.batch_size
+        explanations = []
+        for start in range(0, initial_control.shape[0], batch_size):
+            explanations.extend(self._explain_batch(
+                model,
+                initial_control[start:start + batch_size],
+                initial_state[start:start + batch_size],
+                control[start:start + batch_size]
+            ))
+        return explanations
+
+    def _explain_batch(
+        self,
+        model,
+        initial_control: np.ndarray,
+        initial_state: np.ndarray,
+        control: np.ndarray
+    ) -> List[Explanation]:
+        random_states, inputs = [], []
+        for idx in range(initial_control.shape[0]):
+            random_states.append(np.random.get_state())
+            inputs.append(record_simulations(self, model, initial_control[idx], initial_state[idx], control[idx]))
+        final_state = np.random.get_state()
+
+        flat_inputs = [simulation_input for window_inputs in inputs for simulation_input in window_inputs]
+        flat_predictions = predict_batch(model, *(
+            np.stack([simulation_input[idx] for simulation_input in flat_inputs]) for idx in range(3)
+        )) if len(flat_inputs) > 0 else np.zeros((0,))
+        splits = np.cumsum([len(window_inputs) for window_inputs in inputs])[:-1]
+        predictions = np.split(flat_predictions, splits)
+
+        arguments = (list(initial_control), list(initial_state), list(control), random_states, inputs, predictions)
+        if _context is None or _context.settings.n_workers == 0:
+            explanations = [
+                replay_simulations(self, model, *(argument[idx] for argument in arguments))
+                for idx in range(initial_control.shape[0])
+            ]
+        else:
+            explanations = self._replay_on_pool(*arguments)
+        np.random.set_state(final_state)
+        return explanations
+
+    def _replay_on_pool(self, *arguments: List[Any]) -> List[Explanation]:
+        if self.executor is None:
+            # Workers load the explained model and receive the initialized explainer.
+            self.executor = ProcessPoolExecutor(
+                max_workers=_context.settings.n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_initialize_worker,
+                initargs=(
+                    _context.configuration,
+                    _context.model_name,
+                    _context.device_name,
+                    str(_context.models_directory),
+                    self
+                )
+            )
+            _context.executors.append(self.executor)
+        # One window per task, so the surrogate fits of a batch spread over
+        # all workers.
+        return list(self.executor.map(_replay_window, *arguments))
+
+
+def use_parallel_lime_explainer(configuration: ExperimentConfiguration) -> ExperimentConfiguration:
+    # Copy of the configuration that runs ParallelLIMEExplainer in place of
+    # deepsysid's LIMEExplainer.
+    configuration = configuration.copy(deep=True)
+    for explainer in (configuration.explainers or {}).values():
+        if explainer.explainer_class == LIME_EXPLAINER_CLASS:
+            explainer.explainer_class = PARALLEL_LIME_EXPLAINER_CLASS
+    return configuration
+
+
+@contextlib.contextmanager
+def lime_context(context: LimeContext) -> Iterator[None]:
+    global _context
+    _context = context
+    try:
+        yield
+    finally:
+        _context = None
+        for executor in context.executors:
+            executor.shutdown()
+
+
+def explain_lime(
+    configuration: ExperimentConfiguration,
+    model_name: str,
+    device_name: str,
+    mode: str,
+    dataset_directory: pathlib.Path,
+    result_directory: pathlib.Path,
+    models_directory: pathlib.Path,
+    settings: LimeSettings,
+    layout: Optional[ExplanationLayout] = None,
+    lipschitz: Optional[LipschitzSettings] = None
+) -> pathlib.Path:
+    # Runs deepsysid's explanation of the model, including all configured
+    # explanation metrics, with the simulations of LIME batched and its
+    # surrogates fitted on the process pool. The global numpy generator is
+    # seeded once, and the non-overlapping test windows are explained up front.
+    control_seqs, state_seqs = load_split_sequences(
+        dataset_directory, mode, configuration.control_names, configuration.state_names
+    )
+    batches = list(iterate_windows(
+        control_seqs,
+        state_seqs,
+        configuration.window_size,
+        configuration.horizon_size,
+        configuration.window_size + configuration.horizon_size,
+        batch_size=1024
+    ))
+    windows = tuple(np.concatenate([batch[idx] for batch in batches]) for idx in range(3))
+
+    if lipschitz is not None:
+        configuration = use_batched_lipschitz_metric(configuration, lipschitz)
+    np.random.seed(settings.seed)
+    with lime_context(LimeContext(
+        configuration=configuration,
+        model_name=model_name,
+        device_name=device_name,
+        models_directory=models_directory,
+        settings=settings,
+        windows=windows
+    )):
+        explain_model(
+            model_name=model_name,
+            device_name=device_name,
+            mode=mode,
+            configuration=use_parallel_lime_explainer(configuration),
+            dataset_directory=str(dataset_directory),
+            result_directory=str(result_directory),
+            models_directory=str(models_directory)
+        )
+
+    file_path = result_directory.joinpath(model_name).joinpath(build_explanation_result_file_name(
+        mode, configuration.window_size, configuration.horizon_size, 'hdf5'
+    ))
+    if layout is not None:
+        repack_explanation_file(file_path, layout)
+    return file_path
@@ -0,0 +1,293 @@
+import dataclasses
+import pathlib
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+from deepsysid.explainability.base import (
+    BaseExplainer,
+    Explanation,
+    ExplanationMetric,
+    ExplanationMetricConfig,
+    ModelInput
+)
+from deepsysid.explainability.explainers.switching import SwitchingLSTMExplainer
+from deepsysid.pipeline.configuration import ExperimentConfiguration
+
+from relinet.models import is_switching_model
+
+LIPSCHITZ_METRIC_NAME = 'lipschitz'
+LIPSCHITZ_METRIC_CLASS = 'deepsysid.explainability.metrics.LipschitzEstimateMetric'
+BATCHED_LIPSCHITZ_METRIC_CLASS = 'relinet.lipschitz.BatchedLipschitzEstimateMetric'
+WEIGHT_DATASETS = [
+    'weights_initial_control',
+    'weights_initial_state',
+    'weights_control'
+]
+
+# Explains a batch of windows (initial_control, initial_state, control, window_indices)
+# and returns the arrays of explanations.EXPLANATION_DATASETS.
+BatchExplainer = Callable[[np.ndarray, np.ndarray, np.ndarray, np.ndarray], Dict[str, np.ndarray]]
+
+
+@dataclasses.dataclass
+class LipschitzSettings:
+    n_disturbances: int
+    control_error_std: np.ndarray
+    state_error_std: np.ndarray
+    seed: int = 0
+    # Number of disturbances evaluated per explainer call, all at once if None.
+    chunk_size: Optional[int] = None
+
+    @classmethod
+    def from_parameters(
+        cls,
+        parameters: Dict,
+        seed: int = 0,
+        chunk_size: Optional[int] = None
+    ) -> 'LipschitzSettings':
+        # Reads the parameters of LipschitzEstimateMetric in the gridsearch template.
+        return cls(
+            n_disturbances=parameters['n_disturbances'],
+            control_error_std=np.array(parameters['control_error_std'], dtype=np.float64),
+            state_error_std=np.array(parameters['state_error_std'], dtype=np.float64),
+            seed=seed,
+            chunk_size=chunk_size
+        )
+
+    def fit_to(self, control_dim: int, state_dim: int) -> 'LipschitzSettings':
+        # Standard deviations are paired with the channels in order, as in
+        # deepsysid's LipschitzEstimateMetric: channels without a value are
+        # not disturbed and surplus values are unused. The ship configuration,
+        # e.g., has 3 values for 4 controls and 8 values for 7 states.
+        if self.chunk_size is not None and self.chunk_size < 1:
+            raise ValueError(f'Chunk size has to be positive, got {self.chunk_size}.')
+        return dataclasses.replace(
+            self,
+            control_error_std=_pair_with_channels(self.control_error_std, control_dim),
+            state_error_std=_pair_with_channels(self.state_error_std, state_dim)
+        )
+
+
+def _pair_with_channels(error_std: np.ndarray, dim: int) -> np.ndarray:
+    paired = np.zeros(dim, dtype=np.float64)
+    n_paired = min(dim, error_std.size)
+    paired[:n_paired] = error_std[:n_paired]
+    return paired
+
+
+def _flatten(arrays: Sequence[np.ndarray], n_leading_axes: int) -> np.ndarray:
+    return np.concatenate(
+        [array.reshape(array.shape[:n_leading_axes] + (-1,)) for array in arrays],
+        axis=-1
+    )
+
+
+def estimate_lipschitz(
+    explain_batch: BatchExplainer,
+    initial_control: np.ndarray,
+    initial_state: np.ndarray,
+    control: np.ndarray,
+    explanations: Dict[str, np.ndarray],
+    window_indices: np.ndarray,
+    settings: LipschitzSettings
+) -> np.ndarray:
+    # Largest ratio ||w(x') - w(x)|| / ||x' - x|| over Gaussian disturbances x'
+    # of every window. All disturbed copies of a chunk of disturbances are
+    # explained in one call and reduced into the running maximum, so only one
+    # chunk of disturbed explanations is held in memory.
+    n_windows = initial_control.shape[0]
+    n_disturbances = settings.n_disturbances
+    chunk_size = n_disturbances if settings.chunk_size is None else settings.chunk_size
+
+    # Every window draws all its disturbances from its own seed, so estimates
+    # do not depend on the batch or chunk size.
+    disturbances = []
+    for window_idx in window_indices:
+        rng = np.random.default_rng(np.random.SeedSequence([settings.seed, int(window_idx)]))
+        disturbances.append((
+            rng.normal(size=(n_disturbances,) + initial_control.shape[1:]) * settings.control_error_std,
+            rng.normal(size=(n_disturbances,) + initial_state.shape[1:]) * settings.state_error_std,
+            rng.normal(size=(n_disturbances,) + control.shape[1:]) * settings.control_error_std
+        ))
+    disturbances = [np.stack([disturbance[idx] for disturbance in disturbances]) for idx in range(3)]
+    inputs = (initial_control, initial_state, control)
+    weights = _flatten([explanations[name] for name in WEIGHT_DATASETS], 1)
+
+    estimates = np.zeros(n_windows, dtype=np.float64)
+    for start in range(0, n_disturbances, chunk_size):
+        n_chunk = min(chunk_size, n_disturbances - start)
+        chunk = [disturbance[:, start:start + n_chunk] for disturbance in disturbances]
+        disturbed_inputs = [
+            (array[:, np.newaxis] + disturbance).reshape((n_windows * n_chunk,) + array.shape[1:])
+            for array, disturbance in zip(inputs, chunk)
+        ]
+        disturbed_explanations = explain_batch(*disturbed_inputs, np.repeat(window_indices, n_chunk))
+
+        disturbed_weights = _flatten([disturbed_explanations[name] for name in WEIGHT_DATASETS], 1)
+        weight_distance = np.linalg.norm(
+            disturbed_weights.reshape(n_windows, n_chunk, -1) - weights[:, np.newaxis], axis=-1
+        )
+        input_distance = np.linalg.norm(_flatten(chunk, 2), axis=-1)
+        np.maximum(estimates, np.max(weight_distance / input_distance, axis=1), out=estimates)
+
+    return estimates
+
+
+def _stack_explanations(explanations: Sequence[Explanation]) -> Dict[str, np.ndarray]:
+    return dict(
+        weights_initial_control=np.stack([explanation.weights_initial_control for explanation in explanations]),
+        weights_initial_state=np.stack([explanation.weights_initial_state for explanation in explanations]),
+        weights_control=np.stack([explanation.weights_control for explanation in explanations]),
+        intercepts=np.stack([explanation.intercept for explanation in explanations])
+    )
+
+
+def build_batch_explainer(
+    model,
+    explainer: BaseExplainer,
+    reference: ModelInput,
+    tolerance: float
+) -> BatchExplainer:
+    # Explains a batch of windows with one call per window, or with one call
+    # of explain_batch if the explainer has it. For the switching explainer,
+    # the closed-form explanation of the whole batch is used instead if it
+    # matches the explainer on the reference window.
+    def explain_each(initial_control, initial_state, control, window_indices):
+        return _stack_explanations([
+            explainer.explain(model, initial_control[idx], initial_state[idx], control[idx])
+            for idx in range(initial_control.shape[0])
+        ])
+
+    if hasattr(explainer, 'explain_batch'):
+        return lambda initial_control, initial_state, control, window_indices: _stack_explanations(
+            explainer.explain_batch(model, initial_control, initial_state, control)
+        )
+    if not isinstance(explainer, SwitchingLSTMExplainer) or not is_switching_model(model):
+        return explain_each
+
+    # closedform imports this module.
+    from relinet.closedform import compute_closed_form_explanations
+
+    def explain_closed_form(initial_control, initial_state, control, window_indices):
+        return compute_closed_form_explanations(model, initial_control, initial_state, control)
+
+    reference_inputs = (
+        reference.initial_control[np.newaxis],
+        reference.initial_state[np.newaxis],
+        reference.control[np.newaxis],
+        np.zeros(1, dtype=np.int64)
+    )
+    expected = explain_each(*reference_inputs)
+    actual = explain_closed_form(*reference_inputs)
+    for name in WEIGHT_DATASETS + ['intercepts']:
+        scale = max(float(np.max(np.abs(expected[name]), initial=0.0)), 1.0)
+        if not np.allclose(actual[name], expected[name], rtol=0.0, atol=tolerance * scale):
+            print(
+                f'Closed-form {name} differs from {type(explainer).__name__}, '
+                f'explaining one disturbed window at a time.'
+            )
+            return explain_each
+    return explain_closed_form
+
+
+def use_batched_lipschitz_metric(
+    configuration: ExperimentConfiguration,
+    settings: LipschitzSettings
+) -> ExperimentConfiguration:
+    # Copy of the configuration that runs BatchedLipschitzEstimateMetric in
+    # place of deepsysid's LipschitzEstimateMetric, seeded from settings and
+    # with its chunk size.
+    configuration = configuration.copy(deep=True)
+    for metric in (configuration.explanation_metrics or {}).values():
+        if metric.metric_class == LIPSCHITZ_METRIC_CLASS:
+            metric.metric_class = BATCHED_LIPSCHITZ_METRIC_CLASS
+            metric.parameters = dict(metric.parameters, seed=settings.seed, chunk_size=settings.chunk_size)
+    return configuration
+
+
+class BatchedLipschitzEstimateMetricConfig(ExplanationMetricConfig):
+    n_disturbances: int
+    control_error_std: List[float]
+    state_error_std: List[float]
+    seed: int = 0
+    chunk_size: Optional[int] = None
+    batch_size: int = 256
+    # Largest deviation of the closed-form explanation from the switching
+    # explainer, relative to the largest weight.
+    tolerance: float = 1e-4
+
+
+class BatchedLipschitzEstimateMetric(ExplanationMetric):
+    """LipschitzEstimateMetric of deepsysid on batches of windows.
+
+    Takes the parameters of deepsysid's metric and returns the scores and
+    metadata in its layout. All disturbances of a batch of windows are drawn
+    at once. With the switching explainer, all disturbed copies of a batch
+    are explained in one forward pass of the closed-form explanation, after
+    checking that it matches the explainer on the first window. Explainers
+    with an explain_batch method, e.g. relinet.lime.ParallelLIMEExplainer,
+    receive all disturbed copies of a batch in one call. Other explainers are
+    called once per disturbed window.
+    """
+
+    CONFIG = BatchedLipschitzEstimateMetricConfig
+
+    def __init__(self, config: BatchedLipschitzEstimateMetricConfig):
+        super().__init__(config)
+        self.settings = LipschitzSettings(
+            n_disturbances=config.n_disturbances,
+            control_error_std=np.array(config.control_error_std, dtype=np.float64),
+            state_error_std=np.array(config.state_error_std, dtype=np.float64),
+            seed=config.seed,
+            chunk_size=config.chunk_size
+        )
+        self.batch_size = config.batch_size
+        self.tolerance = config.tolerance
+
+    def measure(
+        self,
+        model,
+        explainer: BaseExplainer,
+        model_inputs: List[ModelInput]
+    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        if len(model_inputs) == 0:
+            return np.zeros(0), dict(largest_lipschitz_estimate=np.array([np.nan]))
+
+        settings = self.settings.fit_to(
+            model_inputs[0].initial_control.shape[1], model_inputs[0].initial_state.shape[1]
+        )
+        explain_batch = build_batch_explainer(model, explainer, model_inputs[0], self.tolerance)
+        scores = []
+        for start in range(0, len(model_inputs), self.batch_size):
+            batch = model_inputs[start:start + self.batch_size]
+            initial_control = np.stack([model_input.initial_control for model_input in batch])
+            initial_state = np.stack([model_input.initial_state for model_input in batch])
+            control = np.stack([model_input.control for model_input in batch])
+            window_indices = np.arange(start, start + len(batch))
+            explanations = explain_batch(initial_control, initial_state, control, window_indices)
+            scores.append(estimate_lipschitz(
+                explain_batch, initial_control, initial_state, control,
+                explanations, window_indices, settings
+            ))
+
+        scores = np.concatenate(scores)
+        return scores, dict(largest_lipschitz_estimate=np.array([np.max(scores)]))
+
+
+def write_lipschitz_scores(
+    file_path: pathlib.Path,
+    explainer_name: str,
+    scores: np.ndarray
+) -> None:
+    # Stored in the layout of deepsysid's LipschitzEstimateMetric, which is read
+    # by summarize_explanation_scores.
+    with h5py.File(file_path, mode='a') as f:
+        if LIPSCHITZ_METRIC_NAME in f and explainer_name in f[LIPSCHITZ_METRIC_NAME]:
+            del f[LIPSCHITZ_METRIC_NAME][explainer_name]
+        group = f.require_group(LIPSCHITZ_METRIC_NAME).create_group(explainer_name)
+        group.create_dataset('score', data=scores)
+        group.create_group('metadata').create_dataset(
+            'largest_lipschitz_estimate',
+            data=np.array([np.max(scores) if scores.size > 0 else np.nan])
+        )
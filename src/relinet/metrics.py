@@ -0,0 +1,163 @@
+import json
+import pathlib
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from relinet.statistics import bootstrap_confidence_intervals
+from relinet.testing import iterate_test_predictions
+
+HORIZON_METRIC_NAMES = ('rmse', 'nrmse', 'cumulative_rmse', 'cumulative_nrmse')
+
+
+class HorizonScoreAccumulator:
+    # Sufficient statistics per predicted step and state, accumulated batch by
+    # batch: the sum of squared errors and the running mean and sum of squared
+    # deviations of the true states, merged with Chan's parallel update.
+    # NRMSE is normalized by the standard deviation of the true states.
+    def __init__(self, horizon_size: int, state_dim: int):
+        self.n_windows = 0
+        self._squared_error = np.zeros((horizon_size, state_dim))
+        self._state_mean = np.zeros((horizon_size, state_dim))
+        self._state_m2 = np.zeros((horizon_size, state_dim))
+
+    def update(self, true_state: np.ndarray, predicted_state: np.ndarray) -> None:
+        n_new = true_state.shape[0]
+        if n_new == 0:
+            return
+
+        batch_mean = np.mean(true_state, axis=0)
+        self._merge(
+            n_new,
+            np.sum((predicted_state - true_state) ** 2, axis=0),
+            batch_mean,
+            np.sum((true_state - batch_mean) ** 2, axis=0)
+        )
+
+    def merge(self, other: 'HorizonScoreAccumulator') -> None:
+        if other.n_windows > 0:
+            self._merge(other.n_windows, other._squared_error, other._state_mean, other._state_m2)
+
+    def _merge(self, n_new: int, squared_error: np.ndarray, mean: np.ndarray, m2: np.ndarray) -> None:
+        total = self.n_windows + n_new
+        delta = mean - self._state_mean
+        self._state_mean += delta * n_new / total
+        self._state_m2 += m2 + delta ** 2 * self.n_windows * n_new / total
+        self._squared_error += squared_error
+        self.n_windows = total
+
+    def _cumulative_state_std(self) -> np.ndarray:
+        # Standard deviation of the true states over the first h steps for
+        # every h, merging the statistics of the steps one after another.
+        std = np.zeros_like(self._state_mean)
+        mean = np.zeros(self._state_mean.shape[1])
+        m2 = np.zeros(self._state_mean.shape[1])
+        for step in range(self._state_mean.shape[0]):
+            count = step * self.n_windows
+            delta = self._state_mean[step] - mean
+            mean = mean + delta * self.n_windows / (count + self.n_windows)
+            m2 = m2 + self._state_m2[step] + delta ** 2 * count * self.n_windows / (count + self.n_windows)
+            std[step] = np.sqrt(m2 / (count + self.n_windows))
+        return std
+
+    def horizon_curves(self) -> Dict[str, np.ndarray]:
+        # Arrays (horizon, state) of RMSE and NRMSE at every predicted step,
+        # and over the first h steps as in the evaluation of deepsysid. The
+        # per-step NRMSE is normalized by the standard deviation over all steps.
+        if self.n_windows == 0:
+            raise ValueError('No predictions have been accumulated.')
+
+        steps = np.arange(1, self._squared_error.shape[0] + 1)[:, np.newaxis]
+        rmse = np.sqrt(self._squared_error / self.n_windows)
+        cumulative_rmse = np.sqrt(np.cumsum(self._squared_error, axis=0) / (self.n_windows * steps))
+        cumulative_std = self._cumulative_state_std()
+        return dict(
+            rmse=rmse,
+            nrmse=rmse / cumulative_std[-1],
+            cumulative_rmse=cumulative_rmse,
+            cumulative_nrmse=cumulative_rmse / cumulative_std
+        )
+
+    def scores_per_horizon(self) -> Dict[str, Dict[str, List[float]]]:
+        curves = self.horizon_curves()
+        return {
+            str(horizon + 1): dict(
+                rmse=curves['cumulative_rmse'][horizon].tolist(),
+                nrmse=curves['cumulative_nrmse'][horizon].tolist()
+            )
+            for horizon in range(curves['rmse'].shape[0])
+        }
+
+
+def build_horizon_metric_file_name(mode: str) -> str:
+    return f'horizon-metrics-{mode}.json'
+
+
+def compute_horizon_metrics(
+    prediction_path: pathlib.Path,
+    horizon_size: int,
+    state_dim: int,
+    batch_size: int = 256
+) -> HorizonScoreAccumulator:
+    # One pass over the predictions of a deepsysid test run, keeping only the
+    # statistics of each batch. The windows are those of the test run, so the
+    # cumulative curves match its scores_per_horizon.
+    scores = HorizonScoreAccumulator(horizon_size, state_dim)
+    for true_state, predicted_state in iterate_test_predictions(prediction_path, batch_size):
+        scores.update(true_state, predicted_state)
+    return scores
+
+
+def write_horizon_metrics(scores: HorizonScoreAccumulator, result_path: pathlib.Path) -> None:
+    with result_path.open(mode='w') as f:
+        json.dump(dict(
+            n_windows=scores.n_windows,
+            **{name: curve.tolist() for name, curve in scores.horizon_curves().items()}
+        ), f)
+
+
+def read_horizon_metrics(result_path: pathlib.Path) -> Dict[str, np.ndarray]:
+    with result_path.open(mode='r') as f:
+        metrics = json.load(f)
+    return {name: np.array(metrics[name]) for name in HORIZON_METRIC_NAMES}
+
+
+def summarize_horizon_metrics(
+    result_directory: pathlib.Path,
+    models: Sequence[str],
+    n_runs: int,
+    mode: str = 'test',
+    n_resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0
+) -> pd.DataFrame:
+    # Mean over runs and bootstrap confidence interval of every metric,
+    # averaged over states, at every horizon step. Runs without a metric file
+    # are left out.
+    rows = []
+    for model in sorted(models):
+        runs: Dict[str, List[np.ndarray]] = {name: [] for name in HORIZON_METRIC_NAMES}
+        for run_idx in range(n_runs):
+            run_directory = result_directory if run_idx == 0 else result_directory.joinpath(f'repeat-{run_idx}')
+            result_path = run_directory.joinpath(model).joinpath(build_horizon_metric_file_name(mode))
+            if not result_path.exists():
+                continue
+            for name, curve in read_horizon_metrics(result_path).items():
+                runs[name].append(np.mean(curve, axis=1))
+        if len(runs['rmse']) == 0:
+            continue
+
+        for name in HORIZON_METRIC_NAMES:
+            values = np.stack(runs[name])
+            low, high = bootstrap_confidence_intervals(values, n_resamples, confidence, seed)
+            for horizon in range(values.shape[1]):
+                rows.append([
+                    model, name, horizon + 1, float(np.mean(values[:, horizon])),
+                    float(low[horizon]), float(high[horizon]), values.shape[0]
+                ])
+
+    return pd.DataFrame(
+        data=rows,
+        columns=['model', 'metric', 'horizon', 'mean', 'ci-lo', 'ci-hi', 'count']
+    )
@@ -0,0 +1,176 @@
+import dataclasses
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from deepsysid.models.recurrent import LSTMInitModel
+from deepsysid.models.switching.switchrnn import StableSwitchingLSTMModel, UnconstrainedSwitchingLSTMModel
+from torch import nn
+
+# Recurrent models composed of an LSTM initializer, which encodes the initial
+# window into the hidden state, and a predictor. The switching predictor
+# additionally receives the previous state and returns the LPV matrices.
+SWITCHING_MODEL_CLASSES = (UnconstrainedSwitchingLSTMModel, StableSwitchingLSTMModel)
+RECURRENT_MODEL_CLASSES = (LSTMInitModel,) + SWITCHING_MODEL_CLASSES
+
+
+def is_recurrent_model(model) -> bool:
+    return isinstance(model, RECURRENT_MODEL_CLASSES)
+
+
+def is_switching_model(model) -> bool:
+    return isinstance(model, SWITCHING_MODEL_CLASSES)
+
+
+@dataclasses.dataclass
+class Normalization:
+    control_mean: np.ndarray
+    control_std: np.ndarray
+    state_mean: np.ndarray
+    state_std: np.ndarray
+
+    @classmethod
+    def from_sequences(
+        cls,
+        control_seqs: Sequence[np.ndarray],
+        state_seqs: Sequence[np.ndarray]
+    ) -> 'Normalization':
+        control = np.vstack(control_seqs)
+        state = np.vstack(state_seqs)
+        return cls(
+            control_mean=np.mean(control, axis=0),
+            control_std=np.std(control, axis=0),
+            state_mean=np.mean(state, axis=0),
+            state_std=np.std(state, axis=0)
+        )
+
+    @classmethod
+    def from_model(cls, model) -> 'Normalization':
+        return cls(
+            control_mean=model.control_mean,
+            control_std=model.control_std,
+            state_mean=model.state_mean,
+            state_std=model.state_std
+        )
+
+    def apply_to(self, model) -> None:
+        model.control_mean = self.control_mean
+        model.control_std = self.control_std
+        model.state_mean = self.state_mean
+        model.state_std = self.state_std
+
+    def normalize_control(self, control: np.ndarray) -> np.ndarray:
+        return (control - self.control_mean) / self.control_std
+
+    def normalize_state(self, state: np.ndarray) -> np.ndarray:
+        return (state - self.state_mean) / self.state_std
+
+    def denormalize_state(self, state: np.ndarray) -> np.ndarray:
+        return state * self.state_std + self.state_mean
+
+
+def build_initializer_windows(
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    sequence_length: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # One-step-ahead training pairs for the initializer: input is the next
+    # control and the current state, target is the next state.
+    x, y = [], []
+    for control, state in zip(control_seqs, state_seqs):
+        n_samples = (control.shape[0] - sequence_length - 1) // sequence_length
+        for idx in range(n_samples):
+            time = idx * sequence_length
+            x.append(np.hstack((
+                control[time + 1:time + 1 + sequence_length],
+                state[time:time + sequence_length]
+            )))
+            y.append(state[time + 1:time + 1 + sequence_length])
+    return np.array(x), np.array(y)
+
+
+def build_initial_window(
+    initial_control: np.ndarray,
+    initial_state: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Input of the initializer and the last known state of an initial window.
+    # Works on single windows (time, channel) and batches (batch, time, channel).
+    x0 = np.concatenate((initial_control[..., 1:, :], initial_state[..., :-1, :]), axis=-1)
+    y0 = initial_state[..., -1, :]
+    return x0, y0
+
+
+def build_predictor_windows(
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    sequence_length: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Training windows for the predictor with an initial window of
+    # sequence_length steps followed by sequence_length predicted steps,
+    # laid out as in build_initial_window.
+    x0, y0, x, y = [], [], [], []
+    for control, state in zip(control_seqs, state_seqs):
+        for time in range(0, control.shape[0] - 2 * sequence_length + 1, sequence_length):
+            middle = time + sequence_length
+            window_x0, window_y0 = build_initial_window(control[time:middle], state[time:middle])
+            x0.append(window_x0)
+            y0.append(window_y0)
+            x.append(control[middle:middle + sequence_length])
+            y.append(state[middle:middle + sequence_length])
+    return np.array(x0), np.array(y0), np.array(x), np.array(y)
+
+
+def predict_normalized(
+    initializer: nn.Module,
+    predictor: nn.Module,
+    switching: bool,
+    x0: torch.Tensor,
+    x: torch.Tensor,
+    y0: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    _, hx = initializer(x0, return_state=True)
+    if switching:
+        return predictor(x, previous_output=y0, hx=hx).outputs
+    return predictor(x, hx=hx)
+
+
+def simulate_model(model, initial_control: np.ndarray, initial_state: np.ndarray, control: np.ndarray) -> np.ndarray:
+    prediction = model.simulate(initial_control, initial_state, control)
+    if isinstance(prediction, tuple):
+        prediction = prediction[0]
+    return prediction
+
+
+def predict_batch(
+    model,
+    initial_control: np.ndarray,
+    initial_state: np.ndarray,
+    control: np.ndarray
+) -> np.ndarray:
+    # Predicted states (batch, horizon, state) for a batch of windows. Recurrent
+    # models predict the batch in one forward pass, all other models window by window.
+    if not is_recurrent_model(model):
+        return np.stack([
+            simulate_model(model, initial_control[idx], initial_state[idx], control[idx])
+            for idx in range(initial_control.shape[0])
+        ])
+
+    normalization = Normalization.from_model(model)
+    x0, y0 = build_initial_window(
+        normalization.normalize_control(initial_control),
+        normalization.normalize_state(initial_state)
+    )
+    x = normalization.normalize_control(control)
+
+    model.initializer.eval()
+    model.predictor.eval()
+    with torch.no_grad():
+        prediction = predict_normalized(
+            model.initializer,
+            model.predictor,
+            is_switching_model(model),
+            torch.from_numpy(x0).float().to(model.device),
+            torch.from_numpy(x).float().to(model.device),
+            torch.from_numpy(y0).float().to(model.device)
+        )
+    return normalization.denormalize_state(prediction.cpu().numpy().astype(np.float64))
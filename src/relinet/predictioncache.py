@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import pathlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from relinet.utils import compute_file_hash
+
+PREDICTION_CACHE_DIRECTORY_NAME = 'prediction-cache'
+
+
+def get_prediction_cache_directory(models_directory: pathlib.Path) -> pathlib.Path:
+    return models_directory.joinpath(PREDICTION_CACHE_DIRECTORY_NAME)
+
+
+def hash_files(file_paths: List[pathlib.Path], root_directory: pathlib.Path) -> str:
+    digest = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        digest.update(str(file_path.relative_to(root_directory)).encode('utf-8'))
+        digest.update(compute_file_hash(file_path).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hash_model_directory(model_directory: pathlib.Path) -> str:
+    # Only the files of the model itself, not subdirectories such as exports.
+    if not model_directory.is_dir():
+        raise ValueError(f'Model directory {model_directory} does not exist.')
+    return hash_files(
+        [file_path for file_path in model_directory.iterdir() if file_path.is_file()],
+        model_directory
+    )
+
+
+def hash_dataset_split(dataset_directory: pathlib.Path, mode: str) -> str:
+    split_directory = dataset_directory.joinpath('processed').joinpath(mode)
+    return hash_files(sorted(split_directory.glob('*.csv')), split_directory)
+
+
+def list_files(directory: pathlib.Path) -> Dict[str, int]:
+    if not directory.is_dir():
+        return {}
+    return {
+        file_path.name: file_path.stat().st_mtime_ns
+        for file_path in directory.iterdir() if file_path.is_file()
+    }
+
+
+class PredictionCache:
+    """Size-bounded store of test predictions.
+
+    Entries are keyed by the hash of the model artifacts, the hash of the
+    dataset split, window and horizon size and mode, and hold the prediction
+    files written by a test run in a compressed .npz archive. Reading an
+    entry marks it as recently used. After every store, the least recently
+    used entries are evicted until the cache fits into max_bytes.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int):
+        if max_bytes < 1:
+            raise ValueError('Prediction cache size has to be positive.')
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def build_key(
+        model_name: str,
+        model_hash: str,
+        dataset_hash: str,
+        window_size: int,
+        horizon_size: int,
+        mode: str
+    ) -> str:
+        description = dict(
+            model_name=model_name,
+            model=model_hash,
+            dataset=dataset_hash,
+            window_size=window_size,
+            horizon_size=horizon_size,
+            mode=mode
+        )
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self, key: str) -> Optional[Dict[str, bytes]]:
+        # Cached files by name, or None on a miss.
+        file_path = self._get_entry_path(key)
+        try:
+            with np.load(file_path, allow_pickle=False) as data:
+                files = {name: data[name].tobytes() for name in data.files}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'Skipping unreadable prediction cache entry {file_path}: {e}')
+            return None
+
+        # The entry can be evicted by another worker after it was read.
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            pass
+        return files
+
+    def store(self, key: str, files: Dict[str, bytes]) -> pathlib.Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        file_path = self._get_entry_path(key)
+        temporary_path = file_path.with_name(f'.{file_path.stem}.{os.getpid()}.tmp.npz')
+        np.savez_compressed(
+            temporary_path,
+            **{name: np.frombuffer(content, dtype=np.uint8) for name, content in files.items()}
+        )
+        os.replace(temporary_path, file_path)
+        self.evict()
+        return file_path
+
+    def evict(self) -> None:
+        # Entries can disappear concurrently when several workers evict.
+        entries = []
+        for file_path in self.directory.glob('*.npz'):
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, file_path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                file_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def _get_entry_path(self, key: str) -> pathlib.Path:
+        return self.directory.joinpath(f'{key}.npz')
@@ -0,0 +1,217 @@
+import dataclasses
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from relinet.utils import compute_file_hash
+
+
+class TaskProgress:
+    # Files of one provisioning task in the manifest. Fetchers record every
+    # file as soon as it is complete, so an interrupted task resumes with the
+    # files that are still present with the recorded content.
+    def __init__(self, manifest: 'ProvisioningManifest', task_name: str):
+        self.manifest = manifest
+        self.task_name = task_name
+
+    def is_verified(self, file_path: pathlib.Path, checksum: Optional[str] = None) -> bool:
+        return self.manifest.is_file_verified(self.task_name, file_path, checksum)
+
+    def record(self, file_path: pathlib.Path, checksum: Optional[str] = None) -> None:
+        self.manifest.record_file(self.task_name, file_path, checksum)
+
+
+class DatasetFetcher:
+    def fetch(self, target_directories: Sequence[pathlib.Path], progress: TaskProgress) -> bool:
+        raise NotImplementedError()
+
+
+class DeepsysidDownloadFetcher(DatasetFetcher):
+    # deepsysid downloads and splits a dataset in one call, so its files are
+    # only recorded once the call succeeded.
+    def __init__(self, dataset_name: str, arguments: Optional[List[str]] = None):
+        self.dataset_name = dataset_name
+        self.arguments = arguments if arguments is not None else []
+
+    def fetch(self, target_directories: Sequence[pathlib.Path], progress: TaskProgress) -> bool:
+        return_code = subprocess.call(
+            ['deepsysid', 'download', self.dataset_name]
+            + self.arguments
+            + [str(directory) for directory in target_directories]
+        )
+        return return_code == 0
+
+
+class LocalMirrorFetcher(DatasetFetcher):
+    # Offline stand-in for a download. The mirror contains the target
+    # directories by name, e.g. {mirror}/ship-ind and {mirror}/ship-ood.
+    # Files whose recorded checksum matches both the mirror and the target
+    # are skipped, all others are copied and recorded one by one.
+    def __init__(self, mirror_directory: pathlib.Path):
+        self.mirror_directory = mirror_directory
+
+    def fetch(self, target_directories: Sequence[pathlib.Path], progress: TaskProgress) -> bool:
+        for target_directory in target_directories:
+            source_directory = self.mirror_directory.joinpath(target_directory.name)
+            if not source_directory.is_dir():
+                return False
+            for source_path in sorted(source_directory.rglob('*')):
+                if not source_path.is_file():
+                    continue
+                target_path = target_directory.joinpath(source_path.relative_to(source_directory))
+                checksum = compute_file_hash(source_path)
+                if progress.is_verified(target_path, checksum):
+                    continue
+                # Copy under a temporary name, so an interrupted copy never
+                # leaves a truncated file under the final name.
+                target_path.parent.mkdir(parents=True, exist_ok=True)
+                temporary_path = target_path.with_name(f'.{target_path.name}.tmp')
+                shutil.copy2(source_path, temporary_path)
+                os.replace(temporary_path, target_path)
+                progress.record(target_path, checksum)
+        return True
+
+
+@dataclasses.dataclass
+class ProvisioningTask:
+    name: str
+    fetcher: DatasetFetcher
+    target_directories: List[pathlib.Path]
+
+
+def link_tree(
+    source_directory: pathlib.Path,
+    target_directory: pathlib.Path,
+    progress: Optional[TaskProgress] = None
+) -> None:
+    # Share file contents instead of copying: hardlinks on the same filesystem,
+    # otherwise a reflink where the filesystem supports it, otherwise a copy.
+    # Every linked file is recorded in progress.
+    for source_path in sorted(source_directory.rglob('*')):
+        if not source_path.is_file():
+            continue
+        target_path = target_directory.joinpath(source_path.relative_to(source_directory))
+        if progress is not None and progress.is_verified(target_path, compute_file_hash(source_path)):
+            continue
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        if target_path.exists():
+            if os.path.samefile(source_path, target_path):
+                if progress is not None:
+                    progress.record(target_path)
+                continue
+            target_path.unlink()
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            return_code = subprocess.call(
+                ['cp', '--reflink=auto', str(source_path), str(target_path)],
+                stderr=subprocess.DEVNULL
+            )
+            if return_code != 0:
+                shutil.copy2(source_path, target_path)
+        if progress is not None:
+            progress.record(target_path)
+
+
+class ProvisioningManifest:
+    # Per task, the checksum of every provisioned file and whether the task
+    # completed. Files are recorded as they complete, not only at the end of
+    # a task, and verified against their checksums on every rerun.
+    def __init__(self, manifest_path: pathlib.Path):
+        self.manifest_path = manifest_path
+        self.root_directory = manifest_path.parent
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if manifest_path.exists():
+            with manifest_path.open(mode='r') as f:
+                self.entries = json.load(f)
+
+    def _get_entry(self, task_name: str) -> Dict[str, Any]:
+        return self.entries.setdefault(task_name, {'complete': False, 'files': {}})
+
+    def is_complete(self, task_name: str) -> bool:
+        # A task is complete if it finished once and all its recorded files
+        # are still present with unchanged content.
+        with self._lock:
+            entry = self.entries.get(task_name)
+            if entry is None or not entry['complete'] or len(entry['files']) == 0:
+                return False
+            checksums = dict(entry['files'])
+        for relative_path, checksum in checksums.items():
+            file_path = self.root_directory.joinpath(relative_path)
+            if not file_path.is_file() or compute_file_hash(file_path) != checksum:
+                return False
+        return True
+
+    def is_file_verified(self, task_name: str, file_path: pathlib.Path, checksum: Optional[str] = None) -> bool:
+        # Whether the file was recorded, with checksum if given, and its
+        # content still matches the record.
+        with self._lock:
+            recorded = self._get_entry(task_name)['files'].get(str(file_path.relative_to(self.root_directory)))
+        if recorded is None or (checksum is not None and recorded != checksum):
+            return False
+        return file_path.is_file() and compute_file_hash(file_path) == recorded
+
+    def record_file(self, task_name: str, file_path: pathlib.Path, checksum: Optional[str] = None) -> None:
+        if checksum is None:
+            checksum = compute_file_hash(file_path)
+        with self._lock:
+            self._get_entry(task_name)['files'][str(file_path.relative_to(self.root_directory))] = checksum
+            self._save()
+
+    def start(self, task_name: str) -> None:
+        # Files recorded so far are kept, so the fetcher can skip them.
+        with self._lock:
+            self._get_entry(task_name)['complete'] = False
+            self._save()
+
+    def complete(self, task_name: str, target_directories: Sequence[pathlib.Path]) -> None:
+        # Records the final content of all files, including those of fetchers
+        # that cannot record files themselves, and drops records of files
+        # that no longer exist.
+        files = {}
+        for directory in target_directories:
+            for file_path in sorted(directory.rglob('*')):
+                if file_path.is_file():
+                    files[str(file_path.relative_to(self.root_directory))] = compute_file_hash(file_path)
+        with self._lock:
+            self.entries[task_name] = {'complete': True, 'files': files}
+            self._save()
+
+    def _save(self) -> None:
+        temporary_path = self.manifest_path.with_name(f'.{self.manifest_path.name}.{threading.get_ident()}.tmp')
+        with temporary_path.open(mode='w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(temporary_path, self.manifest_path)
+
+
+def run_provisioning_task(task: ProvisioningTask, manifest: ProvisioningManifest) -> bool:
+    if manifest.is_complete(task.name):
+        print(f'Skipping {task.name}, all files are present and verified.')
+        return True
+
+    manifest.start(task.name)
+    print(f'Provisioning {task.name}.')
+    if not task.fetcher.fetch(task.target_directories, TaskProgress(manifest, task.name)):
+        print(f'Failed provisioning {task.name}.')
+        return False
+
+    manifest.complete(task.name, task.target_directories)
+    return True
+
+
+def provision_datasets(
+    tasks: Sequence[ProvisioningTask],
+    manifest: ProvisioningManifest
+) -> Dict[str, bool]:
+    with ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as executor:
+        results = list(executor.map(
+            lambda task: run_provisioning_task(task, manifest),
+            tasks
+        ))
+    return {task.name: result for task, result in zip(tasks, results)}
@@ -0,0 +1,279 @@
+import hashlib
+import os
+import pathlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.linalg
+from deepsysid.models.base import DynamicIdentificationModel, DynamicIdentificationModelConfig
+
+from relinet.datasets import hash_sequences
+from relinet.models import Normalization
+from relinet.utils import lock_file
+
+GRAM_CACHE_DIRECTORY_NAME = 'qlag-gram-cache'
+
+
+def build_quadratic_control_lag_features(control: np.ndarray, lag: int) -> np.ndarray:
+    # Features of every step t >= lag - 1 of a normalized control sequence:
+    # a constant, then u_{t-k} and u_{t-k}^2 for k = 0, ..., lag - 1. The
+    # features of a smaller lag are a prefix of those of a larger lag.
+    n_steps = control.shape[0] - lag + 1
+    blocks = [np.ones((n_steps, 1))]
+    for k in range(lag):
+        lagged = control[lag - 1 - k:lag - 1 - k + n_steps]
+        blocks.append(lagged)
+        blocks.append(lagged ** 2)
+    return np.concatenate(blocks, axis=1)
+
+
+def get_feature_dimension(control_dim: int, lag: int) -> int:
+    return 1 + 2 * control_dim * lag
+
+
+def accumulate_gram(
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    normalization: Normalization,
+    max_lag: int,
+    chunk_size: int = 4096
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    # Gram matrix X^T X and moment X^T Y of the max_lag design, built in
+    # chunks of chunk_size steps so the design matrix is never materialized.
+    # Only steps with max_lag controls of history are used, which makes the
+    # Gram matrix of every smaller lag a leading block of this one.
+    feature_dim = get_feature_dimension(control_seqs[0].shape[1], max_lag)
+    gram = np.zeros((feature_dim, feature_dim))
+    moment = np.zeros((feature_dim, state_seqs[0].shape[1]))
+    n_samples = 0
+    for control, state in zip(control_seqs, state_seqs):
+        control = (control - normalization.control_mean) / normalization.control_std
+        state = (state - normalization.state_mean) / normalization.state_std
+        for start in range(max_lag - 1, control.shape[0], chunk_size):
+            end = min(start + chunk_size, control.shape[0])
+            features = build_quadratic_control_lag_features(control[start - max_lag + 1:end], max_lag)
+            gram += features.T @ features
+            moment += features.T @ state[start:end]
+            n_samples += end - start
+    return gram, moment, n_samples
+
+
+def build_head_rows(
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    normalization: Normalization,
+    lag: int,
+    max_lag: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Features and targets of the steps lag - 1, ..., max_lag - 2 of every
+    # sequence. These have lag but not max_lag controls of history, so they
+    # are the rows a fit of lag has in addition to the rows of the Gram matrix.
+    features = [np.zeros((0, get_feature_dimension(control_seqs[0].shape[1], lag)))]
+    targets = [np.zeros((0, state_seqs[0].shape[1]))]
+    for control, state in zip(control_seqs, state_seqs):
+        end = min(max_lag - 1, control.shape[0])
+        if end < lag:
+            continue
+        control = (control[:end] - normalization.control_mean) / normalization.control_std
+        features.append(build_quadratic_control_lag_features(control, lag))
+        targets.append((state[lag - 1:end] - normalization.state_mean) / normalization.state_std)
+    return np.concatenate(features), np.concatenate(targets)
+
+
+def solve_nested_lags(
+    gram: np.ndarray,
+    moment: np.ndarray,
+    control_dim: int,
+    lags: Sequence[int],
+    regularization: float = 0.0,
+    head_rows: Optional[Dict[int, Tuple[np.ndarray, np.ndarray]]] = None
+) -> Dict[int, np.ndarray]:
+    # Least-squares parameters of every lag from one Cholesky factorization.
+    # The Cholesky factor of a leading block of the Gram matrix is the leading
+    # block of the full factor, so each lag only needs two triangular solves.
+    # The rows in head_rows of a lag are added to its block with a QR update
+    # of the block factor, so every lag is fit on all steps with lag controls
+    # of history. regularization is a ridge penalty on all but the constant
+    # feature.
+    penalty = np.full(gram.shape[0], regularization)
+    penalty[0] = 0.0
+    regularized = gram + np.diag(penalty)
+
+    try:
+        factor = scipy.linalg.cholesky(regularized, lower=True)
+    except np.linalg.LinAlgError:
+        # Singular Gram matrix, e.g. from a constant control. Fall back to
+        # minimum-norm solutions of the normal equations.
+        print('Gram matrix is not positive definite, falling back to least squares.')
+        factor = None
+
+    parameters = {}
+    for lag in lags:
+        feature_dim = get_feature_dimension(control_dim, lag)
+        features, targets = (None, None) if head_rows is None else head_rows.get(lag, (None, None))
+        if features is not None and features.shape[0] == 0:
+            features = None
+        lag_moment = moment[:feature_dim]
+        if features is not None:
+            lag_moment = lag_moment + features.T @ targets
+        if factor is None:
+            lag_gram = regularized[:feature_dim, :feature_dim]
+            if features is not None:
+                lag_gram = lag_gram + features.T @ features
+            parameters[lag] = np.linalg.lstsq(lag_gram, lag_moment, rcond=None)[0]
+            continue
+        block = factor[:feature_dim, :feature_dim]
+        if features is not None:
+            # R^T R = L L^T + F^T F for the triangular factor R of [L^T; F].
+            block = np.linalg.qr(np.vstack((block.T, features)), mode='r').T
+        intermediate = scipy.linalg.solve_triangular(block, lag_moment, lower=True)
+        parameters[lag] = scipy.linalg.solve_triangular(block.T, intermediate, lower=False)
+    return parameters
+
+
+def fit_quadratic_control_lags(
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    lags: Sequence[int],
+    regularization: float = 0.0,
+    chunk_size: int = 4096
+) -> Tuple[Normalization, Dict[int, np.ndarray]]:
+    # Fits the quadratic control lag model for all lags in a single pass over
+    # the training data.
+    normalization = Normalization.from_sequences(control_seqs, state_seqs)
+    max_lag = max(lags)
+    gram, moment, _ = accumulate_gram(control_seqs, state_seqs, normalization, max_lag, chunk_size)
+    head_rows = {
+        lag: build_head_rows(control_seqs, state_seqs, normalization, lag, max_lag)
+        for lag in lags
+    }
+    return normalization, solve_nested_lags(
+        gram, moment, control_seqs[0].shape[1], lags, regularization, head_rows
+    )
+
+
+def get_gram_cache_directory(models_directory: pathlib.Path) -> pathlib.Path:
+    return models_directory.joinpath(GRAM_CACHE_DIRECTORY_NAME)
+
+
+class NestedQuadraticControlLagModelConfig(DynamicIdentificationModelConfig):
+    lag: int
+    # Lag of the Gram matrix, the largest lag of the gridsearch.
+    max_lag: Optional[int] = None
+    regularization: float = 0.0
+    chunk_size: int = 4096
+    use_gram_cache: bool = True
+
+
+class NestedQuadraticControlLagModel(DynamicIdentificationModel):
+    """Quadratic control lag model fitted from a shared Gram matrix.
+
+    The Gram matrix of the max_lag design is built once per training set and,
+    if the MODELS_DIRECTORY environment variable is set, cached in
+    MODELS_DIRECTORY/qlag-gram-cache. Every lag of a gridsearch with the same
+    max_lag then only solves its leading block, updated with the few steps
+    that have lag but not max_lag controls of history. Every lag is therefore
+    fit on the same steps as with max_lag equal to lag.
+    """
+
+    CONFIG = NestedQuadraticControlLagModelConfig
+
+    def __init__(self, config: NestedQuadraticControlLagModelConfig):
+        super().__init__(config)
+        self.config = config
+        self.lag = config.lag
+        self.max_lag = config.max_lag if config.max_lag is not None else config.lag
+        if self.max_lag < self.lag:
+            raise ValueError(f'max_lag {self.max_lag} has to be at least lag {self.lag}.')
+
+        self.control_dim = len(config.control_names)
+        self.state_dim = len(config.state_names)
+
+        self.control_mean: Optional[np.ndarray] = None
+        self.control_std: Optional[np.ndarray] = None
+        self.state_mean: Optional[np.ndarray] = None
+        self.state_std: Optional[np.ndarray] = None
+        self.parameters: Optional[np.ndarray] = None
+
+    def train(self, control_seqs: List[np.ndarray], state_seqs: List[np.ndarray]) -> Dict[str, np.ndarray]:
+        normalization = Normalization.from_sequences(control_seqs, state_seqs)
+        normalization.apply_to(self)
+
+        cache_path = self._get_cache_path(control_seqs, state_seqs)
+        if cache_path is None:
+            gram, moment, n_samples = accumulate_gram(
+                control_seqs, state_seqs, normalization, self.max_lag, self.config.chunk_size
+            )
+        else:
+            # The QLag jobs of a gridsearch can run concurrently on several
+            # slots. The first one builds the Gram matrix, the others wait for
+            # it and load the cached one.
+            with lock_file(cache_path.with_suffix('.lock')):
+                if cache_path.exists():
+                    with np.load(cache_path) as data:
+                        gram, moment, n_samples = data['gram'], data['moment'], int(data['n_samples'])
+                else:
+                    gram, moment, n_samples = accumulate_gram(
+                        control_seqs, state_seqs, normalization, self.max_lag, self.config.chunk_size
+                    )
+                    temporary_path = cache_path.with_name(f'.{cache_path.stem}.{os.getpid()}.tmp.npz')
+                    np.savez(temporary_path, gram=gram, moment=moment, n_samples=n_samples)
+                    os.replace(temporary_path, cache_path)
+
+        features, targets = build_head_rows(control_seqs, state_seqs, normalization, self.lag, self.max_lag)
+        self.parameters = solve_nested_lags(
+            gram, moment, self.control_dim, [self.lag], self.config.regularization,
+            {self.lag: (features, targets)}
+        )[self.lag]
+        return dict(n_samples=np.array([n_samples + features.shape[0]]))
+
+    def _get_cache_path(
+        self,
+        control_seqs: List[np.ndarray],
+        state_seqs: List[np.ndarray]
+    ) -> Optional[pathlib.Path]:
+        if not self.config.use_gram_cache or 'MODELS_DIRECTORY' not in os.environ:
+            return None
+        key = hashlib.sha256(
+            f'{self.max_lag}-{self.config.chunk_size}-{hash_sequences(control_seqs)}-'
+            f'{hash_sequences(state_seqs)}'.encode('utf-8')
+        ).hexdigest()
+        return get_gram_cache_directory(pathlib.Path(os.environ['MODELS_DIRECTORY'])).joinpath(f'{key}.npz')
+
+    def simulate(
+        self,
+        initial_control: np.ndarray,
+        initial_state: np.ndarray,
+        control: np.ndarray
+    ) -> np.ndarray:
+        if self.parameters is None:
+            raise ValueError('Model has not been trained.')
+
+        control = np.vstack((initial_control[initial_control.shape[0] - self.lag + 1:], control))
+        control = (control - self.control_mean) / self.control_std
+        prediction = build_quadratic_control_lag_features(control, self.lag) @ self.parameters
+        return prediction * self.state_std + self.state_mean
+
+    def save(self, file_path: Tuple[str, ...]) -> None:
+        np.savez(
+            file_path[0],
+            control_mean=self.control_mean,
+            control_std=self.control_std,
+            state_mean=self.state_mean,
+            state_std=self.state_std,
+            parameters=self.parameters
+        )
+
+    def load(self, file_path: Tuple[str, ...]) -> None:
+        with np.load(file_path[0]) as data:
+            self.control_mean = data['control_mean']
+            self.control_std = data['control_std']
+            self.state_mean = data['state_mean']
+            self.state_std = data['state_std']
+            self.parameters = data['parameters']
+
+    def get_file_extension(self) -> Tuple[str, ...]:
+        return ('npz',)
+
+    def get_parameter_count(self) -> int:
+        return get_feature_dimension(self.control_dim, self.lag) * self.state_dim
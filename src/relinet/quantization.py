@@ -0,0 +1,246 @@
+import contextlib
+import copy
+import dataclasses
+import io
+import json
+import math
+import pathlib
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from deepsysid.pipeline.configuration import ExperimentConfiguration, initialize_model
+from deepsysid.pipeline.data_io import build_score_file_name
+from deepsysid.pipeline.evaluation import evaluate_model
+from deepsysid.pipeline.model_io import load_model
+from torch import nn
+
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    # torch < 1.10
+    from torch.quantization import quantize_dynamic
+
+from relinet.datasets import list_split_file_names, load_split_sequences
+from relinet.models import Normalization, is_recurrent_model, predict_batch
+from relinet.testing import TestPredictionWriter, build_test_prediction_path, iterate_test_windows
+
+QUANTIZED_DIRECTORY_NAME = 'quantized'
+QUANTIZATION_VARIANTS = ('float', 'int8')
+
+
+@dataclasses.dataclass
+class QuantizationTestResult:
+    model_name: str
+    success: bool
+    error: Optional[str] = None
+    n_windows: int = 0
+    float_max_deviation: float = math.nan
+    float_batch_median_ms: float = math.nan
+    int8_batch_median_ms: float = math.nan
+    float_size_bytes: int = 0
+    int8_size_bytes: int = 0
+
+
+def get_quantized_result_directory(result_directory: pathlib.Path) -> pathlib.Path:
+    return result_directory.joinpath(QUANTIZED_DIRECTORY_NAME)
+
+
+def get_variant_result_directory(result_directory: pathlib.Path, variant: str) -> pathlib.Path:
+    # Result directory of a variant in the layout of deepsysid, holding the
+    # test predictions and scores of every model.
+    return get_quantized_result_directory(result_directory).joinpath(variant)
+
+
+def build_quantized_cost_file_name(mode: str) -> str:
+    return f'quantization-{mode}.json'
+
+
+def quantize_model(model):
+    # Copy of a recurrent model with dynamically quantized int8 LSTM and
+    # linear layers. Quantized modules only run on CPU.
+    if not is_recurrent_model(model):
+        raise ValueError(f'Only recurrent models can be quantized, got {type(model).__name__}.')
+
+    quantized = copy.copy(model)
+    quantized.device = torch.device('cpu')
+    quantized.initializer = quantize_dynamic(
+        copy.deepcopy(model.initializer).cpu().eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8
+    )
+    quantized.predictor = quantize_dynamic(
+        copy.deepcopy(model.predictor).cpu().eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8
+    )
+    return quantized
+
+
+def measure_model_size(model) -> int:
+    # Serialized size of the initializer and predictor in bytes.
+    buffer = io.BytesIO()
+    torch.save({
+        'initializer': model.initializer.state_dict(),
+        'predictor': model.predictor.state_dict()
+    }, buffer)
+    return buffer.getbuffer().nbytes
+
+
+def test_quantized_model(
+    configuration: ExperimentConfiguration,
+    model_name: str,
+    dataset_directory: pathlib.Path,
+    result_directory: pathlib.Path,
+    models_directory: pathlib.Path,
+    mode: str = 'test',
+    batch_size: int = 256,
+    tolerance: float = 1e-3
+) -> QuantizationTestResult:
+    # Float and int8 variants predict the windows of the deepsysid test run of
+    # the model on CPU, in batches. The predictions of every variant are
+    # written in deepsysid's test layout to result_directory/quantized/{variant}
+    # and scored with evaluate_model. The float predictions have to reproduce
+    # those of the test run up to tolerance (in units of the state standard
+    # deviation), so its scores are those of summary-prediction.csv.
+    model = initialize_model(configuration, model_name, 'cpu')
+    load_model(model, str(models_directory.joinpath(model_name)), model_name)
+    variants = {'float': model, 'int8': quantize_model(model)}
+    state_std = Normalization.from_model(model).state_std
+
+    control_seqs, state_seqs = load_split_sequences(
+        dataset_directory, mode, configuration.control_names, configuration.state_names
+    )
+    reference_path = build_test_prediction_path(
+        result_directory, model_name, mode, configuration.window_size, configuration.horizon_size
+    )
+
+    latencies: Dict[str, List[float]] = {variant: [] for variant in QUANTIZATION_VARIANTS}
+    n_windows = 0
+    float_max_deviation = 0.0
+    with contextlib.ExitStack() as stack:
+        writers = {
+            variant: stack.enter_context(TestPredictionWriter(reference_path, build_test_prediction_path(
+                get_variant_result_directory(result_directory, variant),
+                model_name,
+                mode,
+                configuration.window_size,
+                configuration.horizon_size
+            )))
+            for variant in QUANTIZATION_VARIANTS
+        }
+        for initial_control, initial_state, control, _, reference_prediction in iterate_test_windows(
+            reference_path,
+            control_seqs,
+            state_seqs,
+            list_split_file_names(dataset_directory, mode),
+            configuration.window_size,
+            configuration.horizon_size,
+            batch_size
+        ):
+            for variant in QUANTIZATION_VARIANTS:
+                start_time = time.perf_counter()
+                prediction = predict_batch(variants[variant], initial_control, initial_state, control)
+                latencies[variant].append(time.perf_counter() - start_time)
+                writers[variant].write(prediction)
+                if variant == 'float':
+                    float_max_deviation = max(
+                        float_max_deviation,
+                        float(np.max(np.abs(prediction - reference_prediction) / state_std))
+                    )
+            n_windows += initial_control.shape[0]
+
+    if float_max_deviation > tolerance:
+        raise ValueError(
+            f'Float predictions of {model_name} deviate from its test run by {float_max_deviation:.2e} '
+            f'state standard deviations, more than the tolerance of {tolerance:.2e}.'
+        )
+
+    result = QuantizationTestResult(
+        model_name=model_name,
+        success=True,
+        n_windows=n_windows,
+        float_max_deviation=float_max_deviation,
+        float_batch_median_ms=float(np.median(latencies['float']) * 1000.0),
+        int8_batch_median_ms=float(np.median(latencies['int8']) * 1000.0),
+        float_size_bytes=measure_model_size(variants['float']),
+        int8_size_bytes=measure_model_size(variants['int8'])
+    )
+
+    for variant in QUANTIZATION_VARIANTS:
+        variant_result_directory = get_variant_result_directory(result_directory, variant)
+        evaluate_model(
+            model_name=model_name,
+            config=configuration,
+            mode=mode,
+            result_directory=str(variant_result_directory),
+            models_directory=str(models_directory)
+        )
+        with variant_result_directory.joinpath(model_name).joinpath(build_quantized_cost_file_name(mode)).open(
+            mode='w'
+        ) as f:
+            json.dump(dict(
+                batch_median_ms=getattr(result, f'{variant}_batch_median_ms'),
+                windows_per_second=n_windows / sum(latencies[variant]),
+                size_bytes=getattr(result, f'{variant}_size_bytes')
+            ), f, indent=2)
+    return result
+
+
+def summarize_quantization(
+    result_directory: pathlib.Path,
+    window_size: int,
+    horizon_size: int,
+    horizons: List[int],
+    mode: str = 'test'
+) -> pd.DataFrame:
+    # NRMSE averaged over states for both variants per model and horizon,
+    # with the difference int8 - float, the speedup float / int8 latency and
+    # the size ratio int8 / float.
+    rows = []
+    float_directory = get_variant_result_directory(result_directory, 'float')
+    model_directories = sorted(float_directory.iterdir()) if float_directory.exists() else []
+    for model_directory in model_directories:
+        variants = {}
+        for variant in QUANTIZATION_VARIANTS:
+            variant_directory = get_variant_result_directory(result_directory, variant).joinpath(model_directory.name)
+            score_path = variant_directory.joinpath(build_score_file_name(
+                mode=mode,
+                window_size=window_size,
+                horizon_size=horizon_size,
+                extension='json'
+            ))
+            cost_path = variant_directory.joinpath(build_quantized_cost_file_name(mode))
+            if score_path.exists() and cost_path.exists():
+                with score_path.open(mode='r') as f:
+                    variants[variant] = json.load(f)
+                with cost_path.open(mode='r') as f:
+                    variants[variant].update(json.load(f))
+        if len(variants) != len(QUANTIZATION_VARIANTS):
+            continue
+
+        for horizon in horizons:
+            nrmse = {
+                variant: float(np.mean(variants[variant]['scores_per_horizon'][str(horizon)]['nrmse']))
+                for variant in QUANTIZATION_VARIANTS
+            }
+            rows.append([
+                model_directory.name,
+                horizon,
+                nrmse['float'],
+                nrmse['int8'],
+                nrmse['int8'] - nrmse['float'],
+                variants['float']['batch_median_ms'] / variants['int8']['batch_median_ms'],
+                variants['int8']['size_bytes'] / variants['float']['size_bytes']
+            ])
+
+    return pd.DataFrame(
+        data=rows,
+        columns=['model', 'horizon', 'nrmse_float', 'nrmse_int8', 'nrmse_delta', 'speedup', 'size_ratio']
+    )
+
+
+def write_quantization_test_results(
+    results: List[QuantizationTestResult],
+    result_path: pathlib.Path
+) -> None:
+    with result_path.open(mode='w') as f:
+        json.dump([dataclasses.asdict(result) for result in results], f, indent=2)
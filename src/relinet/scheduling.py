@@ -0,0 +1,316 @@
+import dataclasses
+import json
+import os
+import pathlib
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from deepsysid.pipeline.configuration import ExperimentConfiguration, ExperimentGridSearchTemplate
+from deepsysid.pipeline.gridsearch import ExperimentSessionReport
+
+from relinet.cachedcli import CACHED_DEEPSYSID_COMMAND
+from relinet.telemetry import TelemetryRecorder
+from relinet.utils import call_command
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkerSlot:
+    name: str
+    device_idx: Optional[int] = None
+    cpu_cores: Optional[Tuple[int, ...]] = None
+    torch_threads: Optional[int] = None
+
+    def build_environment(self, environment: Dict[str, str]) -> Dict[str, str]:
+        env = environment.copy()
+        if self.torch_threads is not None:
+            env['OMP_NUM_THREADS'] = str(self.torch_threads)
+            env['MKL_NUM_THREADS'] = str(self.torch_threads)
+        return env
+
+    def build_command_prefix(self) -> List[str]:
+        # Pins the job to the slot's cores. Affinity is set by taskset in the
+        # child, since preexec_fn is not safe in a threaded parent.
+        if self.cpu_cores is None:
+            return []
+        return ['taskset', '--cpu-list', ','.join(str(core) for core in self.cpu_cores)]
+
+    def build_device_arguments(self) -> List[str]:
+        if self.device_idx is None:
+            return []
+        return ['--enable-cuda', f'--device-idx={self.device_idx}']
+
+
+@dataclasses.dataclass
+class GridModel:
+    model_name: str
+    model_base_name: str
+    model_class: str
+    parameters: Dict[str, Any]
+    cost: float
+
+
+@dataclasses.dataclass(frozen=True)
+class GridsearchJob:
+    model_name: str
+    model_base_name: str
+    cost: float
+
+
+def parse_worker_slots(specification: str) -> List[WorkerSlot]:
+    # Comma-separated list of slots, e.g. "cuda:0,cuda:1,cpu:0-7,cpu:8-15:4".
+    # A CPU slot is a core range with an optional torch thread budget,
+    # which defaults to the number of cores in the range.
+    slots = []
+    for idx, entry in enumerate(specification.split(',')):
+        fields = entry.strip().split(':')
+        if fields[0] == 'cuda' and len(fields) == 2:
+            slots.append(WorkerSlot(
+                name=f'slot-{idx}-cuda-{fields[1]}',
+                device_idx=int(fields[1])
+            ))
+        elif fields[0] == 'cpu' and len(fields) in (2, 3):
+            first_core, last_core = (int(core) for core in fields[1].split('-'))
+            cpu_cores = tuple(range(first_core, last_core + 1))
+            torch_threads = int(fields[2]) if len(fields) == 3 else len(cpu_cores)
+            slots.append(WorkerSlot(
+                name=f'slot-{idx}-cpu-{fields[1]}',
+                cpu_cores=cpu_cores,
+                torch_threads=torch_threads
+            ))
+        else:
+            raise ValueError(
+                f'Invalid worker slot "{entry}". '
+                'Expected "cuda:{device}" or "cpu:{first}-{last}[:{threads}]".'
+            )
+
+    if len(slots) == 0:
+        raise ValueError('At least one worker slot is required.')
+
+    return slots
+
+
+# Models without epochs are fitted by least squares. k-LinReg typically
+# converges within a few tens of iterations per restart.
+KLINREG_ITERATIONS_ESTIMATE = 20
+
+
+def estimate_job_cost(
+    parameters: Dict[str, Any],
+    control_dim: int,
+    state_dim: int
+) -> float:
+    # Rough number of floating point operations per training sample, so
+    # recurrent and least-squares models are comparable:
+    # - recurrent models: forward and backward pass through all LSTM layers
+    #   in every epoch, about 3 * 8 * recurrent_dim^2 per layer and step,
+    # - kLinReg: per restart and iteration, the residuals of all modes and
+    #   the least-squares fits of their samples,
+    # - QLag: a single least-squares fit of the quadratic control features.
+    epochs = sum(
+        value for name, value in parameters.items()
+        if name.startswith('epochs')
+    )
+    if epochs > 0:
+        recurrent_dim = parameters.get('recurrent_dim', 1)
+        num_recurrent_layers = parameters.get('num_recurrent_layers', 1)
+        return float(epochs * num_recurrent_layers * 3 * 8 * recurrent_dim ** 2)
+
+    lag = parameters.get('lag', 1)
+    if 'n_modes' in parameters:
+        regressor_dim = lag * (control_dim + state_dim) + 1
+        n_restarts = parameters.get('zero_probability_restarts', 1)
+        return float(
+            n_restarts * KLINREG_ITERATIONS_ESTIMATE
+            * (regressor_dim ** 2 + parameters['n_modes'] * regressor_dim * state_dim)
+        )
+
+    feature_dim = 2 * lag * control_dim + 1
+    return float(feature_dim ** 2)
+
+
+def expand_model_grid(template: Dict[str, Any]) -> List[GridModel]:
+    # Model names and parameters as deepsysid expands them, so names always
+    # match the session report.
+    configuration = ExperimentConfiguration.from_grid_search_template(
+        ExperimentGridSearchTemplate.parse_obj(template)
+    )
+    control_dim = len(template['settings']['control_names'])
+    state_dim = len(template['settings']['state_names'])
+
+    models = []
+    for model_name, model in configuration.models.items():
+        parameters = dict(model.parameters)
+        models.append(GridModel(
+            model_name=model_name,
+            model_base_name=model.model_base_name,
+            model_class=model.model_class,
+            parameters=parameters,
+            cost=estimate_job_cost(parameters, control_dim, state_dim)
+        ))
+    return models
+
+
+def build_gridsearch_jobs(configuration_path: pathlib.Path) -> List[GridsearchJob]:
+    with configuration_path.open(mode='r') as f:
+        template = json.load(f)
+
+    jobs = [
+        GridsearchJob(
+            model_name=model.model_name,
+            model_base_name=model.model_base_name,
+            cost=model.cost
+        )
+        for model in expand_model_grid(template)
+    ]
+    return sort_jobs_longest_first(jobs)
+
+
+def sort_jobs_longest_first(jobs: Sequence[GridsearchJob]) -> List[GridsearchJob]:
+    return sorted(jobs, key=lambda job: (-job.cost, job.model_name))
+
+
+class SessionReportWriter:
+    def __init__(self, report_path: pathlib.Path, report: ExperimentSessionReport):
+        self.report_path = report_path
+        self.report = report
+        self._lock = threading.Lock()
+
+    def mark_validated(self, model_name: str) -> None:
+        with self._lock:
+            self.report.unfinished_models = set(self.report.unfinished_models) - {model_name}
+            self.report.validated_models = (
+                set(self.report.validated_models or set()) | {model_name}
+            )
+            self.write()
+
+    def mark_pruned(self, model_names: Set[str]) -> None:
+        with self._lock:
+            self.report.unfinished_models = set(self.report.unfinished_models) - model_names
+            self.write()
+
+    def write(self) -> None:
+        # Write to a temporary file first, so an interrupted session
+        # never leaves a truncated report behind.
+        temporary_path = self.report_path.with_name(f'.{self.report_path.name}.tmp')
+        temporary_path.write_text(self.report.json())
+        os.replace(temporary_path, self.report_path)
+
+
+def open_session_report(
+    report_path: pathlib.Path,
+    model_names: Sequence[str]
+) -> SessionReportWriter:
+    if report_path.exists():
+        print('Continuing session...')
+        report = ExperimentSessionReport.parse_file(report_path)
+    else:
+        print('Starting session from fresh.')
+        report = ExperimentSessionReport(
+            unfinished_models=set(model_names),
+            validated_models=set()
+        )
+
+    writer = SessionReportWriter(report_path, report)
+    writer.write()
+    return writer
+
+
+def run_gridsearch_job(
+    job: GridsearchJob,
+    slot: WorkerSlot,
+    environment: Dict[str, str],
+    telemetry: Optional[TelemetryRecorder] = None
+) -> bool:
+    env = slot.build_environment(environment)
+    prefix = slot.build_command_prefix()
+    device_arguments = slot.build_device_arguments()
+    stages = [
+        ('train', prefix + CACHED_DEEPSYSID_COMMAND + ['train'] + device_arguments + [job.model_name]),
+        (
+            'validation-test',
+            prefix + CACHED_DEEPSYSID_COMMAND + ['test', '--mode=validation'] + device_arguments + [job.model_name]
+        ),
+        ('validation-evaluate', prefix + CACHED_DEEPSYSID_COMMAND + ['evaluate', '--mode=validation', job.model_name])
+    ]
+    for stage, command in stages:
+        if telemetry is None:
+            return_code = subprocess.call(command, env=env)
+        else:
+            return_code = telemetry.run_command(job.model_name, stage, command, env=env)
+        if return_code != 0:
+            return False
+
+    return True
+
+
+def run_scheduled_gridsearch_session(
+    report_path: pathlib.Path,
+    slots: Sequence[WorkerSlot],
+    environment: Dict[str, str],
+    telemetry: Optional[TelemetryRecorder] = None
+):
+    jobs = build_gridsearch_jobs(pathlib.Path(environment['CONFIGURATION']))
+    writer = open_session_report(report_path, [job.model_name for job in jobs])
+    unfinished_models = set(writer.report.unfinished_models)
+    jobs = [job for job in jobs if job.model_name in unfinished_models]
+
+    def on_finished(job: GridsearchJob, success: bool) -> None:
+        if success:
+            writer.mark_validated(job.model_name)
+        else:
+            print(f'Failure in training or validating {job.model_name}.')
+
+    results = run_jobs_on_slots(jobs, slots, environment, telemetry, on_finished)
+    if not all(results):
+        raise ValueError('Failed running gridsearch session.')
+
+    run_test_best(report_path, slots[0], environment, telemetry)
+
+
+def run_jobs_on_slots(
+    jobs: Sequence[GridsearchJob],
+    slots: Sequence[WorkerSlot],
+    environment: Dict[str, str],
+    telemetry: Optional[TelemetryRecorder] = None,
+    on_finished: Optional[Callable[[GridsearchJob, bool], None]] = None
+) -> List[bool]:
+    free_slots: 'queue.Queue[WorkerSlot]' = queue.Queue()
+    for slot in slots:
+        free_slots.put(slot)
+
+    def run_on_free_slot(job: GridsearchJob) -> bool:
+        slot = free_slots.get()
+        try:
+            print(f'Training and validating {job.model_name} on {slot.name}.')
+            success = run_gridsearch_job(job, slot, environment, telemetry)
+        finally:
+            free_slots.put(slot)
+
+        if on_finished is not None:
+            on_finished(job, success)
+        return success
+
+    # Jobs are submitted longest-first and the executor dispatches them
+    # in submission order, which gives a longest-processing-time schedule.
+    with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+        return list(executor.map(run_on_free_slot, sort_jobs_longest_first(jobs)))
+
+
+def run_test_best(
+    report_path: pathlib.Path,
+    slot: WorkerSlot,
+    environment: Dict[str, str],
+    telemetry: Optional[TelemetryRecorder] = None
+) -> None:
+    action = 'TEST_BEST'
+    call_command(
+        CACHED_DEEPSYSID_COMMAND + ['session']
+        + slot.build_device_arguments()
+        + [f'--reportin={report_path}', report_path, action],
+        slot.build_environment(environment),
+        telemetry,
+        stage='test-best'
+    )
@@ -0,0 +1,148 @@
+import json
+import math
+import os
+import pathlib
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+from deepsysid.pipeline.data_io import build_score_file_name
+
+from relinet.utils import compute_file_hash
+
+SCORE_INDEX_COLUMNS = ['model', 'run', 'horizon', 'metric', 'channel', 'value']
+
+
+def parse_score_file(model: str, run: int, score_file_path: pathlib.Path) -> pd.DataFrame:
+    # Plain JSON parsing of ReadableEvaluationScores.scores_per_horizon,
+    # which maps horizon -> metric -> one score per state.
+    with score_file_path.open(mode='r') as f:
+        scores_per_horizon = json.load(f)['scores_per_horizon']
+
+    horizons, metrics, channels, values = [], [], [], []
+    for horizon, scores in scores_per_horizon.items():
+        for metric, channel_values in scores.items():
+            n_channels = len(channel_values)
+            horizons.extend([int(horizon)] * n_channels)
+            metrics.extend([metric] * n_channels)
+            channels.extend(range(n_channels))
+            values.extend(channel_values)
+
+    return pd.DataFrame({
+        'model': model,
+        'run': run,
+        'horizon': np.array(horizons, dtype=np.int32),
+        'metric': metrics,
+        'channel': np.array(channels, dtype=np.int32),
+        'value': np.array(values, dtype=np.float64)
+    }, columns=SCORE_INDEX_COLUMNS)
+
+
+def read_validation_score(
+    result_directory: pathlib.Path,
+    model_name: str,
+    window_size: int,
+    horizon_size: int,
+    target_metric: str
+) -> float:
+    # Mean target metric over all states at the full horizon.
+    score_file_path = result_directory.joinpath(model_name).joinpath(build_score_file_name(
+        mode='validation',
+        window_size=window_size,
+        horizon_size=horizon_size,
+        extension='json'
+    ))
+    if not score_file_path.exists():
+        return math.inf
+
+    scores = parse_score_file(model_name, 0, score_file_path)
+    scores = scores[scores['metric'] == target_metric]
+    if len(scores) == 0:
+        return math.inf
+    scores = scores[scores['horizon'] == scores['horizon'].max()]
+    return float(scores['value'].mean())
+
+
+class ScoreIndex:
+    def __init__(self, index_path: pathlib.Path):
+        # Columns are stored in an uncompressed .npz file and the state of the
+        # indexed score files in a JSON manifest next to it.
+        self.index_path = index_path.with_suffix('.npz')
+        self.manifest_path = index_path.with_suffix('.json')
+
+        self.manifest: Dict[str, Dict[str, object]] = {}
+        self.scores = pd.DataFrame(columns=SCORE_INDEX_COLUMNS)
+        if self.index_path.exists() and self.manifest_path.exists():
+            self.load()
+
+    def load(self) -> None:
+        with self.manifest_path.open(mode='r') as f:
+            self.manifest = json.load(f)
+        with np.load(self.index_path, allow_pickle=False) as columns:
+            self.scores = pd.DataFrame({
+                column: columns[column] for column in SCORE_INDEX_COLUMNS
+            })
+
+    def save(self) -> None:
+        temporary_index_path = self.index_path.with_name(f'.{self.index_path.name}.tmp.npz')
+        np.savez(
+            temporary_index_path,
+            model=self.scores['model'].to_numpy(dtype=str),
+            run=self.scores['run'].to_numpy(dtype=np.int32),
+            horizon=self.scores['horizon'].to_numpy(dtype=np.int32),
+            metric=self.scores['metric'].to_numpy(dtype=str),
+            channel=self.scores['channel'].to_numpy(dtype=np.int32),
+            value=self.scores['value'].to_numpy(dtype=np.float64)
+        )
+        os.replace(temporary_index_path, self.index_path)
+
+        temporary_manifest_path = self.manifest_path.with_name(f'.{self.manifest_path.name}.tmp')
+        with temporary_manifest_path.open(mode='w') as f:
+            json.dump(self.manifest, f)
+        os.replace(temporary_manifest_path, self.manifest_path)
+
+    def update(self, score_files: Iterable[Tuple[str, int, pathlib.Path]]) -> int:
+        # Only files whose modification time or size changed are hashed, and
+        # only files whose content hash changed are parsed again. Every score
+        # file has to exist, as when parsing all files directly.
+        stale_keys: List[Tuple[str, int]] = []
+        new_scores: List[pd.DataFrame] = []
+        for model, run, score_file_path in score_files:
+            key = f'{model}/{run}'
+            entry = self.manifest.get(key)
+
+            if not score_file_path.exists():
+                raise FileNotFoundError(f'Score file {score_file_path} of {model} (run {run}) does not exist.')
+
+            stat = score_file_path.stat()
+            if (
+                entry is not None
+                and entry['path'] == str(score_file_path)
+                and entry['mtime_ns'] == stat.st_mtime_ns
+                and entry['size'] == stat.st_size
+            ):
+                continue
+
+            file_hash = compute_file_hash(score_file_path)
+            if entry is None or entry['sha256'] != file_hash:
+                stale_keys.append((model, run))
+                new_scores.append(parse_score_file(model, run, score_file_path))
+
+            self.manifest[key] = {
+                'path': str(score_file_path),
+                'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'sha256': file_hash
+            }
+
+        if len(stale_keys) > 0:
+            stale = pd.MultiIndex.from_tuples(stale_keys, names=['model', 'run'])
+            keep = ~pd.MultiIndex.from_frame(
+                self.scores[['model', 'run']].astype({'run': np.int64})
+            ).isin(stale)
+            self.scores = pd.concat(
+                [self.scores[keep]] + new_scores,
+                ignore_index=True
+            )
+
+        return len(new_scores)
@@ -0,0 +1,142 @@
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+class StreamingStatistics:
+    def __init__(self, reservoir_size: int = 100_000, seed: int = 0):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+        # Quantiles are computed from a uniform reservoir sample of the stream.
+        # They are exact as long as the stream fits into the reservoir.
+        self.reservoir_size = reservoir_size
+        self._reservoir = np.empty(reservoir_size, dtype=np.float64)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n_new = values.shape[0]
+        if n_new == 0:
+            return
+
+        # Merge mean and sum of squared deviations with Chan's parallel update.
+        new_mean = float(np.mean(values))
+        new_m2 = float(np.sum((values - new_mean) ** 2))
+        total = self.count + n_new
+        delta = new_mean - self.mean
+        self.mean += delta * n_new / total
+        self.m2 += new_m2 + delta ** 2 * self.count * n_new / total
+
+        self.minimum = min(self.minimum, float(np.min(values)))
+        self.maximum = max(self.maximum, float(np.max(values)))
+
+        self._update_reservoir(values)
+        self.count = total
+
+    def _update_reservoir(self, values: np.ndarray) -> None:
+        n_free = max(self.reservoir_size - self.count, 0)
+        n_fill = min(n_free, values.shape[0])
+        self._reservoir[self.count:self.count + n_fill] = values[:n_fill]
+
+        remaining = values[n_fill:]
+        if remaining.shape[0] == 0:
+            return
+
+        # Algorithm R: the i-th element of the stream replaces a random
+        # reservoir entry with probability reservoir_size / (i + 1).
+        stream_indices = self.count + n_fill + np.arange(remaining.shape[0])
+        slots = self._rng.integers(0, stream_indices + 1)
+        accepted = slots < self.reservoir_size
+        self._reservoir[slots[accepted]] = remaining[accepted]
+
+    @property
+    def variance(self) -> float:
+        if self.count < 2:
+            return np.nan
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.variance))
+
+    def quantiles(self, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> np.ndarray:
+        if self.count == 0:
+            return np.full(len(quantiles), np.nan)
+        sample = self._reservoir[:min(self.count, self.reservoir_size)]
+        return np.quantile(sample, quantiles)
+
+    def summarize(self, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> Dict[str, float]:
+        summary = {
+            'mean': self.mean if self.count > 0 else np.nan,
+            'std': self.std,
+            'min': self.minimum if self.count > 0 else np.nan,
+            'max': self.maximum if self.count > 0 else np.nan,
+            'count': self.count
+        }
+        for quantile, value in zip(quantiles, self.quantiles(quantiles)):
+            summary[f'q{round(quantile * 100):02d}'] = float(value)
+        return summary
+
+
+def bootstrap_confidence_intervals(
+    values: np.ndarray,
+    n_resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Percentile bootstrap interval of the mean over the first axis (e.g.
+    # repeat runs) for every entry of the remaining axes. All resamples are
+    # drawn at once as counts per run, so the resampled means are a single
+    # matrix product.
+    values = np.asarray(values, dtype=np.float64)
+    n_samples = values.shape[0]
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, n_samples, size=(n_resamples, n_samples))
+    weights = np.zeros((n_resamples, n_samples))
+    np.add.at(weights, (np.arange(n_resamples)[:, np.newaxis], indices), 1.0 / n_samples)
+    means = weights @ values.reshape(n_samples, -1)
+
+    alpha = (1.0 - confidence) / 2.0
+    low, high = np.quantile(means, [alpha, 1.0 - alpha], axis=0)
+    return low.reshape(values.shape[1:]), high.reshape(values.shape[1:])
+
+
+def iterate_sample_blocks(
+    dataset: h5py.Dataset,
+    block_size: Optional[int] = None,
+    target_block_bytes: int = 16 * 1024 * 1024
+) -> Iterator[np.ndarray]:
+    # Read along the sample axis in blocks that cover whole HDF5 chunks,
+    # so every chunk is decompressed exactly once.
+    if dataset.ndim == 0:
+        yield np.asarray(dataset[()])
+        return
+
+    n_samples = dataset.shape[0]
+
+    if block_size is None:
+        sample_bytes = max(int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize, 1)
+        block_size = max(target_block_bytes // sample_bytes, 1)
+        if dataset.chunks is not None:
+            chunk_rows = dataset.chunks[0]
+            block_size = max(block_size // chunk_rows, 1) * chunk_rows
+
+    for start in range(0, n_samples, block_size):
+        yield dataset[start:start + block_size]
+
+
+def reduce_dataset(
+    dataset: h5py.Dataset,
+    block_size: Optional[int] = None
+) -> StreamingStatistics:
+    statistics = StreamingStatistics()
+    for block in iterate_sample_blocks(dataset, block_size=block_size):
+        statistics.update(block)
+    return statistics
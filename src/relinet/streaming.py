@@ -0,0 +1,145 @@
+import dataclasses
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+from relinet.closedform import explain_lpv_rollout
+from relinet.models import Normalization, is_switching_model
+
+StreamIndex = Union[None, int, Sequence[int], np.ndarray]
+
+
+@dataclasses.dataclass
+class StreamingForecast:
+    # Predicted states (stream, horizon, state) in original units.
+    states: np.ndarray
+    # Per-step LPV matrices A_k (stream, horizon, state, state) and
+    # B_k (stream, horizon, state, control) in normalized coordinates.
+    system_matrices: np.ndarray
+    control_matrices: np.ndarray
+    # Explanation of the last predicted state as in relinet.closedform,
+    # weights (stream, state, horizon, control) and intercepts (stream, state).
+    weights_control: np.ndarray
+    intercepts: np.ndarray
+
+
+class StreamingPredictor:
+    """Online inference of switching models for many streams at once.
+
+    The hidden state of the initializer is kept per stream and advanced by a
+    single step for every incoming sample, instead of running the initializer
+    over a full window for every prediction. For a stream that has received
+    exactly window_size samples since its last reset, forecasts equal the
+    prediction from that window. Afterwards, the initializer carries its state
+    over the whole stream.
+    """
+
+    def __init__(self, model, n_streams: int = 1):
+        if not is_switching_model(model):
+            raise ValueError(f'Streaming prediction requires a switching model, got {type(model).__name__}.')
+
+        self.model = model
+        self.n_streams = n_streams
+        self.normalization = Normalization.from_model(model)
+        self.device = model.device
+        model.initializer.eval()
+        model.predictor.eval()
+
+        self.n_steps = np.zeros(n_streams, dtype=np.int64)
+        self._previous_state = torch.zeros(
+            (n_streams, self.normalization.state_mean.shape[0]), device=self.device
+        )
+        # Allocated on the first initializer step, once the hidden state
+        # shape is known. Zero rows equal the default initial state.
+        self._hx: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+
+    def reset(self, stream_indices: StreamIndex = None) -> None:
+        indices = self._resolve(stream_indices)
+        self.n_steps[indices] = 0
+        self._previous_state[indices] = 0.0
+        if self._hx is not None:
+            self._hx[0][:, indices] = 0.0
+            self._hx[1][:, indices] = 0.0
+
+    def update(
+        self,
+        control: np.ndarray,
+        state: np.ndarray,
+        stream_indices: StreamIndex = None
+    ) -> None:
+        # Feeds one sample (stream, channel) of every given stream. As in
+        # relinet.models.build_initial_window, the initializer pairs every
+        # control with the state of the preceding step.
+        indices = self._resolve(stream_indices)
+        control = self._to_tensor(self.normalization.normalize_control(control), len(indices))
+        state = self._to_tensor(self.normalization.normalize_state(state), len(indices))
+
+        started = self.n_steps[indices] > 0
+        if np.any(started):
+            active = indices[started]
+            mask = torch.from_numpy(started).to(self.device)
+            x0 = torch.cat((control[mask], self._previous_state[active]), dim=-1).unsqueeze(1)
+            with torch.no_grad():
+                if self._hx is None:
+                    _, (h, c) = self.model.initializer(x0, return_state=True)
+                    self._hx = (
+                        torch.zeros((h.shape[0], self.n_streams, h.shape[2]), device=self.device),
+                        torch.zeros((c.shape[0], self.n_streams, c.shape[2]), device=self.device)
+                    )
+                else:
+                    _, (h, c) = self.model.initializer(
+                        x0, hx=(self._hx[0][:, active], self._hx[1][:, active]), return_state=True
+                    )
+            self._hx[0][:, active] = h
+            self._hx[1][:, active] = c
+
+        self._previous_state[indices] = state
+        self.n_steps[indices] += 1
+
+    def forecast(
+        self,
+        control: np.ndarray,
+        stream_indices: StreamIndex = None
+    ) -> StreamingForecast:
+        # Predicts the next states for the future controls (stream, horizon, control).
+        indices = self._resolve(stream_indices)
+        if np.any(self.n_steps[indices] == 0):
+            raise ValueError('Cannot forecast streams that have not received a sample.')
+
+        x = self._to_tensor(self.normalization.normalize_control(control), len(indices))
+        y0 = self._previous_state[indices]
+        if self._hx is None:
+            hx = None
+        else:
+            hx = (self._hx[0][:, indices].contiguous(), self._hx[1][:, indices].contiguous())
+
+        with torch.no_grad():
+            output = self.model.predictor(x, previous_output=y0, hx=hx)
+            weights_control, intercepts = explain_lpv_rollout(
+                self.normalization, y0, output.system_matrices, output.control_matrices
+            )
+
+        return StreamingForecast(
+            states=self.normalization.denormalize_state(output.outputs.cpu().numpy().astype(np.float64)),
+            system_matrices=output.system_matrices.cpu().numpy(),
+            control_matrices=output.control_matrices.cpu().numpy(),
+            weights_control=weights_control,
+            intercepts=intercepts
+        )
+
+    def _resolve(self, stream_indices: StreamIndex) -> np.ndarray:
+        if stream_indices is None:
+            return np.arange(self.n_streams)
+        indices = np.atleast_1d(np.asarray(stream_indices, dtype=np.int64))
+        if np.any((indices < 0) | (indices >= self.n_streams)):
+            raise IndexError(f'Stream index out of range for {self.n_streams} streams.')
+        if len(np.unique(indices)) != len(indices):
+            raise ValueError('Stream indices have to be unique.')
+        return indices
+
+    def _to_tensor(self, array: np.ndarray, n_streams: int) -> torch.Tensor:
+        tensor = torch.from_numpy(np.asarray(array)).float().to(self.device)
+        if tensor.shape[0] != n_streams:
+            raise ValueError(f'Expected samples for {n_streams} streams, got {tensor.shape[0]}.')
+        return tensor
@@ -0,0 +1,228 @@
+import contextlib
+import dataclasses
+import functools
+import json
+import math
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Sequence
+
+import pandas as pd
+
+PROC_STATM_PATH = '/proc/self/statm'
+# Unit of ru_maxrss: bytes on macOS, kilobytes on Linux and the BSDs.
+MAXRSS_UNIT_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+
+@dataclasses.dataclass
+class StageRecord:
+    experiment: str
+    model_name: str
+    stage: str
+    run_idx: int
+    start_time: float
+    duration: float
+    peak_rss_mb: float
+    success: bool
+
+
+def get_telemetry_path(report_path: pathlib.Path) -> pathlib.Path:
+    return report_path.with_name(f'{report_path.stem}.telemetry.jsonl')
+
+
+@functools.lru_cache(maxsize=None)
+def get_page_size() -> int:
+    # SC_PAGE_SIZE does not exist on Windows, so it is only queried on first use.
+    return os.sysconf('SC_PAGE_SIZE')
+
+
+def is_rss_available() -> bool:
+    return os.path.exists(PROC_STATM_PATH)
+
+
+def read_current_rss_mb() -> float:
+    # NaN where /proc is not available, e.g. on Windows and macOS.
+    if not is_rss_available():
+        return math.nan
+    with open(PROC_STATM_PATH, mode='r') as f:
+        return int(f.read().split()[1]) * get_page_size() / 1024.0 ** 2
+
+
+class _RssSampler(threading.Thread):
+    # ru_maxrss is the peak of the whole process lifetime, so the peak of a
+    # single in-process stage is sampled from /proc while the stage runs.
+    # Without /proc, nothing is sampled and the peak is NaN.
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.enabled = is_rss_available()
+        self.peak_rss_mb = read_current_rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        if not self.enabled:
+            return
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, read_current_rss_mb())
+
+    def stop(self) -> float:
+        self._stop_event.set()
+        self.join()
+        if self.enabled:
+            self.peak_rss_mb = max(self.peak_rss_mb, read_current_rss_mb())
+        return self.peak_rss_mb
+
+
+class TelemetryRecorder:
+    def __init__(
+        self,
+        telemetry_path: pathlib.Path,
+        experiment: str,
+        profile_directory: Optional[pathlib.Path] = None,
+        rss_sample_interval: float = 0.1
+    ):
+        self.telemetry_path = telemetry_path
+        self.experiment = experiment
+        self.profile_directory = profile_directory
+        self.rss_sample_interval = rss_sample_interval
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Recorders are handed to spawned worker processes, locks cannot be pickled.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, record: StageRecord) -> None:
+        # One JSON object per line, appended with a single write. Records of
+        # concurrent workers and processes therefore never interleave.
+        line = json.dumps(dataclasses.asdict(record)) + '\n'
+        with self._lock:
+            with self.telemetry_path.open(mode='a') as f:
+                f.write(line)
+
+    @contextlib.contextmanager
+    def stage(self, model_name: str, stage: str, run_idx: int = 0) -> Iterator[None]:
+        sampler = _RssSampler(self.rss_sample_interval)
+        sampler.start()
+        start_time = time.time()
+        start_counter = time.perf_counter()
+        success = False
+        try:
+            with self._profile(model_name, stage, run_idx):
+                yield
+            success = True
+        finally:
+            self.record(StageRecord(
+                experiment=self.experiment,
+                model_name=model_name,
+                stage=stage,
+                run_idx=run_idx,
+                start_time=start_time,
+                duration=time.perf_counter() - start_counter,
+                peak_rss_mb=sampler.stop(),
+                success=success
+            ))
+
+    @contextlib.contextmanager
+    def _profile(self, model_name: str, stage: str, run_idx: int) -> Iterator[None]:
+        if self.profile_directory is None:
+            yield
+            return
+
+        import torch.profiler
+
+        self.profile_directory.mkdir(parents=True, exist_ok=True)
+        with torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU],
+            record_shapes=False
+        ) as profiler:
+            yield
+        profiler.export_chrome_trace(str(
+            self.profile_directory.joinpath(f'{model_name}-{stage}-{run_idx}.json')
+        ))
+
+    def run_command(
+        self,
+        model_name: str,
+        stage: str,
+        command: Sequence[str],
+        env: Optional[Dict[str, str]] = None,
+        preexec_fn: Optional[Callable[[], Any]] = None,
+        run_idx: int = 0
+    ) -> int:
+        # The resource usage returned by wait4 belongs to this child alone,
+        # which gives the peak RSS of the subprocess. Where wait4 does not
+        # exist, e.g. on Windows, the peak is NaN.
+        start_time = time.time()
+        start_counter = time.perf_counter()
+        process = subprocess.Popen(command, env=env, preexec_fn=preexec_fn)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+            peak_rss_mb = usage.ru_maxrss * MAXRSS_UNIT_BYTES / 1024.0 ** 2
+        else:
+            process.wait()
+            peak_rss_mb = math.nan
+        self.record(StageRecord(
+            experiment=self.experiment,
+            model_name=model_name,
+            stage=stage,
+            run_idx=run_idx,
+            start_time=start_time,
+            duration=time.perf_counter() - start_counter,
+            peak_rss_mb=peak_rss_mb,
+            success=process.returncode == 0
+        ))
+        return process.returncode
+
+
+def optional_stage(
+    telemetry: Optional[TelemetryRecorder],
+    model_name: str,
+    stage: str,
+    run_idx: int = 0
+) -> ContextManager[None]:
+    if telemetry is None:
+        return contextlib.nullcontext()
+    return telemetry.stage(model_name, stage, run_idx=run_idx)
+
+
+def read_telemetry(telemetry_path: pathlib.Path) -> pd.DataFrame:
+    columns = [field.name for field in dataclasses.fields(StageRecord)]
+    if not telemetry_path.exists():
+        return pd.DataFrame(columns=columns)
+
+    records: List[Dict[str, Any]] = []
+    with telemetry_path.open(mode='r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                records.append(json.loads(line))
+    return pd.DataFrame(records, columns=columns)
+
+
+def summarize_costs(telemetry: pd.DataFrame, experiment: str) -> pd.DataFrame:
+    telemetry = telemetry[telemetry['experiment'] == experiment]
+    return telemetry\
+        .groupby(['model_name', 'stage'])\
+        .agg(
+            count=('duration', 'count'),
+            failures=('success', lambda success: int((~success.astype(bool)).sum())),
+            total_seconds=('duration', 'sum'),
+            mean_seconds=('duration', 'mean'),
+            max_seconds=('duration', 'max'),
+            peak_rss_mb=('peak_rss_mb', 'max')
+        )\
+        .reset_index()
@@ -0,0 +1,323 @@
+import dataclasses
+import multiprocessing
+import os
+import pathlib
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+from deepsysid.pipeline.configuration import ExperimentConfiguration
+from deepsysid.pipeline.data_io import build_result_file_name
+from deepsysid.pipeline.evaluation import evaluate_model
+from deepsysid.pipeline.testing.runner import test_model
+
+from relinet.datasets import install_split_cache_loader
+from relinet.predictioncache import PredictionCache, hash_dataset_split, hash_model_directory, list_files
+from relinet.telemetry import TelemetryRecorder, optional_stage
+from relinet.utils import stage_dataset_in_memory
+
+_worker_configuration: Optional[ExperimentConfiguration] = None
+_worker_telemetry: Optional[TelemetryRecorder] = None
+_worker_prediction_cache: Optional[PredictionCache] = None
+_worker_dataset_hash: Optional[str] = None
+
+# Group of the test result files of deepsysid that holds the predictions of
+# the test windows, one dataset per window in predicted/{i} and true/{i}.
+TEST_RESULT_GROUP = 'main'
+
+
+@dataclasses.dataclass
+class TestRunResult:
+    model_name: str
+    run_idx: int
+    success: bool
+    error: Optional[str] = None
+    cached: bool = False
+
+
+def build_run_directories(
+    run_idx: int,
+    result_directory: str,
+    models_directory: str
+) -> Tuple[str, str]:
+    # The first run lives at the top level, repeats in repeat-{run_idx}.
+    if run_idx == 0:
+        return result_directory, models_directory
+    return (
+        os.path.join(result_directory, f'repeat-{run_idx}'),
+        os.path.join(models_directory, f'repeat-{run_idx}')
+    )
+
+
+def build_test_prediction_path(
+    result_directory: pathlib.Path,
+    model_name: str,
+    mode: str,
+    window_size: int,
+    horizon_size: int
+) -> pathlib.Path:
+    return result_directory.joinpath(model_name).joinpath(
+        build_result_file_name(mode, window_size, horizon_size, 'hdf5')
+    )
+
+
+def iterate_test_predictions(
+    prediction_path: pathlib.Path,
+    batch_size: int = 256
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # Batches of (true_state, predicted_state) of shape (window, horizon, state)
+    # from a test result file of deepsysid, in the order of the file.
+    with h5py.File(prediction_path, mode='r') as f:
+        group = f[TEST_RESULT_GROUP]
+        n_windows = len(group['predicted'])
+        for start in range(0, n_windows, batch_size):
+            indices = range(start, min(start + batch_size, n_windows))
+            yield (
+                np.stack([group['true'][str(idx)][:] for idx in indices]),
+                np.stack([group['predicted'][str(idx)][:] for idx in indices])
+            )
+
+
+def build_test_window_starts(length: int, window_size: int, horizon_size: int) -> np.ndarray:
+    # Windows of a trajectory as split by deepsysid's test: non-overlapping,
+    # from the first step, and only while steps remain after the window.
+    window_length = window_size + horizon_size
+    return np.arange(0, length - window_length, window_length, dtype=np.int64)
+
+
+def iterate_test_windows(
+    prediction_path: pathlib.Path,
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    sequence_names: Sequence[str],
+    window_size: int,
+    horizon_size: int,
+    batch_size: int = 256
+) -> Iterator[Tuple[np.ndarray, ...]]:
+    # Batches of (initial_control, initial_state, control, true_state,
+    # predicted_state) of the windows of a deepsysid test result file, in the
+    # order of the file, where predicted_state is the prediction of the test
+    # run. The windows are rebuilt from the trajectories, matched to the file
+    # by the trajectory file name of every window.
+    sequences = {
+        pathlib.Path(name).stem: (control, state)
+        for name, control, state in zip(sequence_names, control_seqs, state_seqs)
+    }
+    window_starts = {
+        stem: iter(build_test_window_starts(control.shape[0], window_size, horizon_size))
+        for stem, (control, _) in sequences.items()
+    }
+
+    with h5py.File(prediction_path, mode='r') as f:
+        group = f[TEST_RESULT_GROUP]
+        file_names = [
+            pathlib.Path(name.decode('utf-8') if isinstance(name, bytes) else str(name)).stem
+            for name in group['file_names'][:]
+        ]
+        for batch_start in range(0, len(file_names), batch_size):
+            batch = ([], [], [], [], [])
+            for idx in range(batch_start, min(batch_start + batch_size, len(file_names))):
+                if file_names[idx] not in sequences:
+                    raise ValueError(f'Trajectory {file_names[idx]} of {prediction_path} is not in the dataset.')
+                start = next(window_starts[file_names[idx]], None)
+                if start is None:
+                    raise ValueError(f'{prediction_path} has more windows of {file_names[idx]} than expected.')
+                control, state = sequences[file_names[idx]]
+                middle = start + window_size
+                true_state = group['true'][str(idx)][:]
+                if not np.allclose(true_state, state[middle:middle + horizon_size]):
+                    raise ValueError(
+                        f'Window {idx} of {prediction_path} does not match the dataset, '
+                        f'the test windows differ from those of deepsysid.'
+                    )
+                batch[0].append(control[start:middle])
+                batch[1].append(state[start:middle])
+                batch[2].append(control[middle:middle + horizon_size])
+                batch[3].append(true_state)
+                batch[4].append(group['predicted'][str(idx)][:])
+            yield tuple(np.stack(arrays) for arrays in batch)
+
+
+class TestPredictionWriter:
+    """Writes predictions in the layout of a deepsysid test result file.
+
+    The reference file of a deepsysid test run is copied to target_path and
+    its predictions are replaced window by window, so deepsysid's
+    evaluate_model scores the new predictions on exactly the same windows.
+    """
+
+    def __init__(self, reference_path: pathlib.Path, target_path: pathlib.Path):
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(reference_path, target_path)
+        self.target_path = target_path
+        self._file = h5py.File(target_path, mode='r+')
+        self._predicted = self._file[TEST_RESULT_GROUP]['predicted']
+        self.n_windows = len(self._predicted)
+        self.position = 0
+
+    def __enter__(self) -> 'TestPredictionWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._file.close()
+        if exc_type is None and self.position != self.n_windows:
+            raise ValueError(f'Expected {self.n_windows} predictions, received {self.position}.')
+
+    def write(self, predicted_state: np.ndarray) -> None:
+        for prediction in predicted_state:
+            self._predicted[str(self.position)][...] = prediction
+            self.position += 1
+
+
+def _initialize_worker(
+    configuration: ExperimentConfiguration,
+    telemetry: Optional[TelemetryRecorder],
+    prediction_cache: Optional[PredictionCache] = None,
+    dataset_hash: Optional[str] = None
+) -> None:
+    global _worker_configuration, _worker_telemetry, _worker_prediction_cache, _worker_dataset_hash
+    install_split_cache_loader()
+    _worker_configuration = configuration
+    _worker_telemetry = telemetry
+    _worker_prediction_cache = prediction_cache
+    _worker_dataset_hash = dataset_hash
+
+
+def _test_model_with_cache(
+    model_name: str,
+    run_idx: int,
+    device_name: str,
+    mode: str,
+    dataset_directory: str,
+    result_directory: str,
+    models_directory: str
+) -> bool:
+    # Restores the prediction files of an earlier test of the same model
+    # artifacts on the same split, or tests the model and caches the files
+    # the test wrote. Returns whether the predictions came from the cache.
+    key = None
+    model_result_directory = pathlib.Path(result_directory).joinpath(model_name)
+    if _worker_prediction_cache is not None:
+        key = PredictionCache.build_key(
+            model_name,
+            hash_model_directory(pathlib.Path(models_directory).joinpath(model_name)),
+            _worker_dataset_hash,
+            _worker_configuration.window_size,
+            _worker_configuration.horizon_size,
+            mode
+        )
+        cached_files = _worker_prediction_cache.load(key)
+        if cached_files is not None:
+            model_result_directory.mkdir(parents=True, exist_ok=True)
+            for name, content in cached_files.items():
+                model_result_directory.joinpath(name).write_bytes(content)
+            return True
+
+    previous_files = list_files(model_result_directory)
+    with optional_stage(_worker_telemetry, model_name, mode, run_idx):
+        test_model(
+            model_name=model_name,
+            configuration=_worker_configuration,
+            device_name=device_name,
+            mode=mode,
+            dataset_directory=dataset_directory,
+            result_directory=result_directory,
+            models_directory=models_directory
+        )
+
+    if key is not None:
+        _worker_prediction_cache.store(key, {
+            name: model_result_directory.joinpath(name).read_bytes()
+            for name, mtime_ns in list_files(model_result_directory).items()
+            if previous_files.get(name) != mtime_ns
+        })
+    return False
+
+
+def _run_test(
+    model_name: str,
+    run_idx: int,
+    device_name: str,
+    mode: str,
+    dataset_directory: str,
+    result_directory: str,
+    models_directory: str
+) -> TestRunResult:
+    result_directory, models_directory = build_run_directories(
+        run_idx, result_directory, models_directory
+    )
+    try:
+        cached = _test_model_with_cache(
+            model_name, run_idx, device_name, mode, dataset_directory, result_directory, models_directory
+        )
+        with optional_stage(_worker_telemetry, model_name, 'evaluate', run_idx):
+            evaluate_model(
+                model_name=model_name,
+                config=_worker_configuration,
+                mode=mode,
+                result_directory=result_directory,
+                models_directory=models_directory
+            )
+    except Exception:
+        return TestRunResult(model_name, run_idx, success=False, error=traceback.format_exc())
+
+    return TestRunResult(model_name, run_idx, success=True, cached=cached)
+
+
+def run_parallel_tests(
+    models: Sequence[str],
+    n_runs: int,
+    configuration: ExperimentConfiguration,
+    environment: Dict[str, str],
+    device_names: Sequence[str],
+    n_workers: int,
+    mode: str = 'test',
+    telemetry: Optional[TelemetryRecorder] = None,
+    prediction_cache: Optional[PredictionCache] = None
+) -> List[TestRunResult]:
+    tasks = [
+        (model, run_idx)
+        for model in sorted(models)
+        for run_idx in range(n_runs)
+    ]
+
+    dataset_hash = None
+    if prediction_cache is not None:
+        dataset_hash = hash_dataset_split(pathlib.Path(environment['DATASET_DIRECTORY']), mode)
+
+    results = []
+    with stage_dataset_in_memory(
+        pathlib.Path(environment['DATASET_DIRECTORY']), splits=[mode]
+    ) as dataset_directory:
+        # CUDA cannot be re-initialized in forked processes.
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize_worker,
+            initargs=(configuration, telemetry, prediction_cache, dataset_hash)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _run_test,
+                    model,
+                    run_idx,
+                    device_names[task_idx % len(device_names)],
+                    mode,
+                    str(dataset_directory),
+                    environment['RESULT_DIRECTORY'],
+                    environment['MODELS_DIRECTORY']
+                )
+                for task_idx, (model, run_idx) in enumerate(tasks)
+            ]
+            for task_idx, future in enumerate(futures):
+                result = future.result()
+                results.append(result)
+                print(
+                    f'Finished test run {result.run_idx + 1}/{n_runs} of {result.model_name} '
+                    f'({task_idx + 1}/{len(tasks)}{", cached predictions" if result.cached else ""}).'
+                )
+
+    return results
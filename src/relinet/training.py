@@ -0,0 +1,472 @@
+import dataclasses
+import importlib
+import inspect
+import json
+import os
+import pathlib
+import re
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import torch
+from deepsysid.pipeline.configuration import ExperimentConfiguration, initialize_model
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from relinet.checkpoints import TRAINING_PHASES, CheckpointManager, CheckpointSettings, get_checkpoint_directory
+from relinet.datasets import hash_sequences
+from relinet.initializers import (
+    InitializerCache,
+    describe_lstm_sizes,
+    get_initializer_cache_directory,
+    grow_initializer
+)
+from relinet.models import (
+    RECURRENT_MODEL_CLASSES,
+    Normalization,
+    build_initializer_windows,
+    build_predictor_windows,
+    is_recurrent_model,
+    is_switching_model,
+    predict_normalized
+)
+
+# JSON encoded TrainingSettings of the deepsysid jobs run by relinet.cachedcli.
+TRAINING_SETTINGS_VARIABLE = 'RELINET_TRAINING_SETTINGS'
+# deepsysid modules that import train_model by name and call it: the session
+# manager of the gridsearch and the command line interface of `deepsysid train`.
+TRAIN_MODEL_CALL_SITES = ('deepsysid.pipeline.gridsearch', 'deepsysid.cli.interface')
+
+_settings: Optional['TrainingSettings'] = None
+_job: Optional['TrainingJob'] = None
+# Model classes whose initializer records its constructor arguments.
+_recorded_model_classes: Set[str] = set()
+
+
+def _capture_random_state() -> Dict:
+    return dict(
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    )
+
+
+def _restore_random_state(state: Dict) -> None:
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) > 0:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def derive_run_seed(seed: int, run_idx: int) -> int:
+    return int(np.random.SeedSequence([seed, run_idx]).generate_state(1)[0])
+
+
+def derive_training_seeds(seed: int) -> Dict[str, int]:
+    # Seeds of the initial initializer weights and of every training phase of a job.
+    names = ['initial_initializer'] + TRAINING_PHASES
+    return dict(zip(names, (int(state) for state in np.random.SeedSequence(seed).generate_state(len(names)))))
+
+
+def parse_run_index(models_directory: pathlib.Path) -> int:
+    # Inverse of build_run_directories.
+    match = re.match(r'^repeat-(\d+)$', models_directory.name)
+    return 0 if match is None else int(match.group(1))
+
+
+def describe_training(model) -> Dict[str, Any]:
+    # Everything the training of a recurrent model depends on besides its
+    # initial weights, the random state and the training data.
+    return dict(
+        model_class=f'{type(model).__module__}.{type(model).__qualname__}',
+        initializer=repr(model.initializer),
+        predictor=repr(model.predictor),
+        loss=repr(model.loss),
+        batch_size=model.batch_size,
+        learning_rate=model.learning_rate,
+        sequence_length=model.sequence_length,
+        epochs_initializer=model.epochs_initializer,
+        epochs_predictor=model.epochs_predictor
+    )
+
+
+def build_training_fingerprint(
+    job: 'TrainingJob',
+    model,
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray]
+) -> Dict[str, Any]:
+    return dict(
+        model_name=job.model_name,
+        run_idx=job.run_idx,
+        seed=job.seed,
+        training=describe_training(model),
+        data=[hash_sequences(control_seqs), hash_sequences(state_seqs)]
+    )
+
+
+def _get_optimizer(model, name: str, module: nn.Module) -> torch.optim.Optimizer:
+    optimizer = getattr(model, name, None)
+    if optimizer is None:
+        optimizer = torch.optim.Adam(module.parameters(), lr=model.learning_rate)
+    return optimizer
+
+
+def _record_arguments(module_class: type) -> None:
+    # Instances of module_class keep their constructor arguments in
+    # relinet_arguments, so draw_initializer can construct them anew.
+    original = module_class.__init__
+    if getattr(original, 'records_relinet_arguments', False):
+        return
+
+    def __init__(self, *args, **kwargs):
+        original(self, *args, **kwargs)
+        if type(self).__init__ is __init__:
+            self.relinet_arguments = (args, kwargs)
+
+    __init__.records_relinet_arguments = True
+    module_class.__init__ = __init__
+
+
+def _record_initializer_arguments(
+    configuration: ExperimentConfiguration,
+    model_name: str,
+    device_name: str
+) -> None:
+    # The initializer class of a model class is found from a model that is
+    # constructed once per process, before the job is seeded.
+    model_class = configuration.models[model_name].model_class
+    if model_class in _recorded_model_classes:
+        return
+    _recorded_model_classes.add(model_class)
+    model = initialize_model(configuration, model_name, device_name)
+    if is_recurrent_model(model):
+        _record_arguments(type(model.initializer))
+
+
+def draw_initializer(model, seed: int) -> bool:
+    # Draws the initial weights of the initializer from seed with the
+    # initialization of its class, so they do not depend on the predictor of
+    # the model class. Returns False if its constructor arguments are unknown.
+    arguments = getattr(model.initializer, 'relinet_arguments', None)
+    if arguments is None:
+        return False
+    args, kwargs = arguments
+    torch.manual_seed(seed)
+    model.initializer.load_state_dict(type(model.initializer)(*args, **kwargs).state_dict())
+    return True
+
+
+def _load_cached_initializer(
+    model,
+    optimizer_init: torch.optim.Optimizer,
+    initializer_cache: InitializerCache,
+    windows: Sequence[np.ndarray],
+    seed: int,
+    epochs: int
+) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    # Restores the initializer phase from its cache entry. With warm start,
+    # an initializer without an entry is first grown from the largest smaller
+    # initializer of its family. Returns family, key and the entry, if any.
+    hyperparameters = dict(
+        loss=repr(model.loss),
+        optimizer=repr(optimizer_init),
+        batch_size=model.batch_size,
+        sequence_length=model.sequence_length,
+        device_type=torch.device(model.device).type
+    )
+    family = initializer_cache.build_family(model.initializer, hyperparameters, hash_sequences(windows), seed)
+    key = initializer_cache.build_key(family, model.initializer)
+    entry, cached_epochs = initializer_cache.load(family, key, epochs)
+    if entry is None and initializer_cache.warm_start:
+        source = initializer_cache.find_smaller(family, model.initializer)
+        if source is not None:
+            print(f'Warm starting the initializer from one with LSTM sizes {source["lstm_sizes"]}.')
+            grow_initializer(model.initializer, source['parameters'])
+            key = initializer_cache.build_key(family, model.initializer)
+            entry, cached_epochs = initializer_cache.load(family, key, epochs)
+    if entry is not None:
+        print(f'Reusing the initializer trained for {cached_epochs}/{epochs} epochs.')
+        model.initializer.load_state_dict(entry['parameters'])
+        optimizer_init.load_state_dict(entry['optimizer'])
+        _restore_random_state(entry['random'])
+    return family, key, entry
+
+
+def train_recurrent_model(
+    model,
+    control_seqs: Sequence[np.ndarray],
+    state_seqs: Sequence[np.ndarray],
+    checkpoints: Optional[CheckpointManager] = None,
+    seeds: Optional[Dict[str, int]] = None,
+    initializer_cache: Optional[InitializerCache] = None
+) -> Dict[str, np.ndarray]:
+    # deepsysid's training of LSTM+Init and switching models with epoch
+    # checkpoints. It trains on the same windows with the model's optimizers
+    # and a new shuffled DataLoader per epoch, so batches and dropout masks are
+    # drawn from torch's generator in the same order as in model.train. With
+    # checkpoints, training resumes from the latest checkpoint, including the
+    # random state, and continues as if it had not been interrupted.
+    # With seeds (see derive_training_seeds), torch is seeded at the start of
+    # each phase, so the initializer phase does not depend on the model class
+    # and can be restored from initializer_cache.
+    if initializer_cache is not None and seeds is None:
+        raise ValueError('The initializer cache requires seeded training phases.')
+    device = model.device
+    switching = is_switching_model(model)
+    model.initializer.train()
+    model.predictor.train()
+
+    normalization = Normalization.from_sequences(control_seqs, state_seqs)
+    normalization.apply_to(model)
+    control_seqs = [normalization.normalize_control(control) for control in control_seqs]
+    state_seqs = [normalization.normalize_state(state) for state in state_seqs]
+    optimizer_init = _get_optimizer(model, 'optimizer_init', model.initializer)
+    optimizer_pred = _get_optimizer(model, 'optimizer_pred', model.predictor)
+
+    def initializer_step(x: torch.Tensor, y: torch.Tensor) -> float:
+        model.initializer.zero_grad()
+        batch_loss = model.loss.forward(model.initializer.forward(x), y)
+        batch_loss.backward()
+        optimizer_init.step()
+        return batch_loss.item()
+
+    def predictor_step(x0: torch.Tensor, y0: torch.Tensor, x: torch.Tensor, y: torch.Tensor) -> float:
+        # As in deepsysid, the initializer is not frozen, but only the
+        # predictor is optimized.
+        model.predictor.zero_grad()
+        prediction = predict_normalized(model.initializer, model.predictor, switching, x0, x, y0)
+        batch_loss = model.loss.forward(prediction, y)
+        batch_loss.backward()
+        optimizer_pred.step()
+        return batch_loss.item()
+
+    phases = dict(
+        initializer=(
+            model.epochs_initializer,
+            build_initializer_windows(control_seqs, state_seqs, model.sequence_length),
+            initializer_step
+        ),
+        predictor=(
+            model.epochs_predictor,
+            build_predictor_windows(control_seqs, state_seqs, model.sequence_length),
+            predictor_step
+        )
+    )
+    losses: Dict[str, List[List[float]]] = {phase: [] for phase in TRAINING_PHASES}
+    training_time = {phase: 0.0 for phase in TRAINING_PHASES}
+    start_epochs = {phase: 0 for phase in TRAINING_PHASES}
+    # Family and key of the initializer in initializer_cache.
+    cached_initializer: Optional[List[str]] = None
+
+    checkpoint = None if checkpoints is None else checkpoints.load_latest()
+    if checkpoint is not None:
+        print(
+            f'Resuming training after {checkpoint["phase"]} epoch '
+            f'{checkpoint["epoch"] + 1}/{phases[checkpoint["phase"]][0]}.'
+        )
+        state = checkpoint['state']
+        model.initializer.load_state_dict(state['initializer'])
+        model.predictor.load_state_dict(state['predictor'])
+        optimizer_init.load_state_dict(state['optimizer_init'])
+        optimizer_pred.load_state_dict(state['optimizer_pred'])
+        losses = state['losses']
+        training_time = state['training_time']
+        _restore_random_state(state['random'])
+        cached_initializer = state.get('cached_initializer')
+        for phase in TRAINING_PHASES[:TRAINING_PHASES.index(checkpoint['phase'])]:
+            start_epochs[phase] = phases[phase][0]
+        start_epochs[checkpoint['phase']] = checkpoint['epoch'] + 1
+
+    for phase in TRAINING_PHASES:
+        epochs, windows, step = phases[phase]
+        if seeds is not None and start_epochs[phase] == 0:
+            torch.manual_seed(seeds[phase])
+            if phase == 'initializer' and initializer_cache is not None:
+                family, key, entry = _load_cached_initializer(
+                    model, optimizer_init, initializer_cache, windows, seeds[phase], epochs
+                )
+                cached_initializer = [family, key]
+                if entry is not None:
+                    losses[phase] = entry['losses']
+                    training_time[phase] = entry['training_time']
+                    start_epochs[phase] = len(entry['losses'])
+
+        dataset = TensorDataset(*(torch.from_numpy(array) for array in windows))
+        for epoch in range(start_epochs[phase], epochs):
+            start_time = time.time()
+            total_loss = 0.0
+            for batch in DataLoader(dataset, model.batch_size, shuffle=True, drop_last=True):
+                total_loss += step(*(tensor.float().to(device) for tensor in batch))
+            losses[phase].append([epoch, total_loss])
+            training_time[phase] += time.time() - start_time
+
+            if checkpoints is not None and checkpoints.should_save(epoch, epochs):
+                checkpoints.save(phase, epoch, dict(
+                    initializer=model.initializer.state_dict(),
+                    predictor=model.predictor.state_dict(),
+                    optimizer_init=optimizer_init.state_dict(),
+                    optimizer_pred=optimizer_pred.state_dict(),
+                    losses=losses,
+                    training_time=training_time,
+                    random=_capture_random_state(),
+                    cached_initializer=cached_initializer
+                ))
+
+        if (
+            phase == 'initializer' and initializer_cache is not None
+            and cached_initializer is not None and start_epochs[phase] < epochs
+        ):
+            family, key = cached_initializer
+            initializer_cache.store(family, key, epochs, dict(
+                parameters=model.initializer.state_dict(),
+                optimizer=optimizer_init.state_dict(),
+                losses=losses[phase],
+                training_time=training_time[phase],
+                random=_capture_random_state(),
+                lstm_sizes=describe_lstm_sizes(model.initializer)
+            ))
+
+    return dict(
+        epoch_loss_initializer=np.array(losses['initializer']),
+        epoch_loss_predictor=np.array(losses['predictor']),
+        training_time_initializer=np.array([training_time['initializer']]),
+        training_time_predictor=np.array([training_time['predictor']])
+    )
+
+
+@dataclasses.dataclass
+class TrainingSettings:
+    # If set, every training job is seeded once from seed and its run index,
+    # before deepsysid initializes the model. Otherwise jobs are not seeded,
+    # as in deepsysid.
+    seed: Optional[int] = None
+    checkpoints: Optional[CheckpointSettings] = None
+    # Trained initializers are shared through InitializerCache in the models
+    # directory. The initializer is then drawn and trained from seeds of its
+    # own, which changes the trained models.
+    initializer_cache: bool = False
+    # Initializers without a cache entry start from a smaller one, which
+    # changes the trained models.
+    warm_start: bool = False
+
+    def __post_init__(self):
+        if self.warm_start and not self.initializer_cache:
+            raise ValueError('Warm start requires the initializer cache.')
+        if self.initializer_cache and self.seed is None:
+            raise ValueError('The initializer cache requires a seed.')
+
+    def build_environment(self, environment: Dict[str, str]) -> Dict[str, str]:
+        env = environment.copy()
+        env[TRAINING_SETTINGS_VARIABLE] = json.dumps(dataclasses.asdict(self))
+        return env
+
+    @classmethod
+    def from_environment(cls, environment: Mapping[str, str]) -> Optional['TrainingSettings']:
+        if TRAINING_SETTINGS_VARIABLE not in environment:
+            return None
+        settings = json.loads(environment[TRAINING_SETTINGS_VARIABLE])
+        if settings['checkpoints'] is not None:
+            settings['checkpoints'] = CheckpointSettings(**settings['checkpoints'])
+        return cls(**settings)
+
+
+@dataclasses.dataclass
+class TrainingJob:
+    model_name: str
+    # Models directory of the run, repeats are in repeat-{run_idx}.
+    models_directory: pathlib.Path
+    run_idx: int
+    seed: Optional[int]
+    checkpoints: Optional[CheckpointManager] = None
+
+
+def _train_with_settings(
+    model,
+    control_seqs: List[np.ndarray],
+    state_seqs: List[np.ndarray],
+    original_train: Callable
+):
+    job = _job
+    if job is None or _settings is None:
+        return original_train(model, control_seqs=control_seqs, state_seqs=state_seqs)
+
+    # Checkpoints only save and restore the state of the job, the model keeps
+    # the initial weights of deepsysid's initialization. Only the initializer
+    # cache draws the initializer and seeds every phase, so the initializer
+    # phase does not depend on the model class.
+    seeds = None
+    initializer_cache = None
+    if _settings.initializer_cache:
+        seeds = derive_training_seeds(job.seed)
+        draw_initializer(model, seeds['initial_initializer'])
+        # Shared by all runs, which are stored below the models directory.
+        models_root = pathlib.Path(os.environ.get('MODELS_DIRECTORY', job.models_directory))
+        initializer_cache = InitializerCache(get_initializer_cache_directory(models_root), _settings.warm_start)
+    if _settings.checkpoints is not None:
+        job.checkpoints = CheckpointManager(
+            get_checkpoint_directory(job.models_directory, job.model_name),
+            fingerprint=build_training_fingerprint(job, model, control_seqs, state_seqs),
+            settings=_settings.checkpoints
+        )
+    return train_recurrent_model(model, control_seqs, state_seqs, job.checkpoints, seeds, initializer_cache)
+
+
+def _build_train_method(original_train: Callable) -> Callable:
+    def train(self, control_seqs: List[np.ndarray], state_seqs: List[np.ndarray]):
+        return _train_with_settings(self, control_seqs, state_seqs, original_train)
+
+    train.uses_relinet_training = True
+    return train
+
+
+def install_relinet_training() -> None:
+    # Applies the TrainingSettings in the environment to deepsysid's training
+    # jobs. With a seed, every call of deepsysid's train_model is seeded from
+    # its run, and the recurrent models train with train_recurrent_model. The
+    # callers of train_model import it by name, so it is replaced in each of
+    # TRAIN_MODEL_CALL_SITES.
+    global _settings
+    _settings = TrainingSettings.from_environment(os.environ)
+    if _settings is None:
+        return
+
+    from deepsysid.pipeline import training
+
+    original = training.train_model
+    if getattr(original, 'uses_relinet_training', False):
+        return
+    signature = inspect.signature(original)
+
+    def train_model(*args, **kwargs):
+        global _job
+        arguments = signature.bind(*args, **kwargs).arguments
+        models_directory = pathlib.Path(arguments['models_directory'])
+        run_idx = parse_run_index(models_directory)
+        _job = TrainingJob(
+            model_name=arguments['model_name'],
+            models_directory=models_directory,
+            run_idx=run_idx,
+            seed=None if _settings.seed is None else derive_run_seed(_settings.seed, run_idx)
+        )
+
+        if _settings.initializer_cache:
+            _record_initializer_arguments(
+                arguments['configuration'], arguments['model_name'], arguments['device_name']
+            )
+        if _job.seed is not None:
+            torch.manual_seed(_job.seed)
+        try:
+            result = original(*args, **kwargs)
+            if _job.checkpoints is not None:
+                # deepsysid has saved the trained model.
+                _job.checkpoints.clear()
+            return result
+        finally:
+            _job = None
+
+    train_model.uses_relinet_training = True
+    for module_name in TRAIN_MODEL_CALL_SITES:
+        importlib.import_module(module_name).train_model = train_model
+    for model_class in RECURRENT_MODEL_CLASSES:
+        if 'train' in vars(model_class) and not getattr(model_class.train, 'uses_relinet_training', False):
+            model_class.train = _build_train_method(vars(model_class)['train'])
@@ -1,10 +1,19 @@
+import contextlib
+import hashlib
 import os
 import pathlib
+import shutil
 import subprocess
-from typing import Dict, List, Set
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set
 
 from deepsysid.pipeline.gridsearch import ExperimentSessionReport
 
+from relinet.cachedcli import CACHED_DEEPSYSID_COMMAND
+from relinet.telemetry import TelemetryRecorder
+
+SHARED_MEMORY_DIRECTORY = pathlib.Path('/dev/shm')
+
 
 def load_environment(environment_path: pathlib.Path) -> Dict[str, str]:
     env = os.environ.copy()
@@ -44,48 +53,63 @@ def get_configuration_path(
     )
 
 
+def call_command(
+    command: List[Any],
+    environment: Dict[str, str],
+    telemetry: Optional[TelemetryRecorder] = None,
+    model_name: str = 'session',
+    stage: str = 'session'
+) -> int:
+    if telemetry is None:
+        return subprocess.call(command, env=environment)
+    return telemetry.run_command(
+        model_name,
+        stage,
+        [str(argument) for argument in command],
+        env=environment
+    )
+
+
 def run_full_gridsearch_session(
     report_path: pathlib.Path,
     device_idx: int,
-    environment: Dict[str, str]
+    environment: Dict[str, str],
+    telemetry: Optional[TelemetryRecorder] = None
 ):
     if report_path.exists():
         print('Continuing session...')
         action = 'CONTINUE'
-        return_code = subprocess.call([
-            'deepsysid',
+        return_code = call_command(CACHED_DEEPSYSID_COMMAND + [
             'session',
             '--enable-cuda',
             f'--device-idx={device_idx}',
             f'--reportin={report_path}',
             report_path,
             action
-        ], env=environment)
+        ], environment, telemetry, stage='session')
     else:
         print('Starting session from fresh.')
         action = 'NEW'
-        return_code = subprocess.call([
-            'deepsysid',
+        return_code = call_command(CACHED_DEEPSYSID_COMMAND + [
             'session',
             '--enable-cuda',
             f'--device-idx={device_idx}',
             report_path,
             action
-        ], env=environment)
+        ], environment, telemetry, stage='session')
 
     if return_code != 0:
         raise ValueError('Failed running gridsearch session.')
 
     action = 'TEST_BEST'
-    subprocess.call([
-        'deepsysid',
+    call_command(CACHED_DEEPSYSID_COMMAND + [
         'session',
         '--enable-cuda',
         f'--device-idx={device_idx}',
         f'--reportin={report_path}',
         report_path,
         action
-    ], env=environment)
+    ], environment, telemetry, stage='test-best')
 
 
 def retrieve_tested_models(report_path: pathlib.Path) -> Set[str]:
@@ -98,3 +122,62 @@ def retrieve_tested_models(report_path: pathlib.Path) -> Set[str]:
         )
 
     return report.tested_models
+
+
+@contextlib.contextmanager
+def stage_dataset_in_memory(
+    dataset_directory: pathlib.Path,
+    splits: Sequence[str]
+) -> Iterator[pathlib.Path]:
+    # Copy the splits once to a RAM-backed filesystem. All workers read the same
+    # page-cached files instead of each going back to DATASET_DIRECTORY. Split
+    # caches are copied along, with their modification times.
+    parent = SHARED_MEMORY_DIRECTORY if SHARED_MEMORY_DIRECTORY.is_dir() else None
+    staging_directory = pathlib.Path(tempfile.mkdtemp(prefix='relinet-dataset-', dir=parent))
+    try:
+        for split in splits:
+            for directory_name in ('processed', 'cache'):
+                source_directory = dataset_directory.joinpath(directory_name).joinpath(split)
+                if directory_name == 'cache' and not source_directory.is_dir():
+                    continue
+                shutil.copytree(source_directory, staging_directory.joinpath(directory_name).joinpath(split))
+        yield staging_directory
+    finally:
+        shutil.rmtree(staging_directory, ignore_errors=True)
+
+
+def compute_file_hash(file_path: pathlib.Path) -> str:
+    file_hash = hashlib.sha256()
+    with file_path.open(mode='rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+@contextlib.contextmanager
+def lock_file(lock_path: pathlib.Path) -> Iterator[None]:
+    # Exclusive lock across processes. The operating system releases it when
+    # the holding process dies, so a killed job never blocks the others.
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with lock_path.open(mode='a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)